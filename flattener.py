@@ -1,114 +1,747 @@
 #!/usr/bin/python
 
+import hashlib
+import json
+from optparse import OptionParser
 import os
 import re
+import StringIO
 import sys
+import tempfile
+import time
+import urllib2
 
-CONTINUATION = r".*\n(?:^[ \t].*\n|\n)*"
+import minifier
 
-RE = re.compile(
-r"""
-\s*
-(?:^
-include\s*\(\s*\'([^\']+)\'\s*\)\s*; |
-(?:function\s+(\w+)\s*           (\(.*;|%(c)s^\})) |
-(?:(\w+)\.(\w+(?:\.\w+)*)\s*=\s* (.*;|%(c)s^[\]\}];)) |
-(?:(?:const|let|var)\s+(\w+)     (.*;|%(c)s^[\]\}];)) |
-/\*(?:[^*]+|\*[^/])*\*/ |
-//.*
-[ \t]*\n)
-""" % { 'c' : CONTINUATION },
-re.VERBOSE | re.MULTILINE)
+# The top level of a module is a sequence of statements, each of which
+# starts at the beginning of a line (after any whitespace):
+#
+#  include('Module');
+#  function name(...) { ... }      - ends at a line starting with '}'
+#  Name.property[.property...] = ...;
+#  const|let|var name ...;
+#  /* comment */
+#  // comment
+#
+# A function, assignment or declaration either ends with the last ';'
+# on its first line, or continues over following lines that are blank
+# or indented, and ends at the start of an unindented line: '}' for a
+# function, '];' or '};' for the others.
+#
+# This used to be done with a single regular expression, which could
+# backtrack for minutes when part of a module didn't parse, and then
+# only said that the content was unparseable. _Scanner finds the same
+# statements, with the same text, in a single pass over the module, and
+# says what it was looking for. flattener_benchmark.py compares the two.
 
-NONBLANK_RE = re.compile("\S")
+WHITESPACE = " \t\n\r\f\v"
+WORD_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")
 
-NAME_RE = re.compile("(?<![\w\.])\w+(?!\w)")
+# Blank or indented lines. There is only ever one way for this to match,
+# so it doesn't backtrack.
+_CONTINUATION_LINES_RE = re.compile(r"(?:[ \t][^\n]*\n|\n)*")
+
+# A name that isn't a property (preceded by '.'), as a group, so that
+# split() alternates between the text between names and the names
+NAME_SPLIT_RE = re.compile(r"((?<![\w\.])\w+)")
+
+# Kinds of statements returned by _Scanner.next()
+INCLUDE = 'include'         # (module_name,)
+FUNCTION = 'function'       # (name, rest)
+ASSIGNMENT = 'assignment'   # (object, property, value)
+DECLARATION = 'declaration' # (name, rest)
+COMMENT = 'comment'         # ()
+
+class FlattenError(Exception):
+    def __init__(self, filename, line, message):
+        Exception.__init__(self, "%s: %d: %s" % (filename, line, message))
+        self.filename = filename
+        self.line = line
+
+class _Scanner(object):
+    def __init__(self, filename, contents):
+        self.filename = filename
+        self.contents = contents
+        self.pos = 0
+        # Where the last statement returned by next() starts
+        self.start = 0
+
+    def error(self, pos, message):
+        line = 1 + self.contents.count("\n", 0, pos)
+        raise FlattenError(self.filename, line, message)
+
+    def _skip_whitespace(self, pos):
+        contents = self.contents
+        end = len(contents)
+        while pos < end and contents[pos] in WHITESPACE:
+            pos += 1
+        return pos
+
+    def _skip_word(self, pos):
+        contents = self.contents
+        end = len(contents)
+        while pos < end and contents[pos] in WORD_CHARS:
+            pos += 1
+        return pos
+
+    def _line_end(self, pos):
+        end = self.contents.find("\n", pos)
+        if end < 0:
+            return len(self.contents)
+        return end
+
+    # The end of text from pos up to the last ';' on the line, or -1
+    def _to_semicolon(self, pos):
+        semicolon = self.contents.rfind(";", pos, self._line_end(pos))
+        if semicolon < 0:
+            return -1
+        return semicolon + 1
+
+    # The end of the rest of the line at pos, followed by blank or
+    # indented lines, and then a line starting with one of the strings
+    # in terminators; or -1
+    def _to_terminator(self, pos, terminators):
+        contents = self.contents
+        pos = contents.find("\n", pos)
+        if pos < 0:
+            return -1
+        pos = _CONTINUATION_LINES_RE.match(contents, pos + 1).end()
+        for terminator in terminators:
+            if contents.startswith(terminator, pos):
+                return pos + len(terminator)
+        return -1
+
+    # Find the end of the body of a statement that follows optional
+    # whitespace starting at pos; returns (start, end) or None. When
+    # there is whitespace before the body, a body that doesn't fit at
+    # the end of the whitespace can start at a newline in the
+    # whitespace instead.
+    def _body(self, pos, opening, terminators):
+        contents = self.contents
+        start = self._skip_whitespace(pos)
+        if opening is None or contents.startswith(opening, start):
+            end = self._to_semicolon(start + len(opening or ""))
+            if end >= 0:
+                return start, end
+        end = self._to_terminator(start, terminators)
+        if end >= 0:
+            return start, end
+
+        newline = contents.rfind("\n", pos, start)
+        while newline >= 0:
+            end = self._to_terminator(newline, terminators)
+            if end >= 0:
+                return newline, end
+            newline = contents.rfind("\n", pos, newline)
+
+        return None
+
+    def _include(self, pos):
+        contents = self.contents
+        if not (pos == 0 or contents[pos - 1] == "\n"):
+            return None
+        p = self._skip_whitespace(pos + len("include"))
+        if not contents.startswith("(", p):
+            return None
+        p = self._skip_whitespace(p + 1)
+        if not contents.startswith("'", p):
+            return None
+        quote = contents.find("'", p + 1)
+        if quote <= p + 1:
+            return None
+        module_name = contents[p + 1:quote]
+        p = self._skip_whitespace(quote + 1)
+        if not contents.startswith(")", p):
+            return None
+        p = self._skip_whitespace(p + 1)
+        if not contents.startswith(";", p):
+            return None
+
+        return p + 1, (INCLUDE, module_name)
+
+    def _function(self, pos):
+        contents = self.contents
+        p = pos + len("function")
+        name_start = self._skip_whitespace(p)
+        if name_start == p:
+            return None
+        name_end = self._skip_word(name_start)
+        if name_end == name_start:
+            return None
+        body = self._body(name_end, "(", ("}",))
+        if body is None:
+            self.error(pos, "Can't find the end of function %s: expected '}' at the start of a line" %
+                       contents[name_start:name_end])
+
+        return body[1], (FUNCTION, contents[name_start:name_end], contents[body[0]:body[1]])
+
+    def _assignment(self, pos):
+        contents = self.contents
+        object_end = self._skip_word(pos)
+        if object_end == pos or not contents.startswith(".", object_end):
+            return None
+        property_start = p = object_end + 1
+        while True:
+            word_end = self._skip_word(p)
+            if word_end == p:
+                return None
+            p = word_end
+            if not (contents.startswith(".", p) and contents[p + 1:p + 2] in WORD_CHARS):
+                break
+            p += 1
+        property_end = p
+        p = self._skip_whitespace(p)
+        if not contents.startswith("=", p):
+            return None
+        body = self._body(p + 1, None, ("];", "};"))
+        if body is None:
+            self.error(pos, "Can't find the end of the assignment to %s: expected ';' at the end of the line, or '];' or '};' at the start of a line" %
+                       contents[pos:property_end])
+
+        return body[1], (ASSIGNMENT,
+                         contents[pos:object_end], contents[property_start:property_end],
+                         contents[body[0]:body[1]])
+
+    def _declaration(self, pos):
+        contents = self.contents
+        for keyword in ("const", "let", "var"):
+            if contents.startswith(keyword, pos):
+                break
+        else:
+            return None
+        p = pos + len(keyword)
+        name_start = self._skip_whitespace(p)
+        if name_start == p:
+            return None
+        name_end = self._skip_word(name_start)
+        if name_end == name_start:
+            return None
+        end = self._to_semicolon(name_end)
+        if end < 0:
+            end = self._to_terminator(name_end, ("];", "};"))
+        if end < 0:
+            self.error(pos, "Can't find the end of %s %s: expected ';' at the end of the line, or '];' or '};' at the start of a line" %
+                       (keyword, contents[name_start:name_end]))
+
+        return end, (DECLARATION, contents[name_start:name_end], contents[name_end:end])
+
+    # /* ... */; a '*' followed by anything but '/' doesn't end the
+    # comment, and neither does the character after it
+    def _block_comment(self, pos):
+        contents = self.contents
+        end = len(contents)
+        p = pos + 2
+        while True:
+            star = contents.find("*", p)
+            if star < 0 or star + 1 >= end:
+                self.error(pos, "Unterminated comment")
+            if contents[star + 1] == "/":
+                return star + 2, (COMMENT,)
+            p = star + 2
+
+    def _line_comment(self, pos):
+        newline = self.contents.find("\n", pos)
+        if newline < 0:
+            self.error(pos, "Comment at the end of the file must end with a newline")
+
+        return newline + 1, (COMMENT,)
+
+    # Returns the next statement as a tuple of its kind and its parts, or
+    # None at the end of the module; raises FlattenError if the module
+    # can't be parsed
+    def next(self):
+        contents = self.contents
+        pos = self._skip_whitespace(self.pos)
+        if pos == len(contents):
+            return None
+
+        result = None
+        if contents.startswith("include", pos):
+            result = self._include(pos)
+        if result is None and contents.startswith("function", pos):
+            result = self._function(pos)
+        if result is None and contents[pos] in WORD_CHARS:
+            result = self._assignment(pos)
+            if result is None:
+                result = self._declaration(pos)
+        if result is None and contents.startswith("/*", pos):
+            result = self._block_comment(pos)
+        if result is None and contents.startswith("//", pos):
+            result = self._line_comment(pos)
+        if result is None:
+            self.error(pos, "Unparseable content: %s" % contents[pos:self._line_end(pos)].strip())
+
+        self.start = pos
+        self.pos, statement = result
+        return statement
 
 def moduleToFilename(module_name):
     base_name = module_name[0].lower() + module_name[1:] + ".js"
     return os.path.join("js", base_name)
 
-class Flattener(object):
-    def __init__(self, outf):
-        self.outf = outf
-        self.flattened_modules = set()
+def _get_source_hash():
+    f = open(os.path.splitext(os.path.abspath(__file__))[0] + ".py")
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
 
-    def output_prologue(self):
-        self.outf.write("""\
+# Cache of the translated output of modules, on disk in a directory,
+# and in memory for --watch. An entry is keyed by a hash of the contents
+# of the module, the namespace it is flattened into and this file (so
+# that changing how modules are translated invalidates the cache). The
+# translation of a module doesn't depend on the modules it includes, so
+# when a module changes, only it needs to be translated again; the
+# modules that include it are just reassembled from the cache.
+class ModuleCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.source_hash = _get_source_hash()
+        # key => (pieces, lines)
+        self._memory = {}
+        # Keys looked up or stored since the last prune()
+        self._used = set()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_key(self, contents, namespace):
+        h = hashlib.sha1(self.source_hash)
+        h.update("\0%s\0" % (namespace or ""))
+        h.update(contents)
+        return h.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    # Returns the (pieces, lines) stored for key (see
+    # Flattener.translate()), or None
+    def get(self, key):
+        self._used.add(key)
+        translation = self._memory.get(key)
+        if translation is not None:
+            return translation
+
+        try:
+            f = open(self._get_path(key))
+        except IOError:
+            return None
+        try:
+            try:
+                entry = json.load(f)
+            except ValueError:
+                return None
+        finally:
+            f.close()
+
+        # Pieces are stored as Latin-1, which maps any byte to a character
+        # and back, whatever the encoding of the module
+        translation = ([piece.encode("ISO-8859-1") for piece in entry['pieces']], entry['lines'])
+        self._memory[key] = translation
+        return translation
+
+    def put(self, key, translation):
+        self._used.add(key)
+        self._memory[key] = translation
+        pieces, lines = translation
+
+        # Write and rename so that a concurrent build never sees part of
+        # an entry
+        path = self._get_path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        f = open(tmp_path, "w")
+        try:
+            json.dump({ 'pieces': [piece.decode("ISO-8859-1") for piece in pieces],
+                        'lines': lines }, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    # Remove the entries that haven't been used since the last prune()
+    def prune(self):
+        for filename in os.listdir(self.directory):
+            key, ext = os.path.splitext(filename)
+            if ext == ".json" and not key in self._used:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+        for key in self._memory.keys():
+            if not key in self._used:
+                del self._memory[key]
+        self._used = set()
+
+LICENSE_HEADER = """\
 // Splinter - patch review add-on for Bugzilla
 // By Owen Taylor <otaylor@fishsoup.net>
 // Copyright 2009, Red Hat, Inc.
 // Licensed under MPL 1.1 or later, or GPL 2 or later
 // http://git.fishsoup.net/cgit/splinter
+"""
+
+class Flattener(object):
+    def __init__(self, outf, cache=None):
+        self.outf = outf
+        self.cache = cache
+        self.flattened_modules = set()
+        # Filenames of all modules read, for --watch
+        self.filenames = []
+        # The contents of each module read, for the source map
+        self.sources = {}
+        # For each line of the output, (filename, line) for the line of
+        # a module it comes from, or None
+        self.lines = []
 
+    def write(self, text, lines=None):
+        self.outf.write(text)
+        if lines is None:
+            lines = [None] * text.count("\n")
+        self.lines.extend(lines)
+
+    def output_prologue(self):
+        self.write(LICENSE_HEADER + """
 if (!console) {
     var console = {};
     console.log = function() {};
 }
 """);
 
-    def flatten(self, filename, namespace=None):
+    # Translate the statements of a module into the output for it. This
+    # is returned as (pieces, lines), where pieces alternates between
+    # output text and the names of included modules: [text, module, text,
+    # ..., text], and lines has, for each text in pieces, a list of the
+    # lines of the module that its lines come from. Raises FlattenError
+    # if the module can't be parsed.
+    def translate(self, filename, contents, namespace=None):
+        pieces = []
+        lines = []
+        output = []
+        output_lines = []
         locals = {}
-        f = open(filename)
-        contents = f.read()
-
-        def error(pos):
-            m = NONBLANK_RE.search(contents, pos)
-            leading = contents[0:m.start()]
-            line = 1 + leading.count("\n")
-            print >>sys.stderr, "%s: %d: Unparseable content\n" % (filename, line)
-            sys.exit(1)
 
         def add_local(name):
             locals[name] = namespace + "." + name
 
-        def substitute_name(m):
-            name = m.group(0)
-            if name in locals:
-                return locals[name]
-            else:
-                return name
-
+        # Splitting out the names and replacing them with a list
+        # comprehension is faster than NAME_RE.sub() with a function
         def substitute_locals(str):
-            return NAME_RE.sub(substitute_name, str)
-
-        last_end = 0
-        for m in RE.finditer(contents):
-            if m.start() != last_end:
-                error(last_end)
-
-            if m.group(1) is not None:
-                module_name = m.group(1)
-                if not module_name in self.flattened_modules:
-                    self.flattened_modules.add(module_name)
-                    print >>self.outf, "var %s = {};" % module_name
-                    self.flatten(moduleToFilename(module_name), module_name)
-            elif m.group(2) is not None:
+            if len(locals) == 0:
+                return str
+            parts = NAME_SPLIT_RE.split(str)
+            get = locals.get
+            parts[1::2] = [get(name, name) for name in parts[1::2]]
+            return "".join(parts)
+
+        # Line numbers are counted forward from the last position asked
+        # about, since statements are returned in order
+        line_pos = [0, 1]
+        def get_line(pos):
+            line_pos[1] += contents.count("\n", line_pos[0], pos)
+            line_pos[0] = pos
+            return line_pos[1]
+
+        # The first line of the output for a statement is the line the
+        # statement starts on, the rest follow the lines of body
+        def add_output(text, body):
+            start_line = get_line(scanner.start)
+            body_line = get_line(scanner.pos - len(body))
+            output.append(text)
+            output_lines.append(start_line)
+            output_lines.extend(xrange(body_line + 1, body_line + 1 + body.count("\n")))
+
+        scanner = _Scanner(filename, contents)
+        while True:
+            statement = scanner.next()
+            if statement is None:
+                break
+
+            kind = statement[0]
+            if kind == INCLUDE:
+                pieces.append("".join(output))
+                lines.append(output_lines)
+                pieces.append(statement[1])
+                output = []
+                output_lines = []
+            elif kind == FUNCTION:
+                name, rest = statement[1:]
                 if namespace is None:
-                    print >>self.outf, "function %s%s" % (m.group(2), m.group(3))
+                    add_output("function %s%s\n" % (name, rest), rest)
                 else:
-                    add_local(m.group(2))
-                    print >>self.outf, "%s.%s = function%s;" % (namespace, m.group(2), substitute_locals(m.group(3)))
-            elif m.group(4) is not None:
-                if m.group(4) == "jQuery" or namespace is None:
-                    print >>self.outf, "%s.%s = %s" % (m.group(4), m.group(5), m.group(6))
+                    add_local(name)
+                    add_output("%s.%s = function%s;\n" % (namespace, name, substitute_locals(rest)), rest)
+            elif kind == ASSIGNMENT:
+                object, property, value = statement[1:]
+                if object == "jQuery" or namespace is None:
+                    add_output("%s.%s = %s\n" % (object, property, value), value)
                 else:
-                    print >>self.outf, "%s.%s.%s = %s" % (namespace, m.group(4), m.group(5), substitute_locals(m.group(6)))
-            elif m.group(7) is not None:
+                    add_output("%s.%s.%s = %s\n" % (namespace, object, property, substitute_locals(value)), value)
+            elif kind == DECLARATION:
+                name, rest = statement[1:]
                 if namespace is None:
-                    print >>self.outf, "var %s%s" % (m.group(7), m.group(8))
+                    add_output("var %s%s\n" % (name, rest), rest)
                 else:
-                    add_local(m.group(7))
-                    print >>self.outf, "%s.%s%s" % (namespace, m.group(7), substitute_locals(m.group(8)))
+                    add_local(name)
+                    add_output("%s.%s%s\n" % (namespace, name, substitute_locals(rest)), rest)
+
+        pieces.append("".join(output))
+        lines.append(output_lines)
+        return pieces, lines
+
+    # Raises FlattenError if a module can't be parsed
+    def flatten(self, filename, namespace=None):
+        self.filenames.append(filename)
+        f = open(filename)
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        self.sources[filename] = contents
 
-            last_end = m.end()
+        if self.cache is not None:
+            key = self.cache.get_key(contents, namespace)
+            translation = self.cache.get(key)
+            if translation is None:
+                translation = self.translate(filename, contents, namespace)
+                self.cache.put(key, translation)
+        else:
+            translation = self.translate(filename, contents, namespace)
 
-        m = NONBLANK_RE.search(contents, last_end)
-        if m:
-            error(last_end)
+        pieces, lines = translation
+        for i, piece in enumerate(pieces):
+            if i % 2 == 0:
+                self.write(piece, [(filename, line) for line in lines[i // 2]])
+            elif not piece in self.flattened_modules:
+                self.flattened_modules.add(piece)
+                self.write("var %s = {};\n" % piece)
+                self.flatten(moduleToFilename(piece), piece)
 
-if __name__ == '__main__':
-    flattener = Flattener(sys.stdout)
+_VLQ_DIGITS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+# Base64 VLQ, as used in source maps
+def _encode_vlq(value):
+    if value < 0:
+        value = ((-value) << 1) | 1
+    else:
+        value <<= 1
+
+    result = ""
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value > 0:
+            digit |= 32
+        result += _VLQ_DIGITS[digit]
+        if value == 0:
+            return result
+
+# Make a version 3 source map for a file called name. output_lines has,
+# for each line of the file, a list of (column, line) pairs that map
+# from that column on to a line of the flattened output, and
+# flattened_lines has, for each line of the flattened output, the
+# (filename, line) it comes from, or None. The contents of the modules
+# are included, so the map works without them being served.
+def make_source_map(name, output_lines, flattened_lines, sources, source_root):
+    filenames = []
+    indices = {}
+    mappings = []
+    last_column = last_index = last_line = 0
+    for segments in output_lines:
+        encoded = []
+        last_column = 0
+        for column, flattened_line in segments:
+            source = flattened_lines[flattened_line]
+            if source is None:
+                encoded.append(_encode_vlq(column - last_column))
+            else:
+                filename, line = source
+                if not filename in indices:
+                    indices[filename] = len(filenames)
+                    filenames.append(filename)
+                index = indices[filename]
+                encoded.append(_encode_vlq(column - last_column) +
+                               _encode_vlq(index - last_index) +
+                               _encode_vlq(line - 1 - last_line) +
+                               _encode_vlq(0))
+                last_index = index
+                last_line = line - 1
+            last_column = column
+        mappings.append(",".join(encoded))
+
+    return json.dumps({
+            'version': 3,
+            'file': name,
+            'sources': [os.path.relpath(filename, source_root) for filename in filenames],
+            'sourcesContent': [sources[filename] for filename in filenames],
+            'names': [],
+            'mappings': ";".join(mappings)
+            }, separators=(',', ':'))
+
+# Write data to path, without anything ever seeing it half-written
+def write_file(path, data):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    f = open(tmp_path, "w")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+# Write the flattened output minified to a file named for output with a
+# hash of its contents, like splinter.flat.0123456789ab.js for
+# splinter.flat.js, along with a source map; earlier files like these
+# are removed. Returns the names of the files.
+def write_production(output, flattener, flattened):
+    minified, output_lines = minifier.minify(flattened, flattener.flattened_modules)
+    # Keep the license, and map the minified lines after it
+    minified = LICENSE_HEADER + minified + "\n"
+    output_lines = [[]] * LICENSE_HEADER.count("\n") + output_lines
+
+    directory, basename = os.path.split(output)
+    base, ext = os.path.splitext(basename)
+    name = "%s.%s%s" % (base, hashlib.sha1(minified).hexdigest()[0:12], ext)
+    map_name = name + ".map"
+
+    for filename in os.listdir(directory or "."):
+        if (filename.startswith(base + ".") and
+            re.match(r"\.[0-9a-f]{12}%s(\.map)?$" % re.escape(ext), filename[len(base):]) and
+            filename != name and filename != map_name):
+            os.remove(os.path.join(directory, filename))
+
+    write_file(os.path.join(directory, map_name),
+               make_source_map(name, output_lines, flattener.lines, flattener.sources, directory or "."))
+    write_file(os.path.join(directory, name),
+               minified + "//# sourceMappingURL=%s\n" % map_name)
+
+    return [name, map_name]
+
+# Flatten the modules in filenames to output, or to stdout if output is
+# None; if production is True, minify it instead, as described for
+# write_production(). The names of the files written are written to
+# name_file, if it isn't None, for the Makefile to substitute into
+# index.html. Returns the filenames of all the modules read, or None if
+# there was an error, which has been printed.
+def build(filenames, output, cache, production=False, name_file=None):
+    outf = StringIO.StringIO()
+    flattener = Flattener(outf, cache)
     flattener.output_prologue()
-    for filename in sys.argv[1:]:
-        flattener.flatten(filename)
+    try:
+        for filename in filenames:
+            flattener.flatten(filename)
+        if production:
+            names = write_production(output, flattener, outf.getvalue())
+        elif output is not None:
+            write_file(output, outf.getvalue())
+            names = [os.path.basename(output)]
+        else:
+            sys.stdout.write(outf.getvalue())
+            names = []
+    except (FlattenError, minifier.MinifyError, IOError, OSError), e:
+        print >>sys.stderr, e
+        return None
+
+    if name_file is not None:
+        names = "".join(name + "\n" for name in names)
+        # Only touched when it changes, so that what depends on it
+        # isn't rebuilt
+        if not os.path.exists(name_file) or open(name_file).read() != names:
+            write_file(name_file, names)
+    if cache is not None:
+        cache.prune()
+
+    return flattener.filenames
+
+# Tell a running splinter_proxy.py that output changed, by POSTing to
+# url (/_splinter/invalidate?path=<path of the output>)
+def notify(url):
+    try:
+        urllib2.urlopen(url, "").close()
+    except (urllib2.URLError, IOError), e:
+        print >>sys.stderr, "Couldn't notify %s: %s" % (url, e)
+
+def get_mtimes(filenames):
+    mtimes = {}
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+            mtimes[filename] = (st.st_mtime, st.st_size)
+        except OSError:
+            mtimes[filename] = None
+    return mtimes
+
+# Call rebuild(), which builds like build(), whenever one of the modules
+# read by the last build changes; modules are checked every
+# WATCH_INTERVAL seconds
+WATCH_INTERVAL = 0.05
+
+def watch(rebuild, filenames, output, notify_url):
+    watched = rebuild()
+    if watched is None:
+        watched = filenames
+    elif notify_url is not None:
+        notify(notify_url)
+    mtimes = get_mtimes(watched)
+
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        if get_mtimes(watched) == mtimes:
+            continue
+
+        # Record the times before building, so that a save during the
+        # build causes another one
+        mtimes = get_mtimes(watched)
+        start = time.time()
+        result = rebuild()
+        if result is None:
+            continue
+
+        print >>sys.stderr, "Wrote %s in %.0fms" % (output, 1000 * (time.time() - start))
+        if notify_url is not None:
+            notify(notify_url)
+        if result != watched:
+            watched = result
+            mtimes = get_mtimes(watched)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] <file.js>...")
+    parser.add_option("-o", "--output", dest="output",
+                      help="file to write to, instead of stdout")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help="directory to cache the translation of each module in")
+    parser.add_option("--watch", action="store_true", dest="watch", default=False,
+                      help="rebuild whenever a module changes; requires --output")
+    parser.add_option("--notify", dest="notify",
+                      help="URL to POST to after the output is written, e.g. "
+                      "http://127.0.0.1:23080/_splinter/invalidate?path=/splinter.flat.js")
+    parser.add_option("--production", action="store_true", dest="production", default=False,
+                      help="minify, and write to a file named with a hash of its contents, "
+                      "along with a source map; requires --output")
+    parser.add_option("--name-file", dest="name_file",
+                      help="file to write the names of the files written to")
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("No files to flatten")
+    if options.watch and options.output is None:
+        parser.error("--watch requires --output")
+    if options.production and options.output is None:
+        parser.error("--production requires --output")
+
+    if options.cache_dir is not None:
+        cache = ModuleCache(options.cache_dir)
+    elif options.watch:
+        cache = ModuleCache(os.path.join(tempfile.gettempdir(), "splinter-flattener-%d" % os.getuid()))
+    else:
+        cache = None
+
+    def rebuild():
+        return build(args, options.output, cache, options.production, options.name_file)
+
+    if options.watch:
+        try:
+            watch(rebuild, args, options.output, options.notify)
+        except KeyboardInterrupt:
+            pass
+    else:
+        if rebuild() is None:
+            sys.exit(1)
+        if options.notify is not None:
+            notify(options.notify)
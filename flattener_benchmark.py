@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# Benchmark of flattener.py against the single regular expression it used
+# to parse modules with, on large synthetic modules. The output of the
+# two is also compared, to check that the scanner finds exactly the same
+# statements.
+#
+#  flattener_benchmark.py [-f <functions>] [-l <lines per function>] [-r <repeats>]
+
+from optparse import OptionParser
+import os
+import re
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+import flattener
+
+# The regular expressions and loop from the old flattener.py
+
+CONTINUATION = r".*\n(?:^[ \t].*\n|\n)*"
+
+RE = re.compile(
+r"""
+\s*
+(?:^
+include\s*\(\s*\'([^\']+)\'\s*\)\s*; |
+(?:function\s+(\w+)\s*           (\(.*;|%(c)s^\})) |
+(?:(\w+)\.(\w+(?:\.\w+)*)\s*=\s* (.*;|%(c)s^[\]\}];)) |
+(?:(?:const|let|var)\s+(\w+)     (.*;|%(c)s^[\]\}];)) |
+/\*(?:[^*]+|\*[^/])*\*/ |
+//.*
+[ \t]*\n)
+""" % { 'c' : CONTINUATION },
+re.VERBOSE | re.MULTILINE)
+
+NONBLANK_RE = re.compile("\S")
+
+NAME_RE = re.compile("(?<![\w\.])\w+(?!\w)")
+
+class RegexFlattener(flattener.Flattener):
+    def flatten(self, filename, namespace=None):
+        locals = {}
+        f = open(filename)
+        contents = f.read()
+
+        def error(pos):
+            m = NONBLANK_RE.search(contents, pos)
+            leading = contents[0:m.start()]
+            line = 1 + leading.count("\n")
+            raise flattener.FlattenError(filename, line, "Unparseable content")
+
+        def add_local(name):
+            locals[name] = namespace + "." + name
+
+        def substitute_name(m):
+            name = m.group(0)
+            if name in locals:
+                return locals[name]
+            else:
+                return name
+
+        def substitute_locals(str):
+            return NAME_RE.sub(substitute_name, str)
+
+        last_end = 0
+        for m in RE.finditer(contents):
+            if m.start() != last_end:
+                error(last_end)
+
+            if m.group(1) is not None:
+                module_name = m.group(1)
+                if not module_name in self.flattened_modules:
+                    self.flattened_modules.add(module_name)
+                    print >>self.outf, "var %s = {};" % module_name
+                    self.flatten(flattener.moduleToFilename(module_name), module_name)
+            elif m.group(2) is not None:
+                if namespace is None:
+                    print >>self.outf, "function %s%s" % (m.group(2), m.group(3))
+                else:
+                    add_local(m.group(2))
+                    print >>self.outf, "%s.%s = function%s;" % (namespace, m.group(2), substitute_locals(m.group(3)))
+            elif m.group(4) is not None:
+                if m.group(4) == "jQuery" or namespace is None:
+                    print >>self.outf, "%s.%s = %s" % (m.group(4), m.group(5), m.group(6))
+                else:
+                    print >>self.outf, "%s.%s.%s = %s" % (namespace, m.group(4), m.group(5), substitute_locals(m.group(6)))
+            elif m.group(7) is not None:
+                if namespace is None:
+                    print >>self.outf, "var %s%s" % (m.group(7), m.group(8))
+                else:
+                    add_local(m.group(7))
+                    print >>self.outf, "%s.%s%s" % (namespace, m.group(7), substitute_locals(m.group(8)))
+
+            last_end = m.end()
+
+        m = NONBLANK_RE.search(contents, last_end)
+        if m:
+            error(last_end)
+
+# A module with n_functions functions of about lines_per_function lines
+# each, along with the other kinds of statements
+def make_module(n_functions, lines_per_function):
+    parts = ["/* -*- mode: js2; js2-basic-offset: 4; indent-tabs-mode: nil -*- */\n",
+             "include('Utils');\n\n"]
+    for i in xrange(n_functions):
+        parts.append("// Function %d\n" % i)
+        parts.append("const LIMIT_%d = %d;\n\n" % (i, i))
+        parts.append("function helper%d(a, b) {\n" % i)
+        for j in xrange(lines_per_function):
+            if j % 10 == 9:
+                parts.append("\n")
+            else:
+                parts.append("    var x%d = helper%d(a, Utils.strip(b)) + LIMIT_%d; // %d\n" % (j, max(i - 1, 0), i, j))
+        parts.append("    return a;\n}\n\n")
+        parts.append("function Thing%d(a) {\n    this._init(a);\n}\n\n" % i)
+        parts.append("Thing%d.prototype = {\n    _init : function(a) {\n        this.a = helper%d(a, a);\n    }\n};\n\n" % (i, i))
+
+    return "".join(parts)
+
+def run(flattener_class, filename, repeats):
+    best = None
+    for i in xrange(repeats):
+        outf = StringIO.StringIO()
+        start = time.time()
+        f = flattener_class(outf)
+        f.flatten(filename, "Module")
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, outf.getvalue()
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-f", "--functions", type="int", dest="functions", default=200,
+                      help="number of functions in the module")
+    parser.add_option("-l", "--lines", type="string", dest="lines", default="10,100,1000",
+                      help="comma-separated lines per function to test with")
+    parser.add_option("-r", "--repeats", type="int", dest="repeats", default=3,
+                      help="times to repeat each run; the best time is reported")
+    options, args = parser.parse_args()
+
+    # Modules are included from js/ relative to the current directory
+    directory = tempfile.mkdtemp()
+    old_cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        os.mkdir("js")
+        f = open(os.path.join("js", "utils.js"), "w")
+        f.write("function strip(s) {\n    return s;\n}\n")
+        f.close()
+
+        print "%8s %10s %10s %10s %8s" % ("lines", "size", "regex", "scanner", "speedup")
+        for lines in [int(l) for l in options.lines.split(",")]:
+            filename = os.path.join("js", "module.js")
+            f = open(filename, "w")
+            f.write(make_module(options.functions, lines))
+            f.close()
+
+            regex_time, regex_output = run(RegexFlattener, filename, options.repeats)
+            scanner_time, scanner_output = run(flattener.Flattener, filename, options.repeats)
+            if regex_output != scanner_output:
+                print >>sys.stderr, "Output differs for %d lines per function" % lines
+                sys.exit(1)
+
+            print "%8d %10d %9.3fs %9.3fs %7.1fx" % (lines, os.path.getsize(filename),
+                                                      regex_time, scanner_time,
+                                                      regex_time / scanner_time)
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(directory)
@@ -257,12 +257,16 @@ function Patch(text) {
 Patch.prototype = {
     // cf. parsing in Review.Review.parse()
     _init : function(text) {
+        this.files = [];
+
+        // Patch.fromColumns() fills in the patch itself
+        if (text == null)
+            return;
+
         // Canonicalize newlines to simplify the following
         if (/\r/.test(text))
             text = text.replace(/(\r\n|\r|\n)/g, "\n");
 
-        this.files = [];
-
         var m = FILE_START_RE.exec(text);
         if (m != null)
             this.intro = _cleanIntro(text.substring(0, m.index));
@@ -334,3 +338,30 @@ Patch.prototype = {
         return null;
     }
 };
+
+// Create a patch from the compact form served by the proxy (see
+// proxy/patch_parser.py), where the patch has already been parsed
+// following the rules above and the lines of each hunk are stored as
+// separate oldText, newText and flags arrays
+Patch.fromColumns = function(data) {
+    var patch = new Patch(null);
+    patch.intro = data.intro;
+
+    for (var i = 0; i < data.files.length; i++) {
+        var fileData = data.files[i];
+        var hunks = [];
+        for (var j = 0; j < fileData.hunks.length; j++) {
+            var hunkData = fileData.hunks[j];
+            var hunk = new Hunk(hunkData.oldStart, hunkData.oldCount,
+                                hunkData.newStart, hunkData.newCount,
+                                hunkData.functionLine, "");
+            for (var k = 0; k < hunkData.flags.length; k++)
+                hunk.lines.push([hunkData.oldText[k], hunkData.newText[k], hunkData.flags[k]]);
+            hunks.push(hunk);
+        }
+
+        patch.files.push(new File(fileData.filename, fileData.status, hunks));
+    }
+
+    return patch;
+};
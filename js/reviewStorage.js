@@ -14,6 +14,7 @@ include('Review');
  *      isDraft
  *  loadDraft(bug, attachment, patch)
  *  saveDraft(bug, attachment, review)
+ *  deleteDraft(bug, attachment, review)
  *  draftPublished(bug, attachment)
  */
 
@@ -125,3 +126,115 @@ LocalReviewStorage.prototype = {
         delete localStorage[propertyName];
     }
 };
+
+// Stores reviews with the draft storage API of splinter_proxy.py (see
+// proxy/draft_store.py) at configDraftStorageUrl. Only the review being
+// changed is sent to the server, and only the properties that changed.
+// The interface is synchronous, so the requests are too; they go to the
+// proxy on the local machine.
+function ProxyReviewStorage(url) {
+    this._init(url);
+}
+
+ProxyReviewStorage.available = function() {
+    return typeof(configDraftStorageUrl) != 'undefined' && configDraftStorageUrl != null;
+};
+
+// Number of reviews to get from the server per request when listing
+const PROXY_LIST_PAGE_SIZE = 100;
+
+ProxyReviewStorage.prototype = {
+    _init : function(url) {
+        this._url = url;
+        this._reviewInfos = [];
+
+        while (true) {
+            var result = this._request('GET', {
+                                           offset: this._reviewInfos.length,
+                                           limit: PROXY_LIST_PAGE_SIZE
+                                       });
+            if (result == null)
+                break;
+
+            this._reviewInfos = this._reviewInfos.concat(result.reviews);
+            if (result.reviews.length == 0 || this._reviewInfos.length >= result.total)
+                break;
+        }
+    },
+
+    // Returns the parsed JSON result, or null if the request failed
+    _request : function(type, params, props) {
+        var result = null;
+        var url = this._url + '?' + $.param(params);
+
+        $.ajax({
+                   type: type,
+                   async: false,
+                   dataType: 'json',
+                   contentType: 'application/json',
+                   url: url,
+                   data: props != null ? JSON.stringify(props) : null,
+                   success: function(data) {
+                       result = data;
+                   }
+               });
+
+        return result;
+    },
+
+    listReviews : function() {
+        return this._reviewInfos;
+    },
+
+    loadDraft : function(bug, attachment, patch) {
+        var result = this._request('GET', { bug: bug.id, attachment: attachment.id });
+        if (result != null && result.draft != null) {
+            var review = new Review.Review(patch);
+            review.parse(result.draft);
+            return review;
+        } else {
+            return null;
+        }
+    },
+
+    _findReview : function(bug, attachment) {
+        for (var i = 0 ; i < this._reviewInfos.length; i++)
+            if (this._reviewInfos[i].bugId == bug.id && this._reviewInfos[i].attachmentId == attachment.id)
+                return i;
+
+        return -1;
+    },
+
+    _updateReview : function(bug, attachment, props) {
+        var reviewIndex = this._findReview(bug, attachment);
+        if (reviewIndex < 0) {
+            props.bugShortDesc = bug.shortDesc;
+            props.attachmentDescription = attachment.description;
+        }
+
+        var reviewInfo = this._request('POST', { bug: bug.id, attachment: attachment.id }, props);
+        if (reviewInfo == null)
+            return;
+
+        // Keep the list ordered by modification time, as the server does
+        if (reviewIndex >= 0)
+            this._reviewInfos.splice(reviewIndex, 1);
+        this._reviewInfos.push(reviewInfo);
+    },
+
+    saveDraft : function(bug, attachment, review) {
+        this._updateReview(bug, attachment, { isDraft: true, draft: "" + review });
+    },
+
+    deleteDraft : function(bug, attachment, review) {
+        this._request('POST', { bug: bug.id, attachment: attachment.id, 'delete': 1 });
+
+        var reviewIndex = this._findReview(bug, attachment);
+        if (reviewIndex >= 0)
+            this._reviewInfos.splice(reviewIndex, 1);
+    },
+
+    draftPublished : function(bug, attachment) {
+        this._updateReview(bug, attachment, { isDraft: false, draft: null });
+    }
+};
@@ -70,7 +70,7 @@ function updateAttachmentStatus(attachment, newStatus, success, failure) {
                    }
                },
                type: 'POST',
-               url: "/attachment.cgi"
+               url: configUrlPrefix + "/attachment.cgi"
            });
 }
 
@@ -97,7 +97,7 @@ function addComment(bug, comment, success, failure) {
                    }
                },
                type: 'POST',
-               url: "/process_bug.cgi"
+               url: configUrlPrefix + "/process_bug.cgi"
            });
 }
 
@@ -126,7 +126,7 @@ function publishReview() {
             params['attachment_status'] = newStatus;
 
         XmlRpc.call({
-                        url: '/xmlrpc.cgi',
+                        url: configUrlPrefix + '/xmlrpc.cgi',
                         name: 'Splinter.publish_review',
                         params: params,
                         error: function(message) {
@@ -974,6 +974,12 @@ function gotAttachment(text) {
         start();
 }
 
+function gotParsedPatch(data) {
+    thePatch = Patch.Patch.fromColumns(data);
+    if (theAttachment != null)
+        start();
+}
+
 function isDigits(str) {
     return str.match(/^[0-9]+$/);
 }
@@ -1140,7 +1146,9 @@ function init() {
     var params = getQueryParams();
     var bugId;
 
-    if (ReviewStorage.LocalReviewStorage.available())
+    if (ReviewStorage.ProxyReviewStorage.available())
+        reviewStorage = new ReviewStorage.ProxyReviewStorage(configDraftStorageUrl);
+    else if (ReviewStorage.LocalReviewStorage.available())
         reviewStorage = new ReviewStorage.LocalReviewStorage();
 
     if (params.bug)
@@ -1155,7 +1163,7 @@ function init() {
         $.ajax({
                    type: 'GET',
                    dataType: 'xml',
-                   url: '/show_bug.cgi',
+                   url: configUrlPrefix + '/show_bug.cgi',
                    data: {
                        id: bugId,
                        ctype: 'xml',
@@ -1177,11 +1185,25 @@ function init() {
             displayError("Attachment ID '" + params.bug + "' is not valid");
             attachmentId = undefined;
         }
+    } else if (configParsedPatchUrl) {
+        // Let the proxy parse the patch for us
+        $.ajax({
+                   type: 'GET',
+                   dataType: 'json',
+                   url: configParsedPatchUrl,
+                   data: {
+                       id: attachmentId
+                   },
+                   success: gotParsedPatch,
+                   error: function(a, b, c) {
+                       displayError("Failed to retrieve attachment " + attachmentId);
+                   }
+               });
     } else {
         $.ajax({
                    type: 'GET',
                    dataType: 'text',
-                   url: '/attachment.cgi',
+                   url: configUrlPrefix + '/attachment.cgi',
                    data: {
                        id: attachmentId
                    },
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+#
+# Minification of the output of flattener.py
+#
+# This isn't a general JavaScript minifier; it relies on knowing what
+# flattener.py produces. Comments are removed and whitespace is
+# collapsed, following the rules of JSMin: a line break is kept only
+# where automatic semicolon insertion could depend on it, and a space
+# only where two tokens would otherwise run together.
+#
+# The names inside functions are left alone, since renaming them safely
+# would need a real parser to find their scopes. What can be renamed is
+# the namespace objects that flattener.py creates for modules
+# ('var Utils = {};'), which are referenced as 'Utils.name' everywhere a
+# name from the module is used; a namespace is only renamed if it is
+# never used any other way, to a name that isn't used anywhere.
+#
+#  minifier.py <file.js>
+
+import re
+import sys
+
+_TOKEN_RE = re.compile(r"""
+(?P<space>[ \t\r\f\v]+) |
+(?P<newline>\n) |
+(?P<comment>//[^\n]* | /\*[\s\S]*?\*/) |
+(?P<string>'(?:[^'\\\n]|\\[\s\S])*' | "(?:[^"\\\n]|\\[\s\S])*") |
+(?P<name>[A-Za-z_$][\w$]*) |
+(?P<number>\.?[0-9](?:[eE][+-]|[\w.])*) |
+(?P<punct>[\s\S])
+""", re.VERBOSE)
+
+# Regular expression literal, from after the initial '/'
+_REGEXP_RE = re.compile(r"(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[\w$]*")
+
+# A '/' after one of these starts a regular expression rather than being
+# division
+_REGEXP_PRECEDERS = frozenset("(,=:[!&|?{};+-*%<>~^")
+_REGEXP_KEYWORDS = frozenset(["return", "typeof", "case", "do", "else", "in", "instanceof", "new", "void", "delete", "throw"])
+
+# A line break between a token ending with one of the characters in
+# _BREAK_AFTER and one starting with one of the characters in
+# _BREAK_BEFORE is kept
+_BREAK_AFTER = re.compile(r"[\w$\\}\])'\"+\-/]$")
+_BREAK_BEFORE = re.compile(r"^[\w$\\{\[(+\-!~'\"/]")
+
+_WORD_CHAR_RE = re.compile(r"[\w$\\]")
+
+# Names that can't be used when renaming
+RESERVED = frozenset("""
+break case catch class const continue debugger default delete do else enum
+export extends false finally for function if implements import in instanceof
+interface let new null package private protected public return static super
+switch this throw true try typeof var void while with yield
+""".split())
+
+class MinifyError(Exception):
+    pass
+
+class _Token(object):
+    def __init__(self, kind, text, line):
+        self.kind = kind
+        self.text = text
+        # Index of the line of the input the token starts on
+        self.line = line
+
+# Split text into tokens; whitespace and comments are returned as
+# 'space' or 'newline' tokens, depending on whether they contain a
+# line break
+def tokenize(text):
+    tokens = []
+    line = 0
+    pos = 0
+    end = len(text)
+    last = None # last significant token
+    while pos < end:
+        if (text[pos] == "/" and last is not None and
+            (last.text in _REGEXP_PRECEDERS or last.text in _REGEXP_KEYWORDS) and
+            not text.startswith("//", pos) and not text.startswith("/*", pos)):
+            m = _REGEXP_RE.match(text, pos + 1)
+            if m is None:
+                raise MinifyError("Unterminated regular expression on line %d" % (line + 1))
+            token = _Token('regexp', text[pos:m.end()], line)
+            pos = m.end()
+        else:
+            m = _TOKEN_RE.match(text, pos)
+            kind = m.lastgroup
+            token_text = m.group(kind)
+            if kind == 'comment':
+                kind = 'newline' if "\n" in token_text else 'space'
+            elif kind == 'punct' and token_text in "'\"":
+                raise MinifyError("Unterminated string on line %d" % (line + 1))
+            elif kind == 'punct' and text.startswith("/*", pos):
+                raise MinifyError("Unterminated comment on line %d" % (line + 1))
+            token = _Token(kind, token_text, line)
+            pos = m.end()
+
+        line += token.text.count("\n")
+        if token.kind != 'space' and token.kind != 'newline':
+            last = token
+        tokens.append(token)
+
+    return tokens
+
+# The tokens that follow a '.'
+def _get_properties(tokens):
+    properties = set()
+    last = None
+    for token in tokens:
+        if token.kind == 'space' or token.kind == 'newline':
+            continue
+        if last is not None and last.text == '.' and token.kind == 'name':
+            properties.add(token)
+        last = token
+
+    return properties
+
+# Pick new names for the namespaces that can be renamed; returns a
+# dictionary from old name to new name
+def _rename_namespaces(tokens, namespaces):
+    significant = [t for t in tokens if t.kind != 'space' and t.kind != 'newline']
+    properties = _get_properties(tokens)
+
+    used = set()
+    safe = set(namespaces)
+    for i, token in enumerate(significant):
+        if token.kind != 'name':
+            continue
+        used.add(token.text)
+        if not token.text in safe or token in properties:
+            continue
+        # 'Name.' or 'var Name = {};'
+        next = significant[i + 1].text if i + 1 < len(significant) else None
+        declaration = [t.text for t in significant[i - 1:i + 5]] == ['var', token.text, '=', '{', '}', ';']
+        if next != '.' and not declaration:
+            safe.discard(token.text)
+
+    renames = {}
+    counter = 0
+    for namespace in sorted(safe, key=lambda n: -sum(1 for t in significant if t.text == n)):
+        while True:
+            new_name = "$" + _base52(counter)
+            counter += 1
+            if not new_name in used and not new_name in RESERVED:
+                break
+        if len(new_name) < len(namespace):
+            renames[namespace] = new_name
+
+    return renames
+
+def _base52(n):
+    digits = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    result = digits[n % 52]
+    n //= 52
+    while n > 0:
+        n -= 1
+        result = digits[n % 52] + result
+        n //= 52
+    return result
+
+# Minify text, renaming the namespaces in the list namespaces where that
+# is safe. Returns the minified text and, for each line of it, a list of
+# (column, line) pairs, each saying that the text from that column on
+# comes from that line of the input. Raises MinifyError for an
+# unterminated string, comment or regular expression.
+def minify(text, namespaces=()):
+    tokens = tokenize(text)
+    renames = _rename_namespaces(tokens, namespaces)
+    properties = _get_properties(tokens)
+
+    lines = [[]]
+    output = []
+    column = 0
+    last = None
+    last_line = None
+    separator = None
+    for token in tokens:
+        if token.kind == 'space':
+            if separator is None:
+                separator = " "
+            continue
+        elif token.kind == 'newline':
+            separator = "\n"
+            continue
+
+        token_text = token.text
+        if token.kind == 'name' and token_text in renames and not token in properties:
+            token_text = renames[token_text]
+
+        if last is not None and separator is not None:
+            if separator == "\n" and _BREAK_AFTER.search(last) and _BREAK_BEFORE.search(token_text):
+                output.append("\n")
+                lines.append([])
+                column = 0
+                last_line = None
+            elif ((_WORD_CHAR_RE.match(last[-1]) and _WORD_CHAR_RE.match(token_text[0])) or
+                  (last[-1] in "+-" and token_text[0] == last[-1]) or
+                  (last[-1] == "/" and token_text[0] in "/*") or
+                  (last[0].isdigit() and token_text[0] == ".")):
+                output.append(" ")
+                column += 1
+
+        if token.line != last_line:
+            lines[-1].append((column, token.line))
+            last_line = token.line
+
+        output.append(token_text)
+        column += len(token_text)
+        # Lines within the token, like a string continued with '\'
+        for i in xrange(token_text.count("\n")):
+            lines.append([(0, token.line + i + 1)])
+            column = len(token_text) - token_text.rfind("\n") - 1
+            last_line = token.line + i + 1
+
+        last = token_text
+        separator = None
+
+    return "".join(output), lines
+
+if __name__ == '__main__':
+    f = open(sys.argv[1])
+    try:
+        text = f.read()
+    finally:
+        f.close()
+
+    try:
+        minified, lines = minify(text)
+    except MinifyError, e:
+        print >>sys.stderr, "%s: %s" % (sys.argv[1], e)
+        sys.exit(1)
+
+    sys.stdout.write(minified)
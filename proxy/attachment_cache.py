@@ -0,0 +1,231 @@
+# On-disk cache of attachment contents
+#
+# Bugzilla never changes the data of an attachment once it has been
+# created, so once we've fetched an attachment we can keep serving
+# it without asking Bugzilla again. Data is stored content-addressed
+# by SHA-1 under <directory>/objects; <directory>/index has a small
+# JSON file per attachment id pointing to the object along with the
+# headers needed to serve it. The modification time of the index file
+# records when the attachment was last used, for LRU eviction once the
+# total size exceeds max_size.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+class CacheWriter:
+    def __init__(self, cache, attachment_id, headers):
+        self.cache = cache
+        self.attachment_id = attachment_id
+        self.headers = headers
+
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.tmp_dir)
+        self.file = os.fdopen(fd, 'wb')
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        if self.file is None:
+            return
+
+        self.size += len(data)
+        if self.size > self.cache.max_size:
+            self.abort()
+            return
+
+        self.file.write(data)
+        self.hash.update(data)
+
+    def commit(self):
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+        self.cache._commit(self.attachment_id, self.headers,
+                           self.temp_path, self.hash.hexdigest(), self.size)
+
+    def abort(self):
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+class AttachmentCache:
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_dir = os.path.join(directory, 'index')
+        self.tmp_dir = os.path.join(directory, 'tmp')
+
+        for d in (self.objects_dir, self.index_dir, self.tmp_dir):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+        self._lock = threading.Lock()
+        # attachment id => entry dictionary
+        self._entries = {}
+        # sha1 => size of the object
+        self._objects = {}
+        self._size = 0
+
+        self._load()
+
+    def _object_path(self, sha1):
+        return os.path.join(self.objects_dir, sha1)
+
+    def _index_path(self, attachment_id):
+        return os.path.join(self.index_dir, str(attachment_id))
+
+    def _load(self):
+        for name in os.listdir(self.tmp_dir):
+            os.unlink(os.path.join(self.tmp_dir, name))
+
+        for name in os.listdir(self.index_dir):
+            index_path = os.path.join(self.index_dir, name)
+            try:
+                f = open(index_path)
+                try:
+                    entry = json.load(f)
+                finally:
+                    f.close()
+                size = os.path.getsize(self._object_path(entry['sha1']))
+                entry['last_used'] = os.path.getmtime(index_path)
+            except (IOError, OSError, ValueError, KeyError):
+                os.unlink(index_path)
+                continue
+
+            self._entries[entry['id']] = entry
+            if not entry['sha1'] in self._objects:
+                self._objects[entry['sha1']] = size
+                self._size += size
+
+        for name in os.listdir(self.objects_dir):
+            if not name in self._objects:
+                os.unlink(os.path.join(self.objects_dir, name))
+
+        self._lock.acquire()
+        try:
+            self._evict()
+        finally:
+            self._lock.release()
+
+    # Returns a copy of the entry for the attachment, with keys 'id',
+    # 'sha1', 'size', 'content_type', 'content_disposition' and
+    # 'last_modified', or None if the attachment isn't cached
+    def lookup(self, attachment_id):
+        self._lock.acquire()
+        try:
+            if not attachment_id in self._entries:
+                return None
+            entry = self._entries[attachment_id]
+            entry['last_used'] = time.time()
+            entry = dict(entry)
+        finally:
+            self._lock.release()
+
+        try:
+            os.utime(self._index_path(attachment_id), None)
+        except OSError:
+            pass
+
+        return entry
+
+    # Returns the number of cached attachments and their total size
+    def get_size(self):
+        self._lock.acquire()
+        try:
+            return len(self._entries), self._size
+        finally:
+            self._lock.release()
+
+    # May raise IOError if the entry was evicted after lookup()
+    def open(self, entry):
+        return open(self._object_path(entry['sha1']), 'rb')
+
+    # Start storing the body of a response; the caller calls write()
+    # on the result with the data, then commit() or abort()
+    def begin_store(self, attachment_id, response):
+        last_modified = response.getheader('last-modified')
+        if last_modified is None:
+            last_modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+
+        headers = {
+            'content_type': response.getheader('content-type'),
+            'content_disposition': response.getheader('content-disposition'),
+            'last_modified': last_modified
+        }
+
+        return CacheWriter(self, attachment_id, headers)
+
+    def _commit(self, attachment_id, headers, temp_path, sha1, size):
+        entry = dict(headers)
+        entry['id'] = attachment_id
+        entry['sha1'] = sha1
+        entry['size'] = size
+
+        self._lock.acquire()
+        try:
+            if sha1 in self._objects:
+                os.unlink(temp_path)
+            else:
+                os.rename(temp_path, self._object_path(sha1))
+                self._objects[sha1] = size
+                self._size += size
+
+            index_path = self._index_path(attachment_id)
+            f = open(index_path + '.tmp', 'w')
+            try:
+                json.dump(entry, f)
+            finally:
+                f.close()
+            os.rename(index_path + '.tmp', index_path)
+
+            old_entry = self._entries.get(attachment_id)
+            entry['last_used'] = time.time()
+            self._entries[attachment_id] = entry
+            if old_entry is not None and old_entry['sha1'] != sha1:
+                self._maybe_remove_object(old_entry['sha1'])
+
+            self._evict()
+        finally:
+            self._lock.release()
+
+    # Called with the lock held
+    def _maybe_remove_object(self, sha1):
+        for entry in self._entries.itervalues():
+            if entry['sha1'] == sha1:
+                return
+
+        try:
+            os.unlink(self._object_path(sha1))
+        except OSError:
+            pass
+        self._size -= self._objects[sha1]
+        del self._objects[sha1]
+
+    # Called with the lock held
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+
+        by_age = sorted(self._entries.itervalues(), key=lambda e: e['last_used'])
+        for entry in by_age:
+            if self._size <= self.max_size:
+                break
+
+            del self._entries[entry['id']]
+            try:
+                os.unlink(self._index_path(entry['id']))
+            except OSError:
+                pass
+            self._maybe_remove_object(entry['sha1'])
@@ -0,0 +1,337 @@
+#!/usr/bin/python
+
+# Load-test splinter_proxy.py against the stand-in Bugzilla server in
+# fake_bugzilla.py. Both are started as separate processes; each
+# scenario is then run at each requested concurrency level, and the
+# requests per second, latency percentiles and peak RSS of the proxy
+# are reported as JSON, so that runs can be compared over time:
+#
+#   ./benchmark.py --concurrency=1,8,32 --output=results.json
+#
+# Proxy configuration options can be set with --set, for example
+# --set bug_cache_ttl=30 --set server_engine="'single'"
+
+import ast
+import datetime
+import httplib
+import json
+from optparse import OptionParser
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+from fake_bugzilla import PATCH_BASE_ID
+
+proxy_dir = os.path.dirname(os.path.realpath(os.path.abspath(__file__)))
+top_dir = os.path.dirname(proxy_dir)
+
+STATIC_REQUESTS = [
+    ('GET', '/splinter.css', None),
+    ('GET', '/jquery.min.js', None),
+    ('GET', '/help.html', None),
+    ('GET', '/config.js', None)
+]
+
+BUG_REQUESTS = [
+    ('GET', '/show_bug.cgi?id=561745&ctype=xml&excludefield=attachmentdata', None)
+]
+
+ATTACHMENT_REQUESTS = [
+    ('GET', '/attachment.cgi?id=123143', None)
+]
+
+PATCH_REQUESTS = [('GET', '/attachment.cgi?id=%d' % (PATCH_BASE_ID + i), None)
+                  for i in xrange(len(os.listdir(os.path.join(top_dir, "testpatches"))))]
+
+XMLRPC_REQUESTS = [
+    ('POST', '/xmlrpc.cgi', xmlrpclib.dumps((), 'Splinter.info'))
+]
+
+# Name => list of (method, path, body); the requests of a scenario are
+# made round-robin
+SCENARIOS = [
+    ('static', STATIC_REQUESTS),
+    ('bug_xml', BUG_REQUESTS),
+    ('attachment', ATTACHMENT_REQUESTS),
+    ('patches', PATCH_REQUESTS),
+    ('xmlrpc', XMLRPC_REQUESTS),
+    ('page_load', STATIC_REQUESTS + BUG_REQUESTS + ATTACHMENT_REQUESTS)
+]
+
+def find_free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def wait_for_port(port, process, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        if process.poll() is not None:
+            raise RuntimeError("Process exited with status %d" % process.returncode)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            try:
+                s.connect(('127.0.0.1', port))
+                return
+            except socket.error:
+                time.sleep(0.05)
+        finally:
+            s.close()
+
+    raise RuntimeError("Timed out waiting for port %d" % port)
+
+# Peak resident set size of a process in kB, sampled while running
+class RssMonitor:
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _sample(self):
+        try:
+            f = open('/proc/%d/status' % self.pid)
+        except IOError:
+            return None
+        try:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        finally:
+            f.close()
+
+        return None
+
+    def _run(self):
+        while not self._stopped.isSet():
+            rss = self._sample()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.peak
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    index = int(round(p * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def run_scenario(port, requests, concurrency, count):
+    lock = threading.Lock()
+    state = { 'next': 0, 'errors': 0, 'bytes': 0 }
+    latencies = []
+
+    def worker():
+        connection = None
+        while True:
+            lock.acquire()
+            try:
+                i = state['next']
+                if i >= count:
+                    break
+                state['next'] += 1
+            finally:
+                lock.release()
+
+            method, path, body = requests[i % len(requests)]
+            start = time.time()
+            try:
+                if connection is None:
+                    connection = httplib.HTTPConnection('127.0.0.1', port)
+                headers = { 'Accept-Encoding': 'gzip' }
+                if body is not None:
+                    headers['Content-Type'] = 'text/xml'
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                ok = response.status < 400
+                if response.will_close:
+                    connection.close()
+                    connection = None
+            except (socket.error, httplib.HTTPException):
+                ok = False
+                data = ''
+                if connection is not None:
+                    connection.close()
+                    connection = None
+            elapsed = time.time() - start
+
+            lock.acquire()
+            try:
+                latencies.append(elapsed)
+                state['bytes'] += len(data)
+                if not ok:
+                    state['errors'] += 1
+            finally:
+                lock.release()
+
+        if connection is not None:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for i in xrange(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': state['errors'],
+        'bytes': state['bytes'],
+        'duration': duration,
+        'requests_per_second': len(latencies) / duration,
+        'latency': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1]
+        }
+    }
+
+def get_git_revision():
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=top_dir,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode == 0:
+            return output.strip()
+    except OSError:
+        pass
+
+    return None
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--concurrency", default="1,8,32",
+                      help="comma separated concurrency levels")
+    parser.add_option("-n", "--requests", type='int', default=500,
+                      help="requests per scenario and concurrency level")
+    parser.add_option("", "--warmup", type='int', default=20,
+                      help="requests made before measuring each scenario")
+    parser.add_option("-s", "--scenario", action='append',
+                      help="scenario to run (may be repeated; default all)")
+    parser.add_option("", "--latency", type='float', default=0.02,
+                      help="latency added to each Bugzilla response in seconds")
+    parser.add_option("", "--redirect", action='store_true',
+                      help="have Bugzilla redirect attachments to attachment_base")
+    parser.add_option("", "--anonymous", action='store_true',
+                      help="run the proxy without a Bugzilla login")
+    parser.add_option("", "--set", action='append', default=[], metavar="<key>=<value>",
+                      help="set a proxy configuration option (value is a Python literal)")
+    parser.add_option("-o", "--output", metavar="<file>",
+                      help="write JSON results to this file rather than stdout")
+
+    options, args = parser.parse_args()
+
+    concurrency_levels = [int(c) for c in options.concurrency.split(',')]
+    scenarios = SCENARIOS
+    if options.scenario:
+        scenarios = [s for s in SCENARIOS if s[0] in options.scenario]
+
+    bugzilla_port = find_free_port()
+    proxy_port = find_free_port()
+
+    proxy_config = {
+        'bugzilla_url': 'http://127.0.0.1:%d/' % bugzilla_port,
+        'proxy_port': proxy_port
+    }
+    if not options.anonymous:
+        proxy_config['bugzilla_login'] = 'john.doe@example.com'
+        proxy_config['bugzilla_password'] = 'password'
+    for setting in options.set:
+        key, value = setting.split('=', 1)
+        proxy_config[key] = ast.literal_eval(value)
+
+    temp_dir = tempfile.mkdtemp(prefix='splinter-benchmark-')
+    config_file = os.path.join(temp_dir, 'config.py')
+    f = open(config_file, 'w')
+    f.write("default_config = 'benchmark'\nconfigs = { 'benchmark': %r }\n" % proxy_config)
+    f.close()
+    log_file = os.path.join(temp_dir, 'proxy.log')
+    print >>sys.stderr, "Proxy log is %s" % log_file
+
+    bugzilla_args = [sys.executable, os.path.join(proxy_dir, 'fake_bugzilla.py'),
+                     '--port=%d' % bugzilla_port, '--latency=%g' % options.latency]
+    if options.redirect:
+        bugzilla_args.append('--redirect')
+
+    devnull = open(os.devnull, 'w')
+    bugzilla = subprocess.Popen(bugzilla_args, stdout=devnull, stderr=devnull)
+    proxy = None
+    try:
+        wait_for_port(bugzilla_port, bugzilla)
+        log = open(log_file, 'w')
+        proxy = subprocess.Popen([sys.executable, os.path.join(proxy_dir, 'splinter_proxy.py'),
+                                  '--config=%s' % config_file],
+                                 stdout=log, stderr=log)
+        log.close()
+        wait_for_port(proxy_port, proxy)
+
+        results = []
+        for name, requests in scenarios:
+            for concurrency in concurrency_levels:
+                if options.warmup > 0:
+                    run_scenario(proxy_port, requests, concurrency, options.warmup)
+                monitor = RssMonitor(proxy.pid)
+                result = run_scenario(proxy_port, requests, concurrency, options.requests)
+                result['peak_rss_kb'] = monitor.stop()
+                result['scenario'] = name
+                result['concurrency'] = concurrency
+                results.append(result)
+
+                print >>sys.stderr, "%-12s c=%-4d %8.1f req/s  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  errors %d  rss %s kB" % (
+                    name, concurrency, result['requests_per_second'],
+                    1000 * result['latency']['p50'], 1000 * result['latency']['p95'],
+                    1000 * result['latency']['p99'], result['errors'], result['peak_rss_kb'])
+    finally:
+        if proxy is not None and proxy.poll() is None:
+            proxy.terminate()
+            proxy.wait()
+        bugzilla.terminate()
+        bugzilla.wait()
+        devnull.close()
+
+    report = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_revision': get_git_revision(),
+        'python': sys.version.split()[0],
+        'options': {
+            'requests': options.requests,
+            'warmup': options.warmup,
+            'latency': options.latency,
+            'redirect': bool(options.redirect),
+            'anonymous': bool(options.anonymous),
+            'proxy_config': proxy_config
+        },
+        'results': results
+    }
+
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Splitting and joining the XML from show_bug.cgi?ctype=xml
+#
+# Given several id parameters, show_bug.cgi returns the XML for all the
+# bugs in one document: the usual prolog and <bugzilla> element, with a
+# <bug> element for each bug. To cache the bugs of such a document
+# separately, and to put bugs from the cache together with ones just
+# fetched, documents are split at the <bug> elements as text, so that
+# each bug comes out byte for byte as Bugzilla sent it. Text content is
+# escaped in the XML, so '<bug' and '</bug>' only appear as tags.
+
+import re
+
+_ROOT_RE = re.compile(r"<bugzilla(?:\s[^>]*)?>")
+_BUG_RE = re.compile(r"<bug(?:\s[^>]*)?>.*?</bug>", re.DOTALL)
+_BUG_ID_RE = re.compile(r"<bug_id>\s*([0-9]+)\s*</bug_id>")
+# Bugzilla reports a bug that doesn't exist or can't be seen as
+# <bug error="NotFound"> and so on
+_ERROR_RE = re.compile(r"<bug\s[^>]*\berror\s*=")
+
+class BugXmlError(Exception):
+    pass
+
+# Split a document into its prolog, up to and including the start tag
+# of the <bugzilla> element, and a list of (bug ID, error, text of the
+# <bug> element) for the bugs in it; bug ID is None if the element
+# doesn't have one, and error is True for the bugs that Bugzilla
+# couldn't return. Raises BugXmlError if there's no <bugzilla> element.
+def split_bugs(xml):
+    m = _ROOT_RE.search(xml)
+    if m is None:
+        raise BugXmlError("No <bugzilla> element")
+    prolog = xml[0:m.end()]
+
+    bugs = []
+    for m in _BUG_RE.finditer(xml, m.end()):
+        element = m.group(0)
+        bug_id = _BUG_ID_RE.search(element)
+        bugs.append((int(bug_id.group(1)) if bug_id is not None else None,
+                     _ERROR_RE.match(element) is not None,
+                     element))
+
+    return prolog, bugs
+
+# Put a document together from a prolog and <bug> elements, as returned
+# by split_bugs()
+def join_bugs(prolog, elements):
+    parts = [prolog, "\n"]
+    for element in elements:
+        parts.append("\n    ")
+        parts.append(element)
+        parts.append("\n")
+    parts.append("\n</bugzilla>\n")
+
+    return "".join(parts)
@@ -0,0 +1,112 @@
+# Content-Encoding support: negotiation from Accept-Encoding and
+# incremental gzip/deflate encoders for compressing responses as they
+# are streamed to the client.
+
+import struct
+import zlib
+
+# Types that are worth compressing; images, archives and so forth
+# are already compressed
+COMPRESSIBLE_TYPES = [
+    'application/javascript',
+    'application/json',
+    'application/x-javascript',
+    'application/xml',
+    'image/svg+xml'
+]
+
+def is_compressible(content_type):
+    if content_type is None:
+        return False
+
+    content_type = content_type.split(';')[0].strip().lower()
+    return (content_type.startswith('text/') or
+            content_type.endswith('+xml') or
+            content_type in COMPRESSIBLE_TYPES)
+
+# Pick the encoding to use for a response given the Accept-Encoding header
+# of the request; returns 'gzip', 'deflate' or None
+def choose_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for item in accept_encoding.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.
+        qualities[coding] = q
+
+    best = None
+    best_q = 0.
+    for coding in ('gzip', 'deflate'):
+        q = qualities.get(coding, qualities.get('*', 0.))
+        if q > best_q:
+            best = coding
+            best_q = q
+
+    return best
+
+# mtime of 0 and OS of 'unknown'
+GZIP_HEADER = '\037\213\010\000\000\000\000\000\000\377'
+
+class GzipEncoder:
+    encoding = 'gzip'
+
+    def __init__(self, level=6):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.crc = zlib.crc32('')
+        self.size = 0
+        self.header_written = False
+
+    def _add_header(self, data):
+        if self.header_written:
+            return data
+
+        self.header_written = True
+        return GZIP_HEADER + data
+
+    # Returns the compressed data that is ready; may be ''
+    def compress(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+        return self._add_header(self.compressor.compress(data))
+
+    def flush(self):
+        return (self._add_header(self.compressor.flush()) +
+                struct.pack('<LL', self.crc & 0xffffffffL, self.size & 0xffffffffL))
+
+# 'deflate' in HTTP is the zlib format, not raw deflate
+class DeflateEncoder:
+    encoding = 'deflate'
+
+    def __init__(self, level=6):
+        self.compressor = zlib.compressobj(level)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+def make_encoder(encoding, level=6):
+    if encoding == 'gzip':
+        return GzipEncoder(level)
+    elif encoding == 'deflate':
+        return DeflateEncoder(level)
+    else:
+        raise RuntimeError("Bad encoding %s" % encoding)
+
+def gzip_data(data, level=9):
+    encoder = GzipEncoder(level)
+    return encoder.compress(data) + encoder.flush()
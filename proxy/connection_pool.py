@@ -0,0 +1,220 @@
+# Pooling of keep-alive connections to the upstream Bugzilla server
+#
+# httplib.HTTPConnection speaks HTTP/1.1 and will happily send several
+# requests over one socket as long as each response is read completely
+# before the next request is made. We keep a small stack of such idle
+# connections per (scheme, host, port) so that proxied requests don't
+# pay for a TCP (and possibly SSL) handshake every time.
+
+import httplib
+import metrics
+import os
+import select
+import socket
+import threading
+import time
+
+# Errors that indicate a reused connection was closed by the server
+# while it sat in the pool; the request is retried on a fresh connection
+STALE_CONNECTION_ERRORS = (socket.error,
+                           httplib.BadStatusLine,
+                           httplib.CannotSendRequest,
+                           httplib.ResponseNotReady)
+
+# Methods that can be safely sent again even if the server may already
+# have handled them
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+class ConnectionPool:
+    def __init__(self, scheme, hostname, port, max_size=4, idle_timeout=15):
+        self.scheme = scheme
+        self.hostname = hostname
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        # List of (connection, time_released); the most recently released
+        # connection is at the end, and is the one we hand out first
+        self._idle = []
+        self._pid = os.getpid()
+
+    # A process forked by the fork server engine gets copies of the idle
+    # connections of its parent, and the sockets can't be shared with the
+    # parent or other children - they'd read each other's responses - so
+    # each process starts with an empty pool of its own
+    def _check_process(self):
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._idle = []
+            self._pid = os.getpid()
+
+    def _create(self):
+        if self.scheme == 'http':
+            connection = httplib.HTTPConnection(self.hostname, self.port)
+        else:
+            connection = httplib.HTTPSConnection(self.hostname, self.port)
+        connection.connect()
+        connection.splinter_reused = False
+
+        return connection
+
+    # A pooled connection is still usable if it hasn't been idle longer
+    # than the server is likely to keep it open, and if the socket isn't
+    # readable - with no request outstanding, readable means that the
+    # server has closed its end (or sent something unexpected.)
+    def _is_healthy(self, connection, released):
+        if connection.sock is None:
+            return False
+        if time.time() - released > self.idle_timeout:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+
+        return len(readable) == 0
+
+    # Get a connection, reusing an idle one if possible. The connection
+    # has a 'splinter_reused' attribute so that the caller can tell whether
+    # a failure might be just because the server closed a stale connection.
+    def get(self):
+        self._check_process()
+        while True:
+            self._lock.acquire()
+            try:
+                if len(self._idle) == 0:
+                    break
+                connection, released = self._idle.pop()
+            finally:
+                self._lock.release()
+
+            if self._is_healthy(connection, released):
+                connection.splinter_reused = True
+                return connection
+            connection.close()
+
+        return self._create()
+
+    # Give a connection back once the response to the last request on it
+    # has been completely read. Connections the server is going to close
+    # and connections beyond max_size are simply closed.
+    def release(self, connection, response=None):
+        if (connection.sock is None or
+            (response is not None and (response.will_close or not response.isclosed()))):
+            connection.close()
+            return
+
+        self._check_process()
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.max_size:
+                self._idle.append((connection, time.time()))
+                return
+        finally:
+            self._lock.release()
+
+        connection.close()
+
+    def discard(self, connection):
+        connection.close()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+
+        for connection, released in idle:
+            connection.close()
+
+    # Send a request and get the response headers, retrying once on a new
+    # connection if a reused connection turns out to be stale. Requests
+    # other than GET and HEAD are only retried if sending them failed;
+    # once the whole request is sent, the server may have acted on it even
+    # though we don't get a response, so the error is raised. body can be
+    # None, a string, or a file-like object that is read and sent
+    # buffer_size bytes at a time. A file is rewound with seek() to send it
+    # a second time; if it can't be rewound, a new connection is used to
+    # begin with. Returns the connection and response; the caller must
+    # read the response and then call release() with both.
+    def request(self, method, path, headers, body=None, buffer_size=64 * 1024):
+        is_file = hasattr(body, 'read')
+        position = None
+        if is_file and hasattr(body, 'seek'):
+            position = body.tell()
+
+        while True:
+            start = time.time()
+            if is_file and position is None:
+                connection = self._create()
+            else:
+                connection = self.get()
+            sent = time.time()
+            metrics.observe('splinter_upstream_connect_seconds', sent - start)
+            request_sent = False
+            try:
+                # Don't let httplib add 'Accept-Encoding: identity' when
+                # passing on the client's Accept-Encoding
+                skip_accept_encoding = False
+                for header, value in headers:
+                    if header.lower() == 'accept-encoding':
+                        skip_accept_encoding = True
+                connection.putrequest(method, path,
+                                      skip_accept_encoding=skip_accept_encoding)
+                for header, value in headers:
+                    connection.putheader(header, value)
+
+                # Passing the (start of the) body to endheaders() sends it
+                # in the same packet as the headers when it's small, rather
+                # than waiting on a delayed ACK before sending it
+                if is_file:
+                    data = body.read(buffer_size)
+                    connection.endheaders(data or None)
+                    bytes_sent = len(data)
+                    while data:
+                        data = body.read(buffer_size)
+                        if data:
+                            connection.send(data)
+                            bytes_sent += len(data)
+                else:
+                    connection.endheaders(body or None)
+                    bytes_sent = len(body or '')
+                if bytes_sent > 0:
+                    metrics.inc('splinter_bytes_out_total', bytes_sent, peer='upstream')
+                request_sent = True
+
+                response = connection.getresponse()
+                metrics.observe('splinter_upstream_first_byte_seconds', time.time() - sent)
+
+                return connection, response
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if not connection.splinter_reused:
+                    raise
+                if request_sent and not method in IDEMPOTENT_METHODS:
+                    raise
+                if position is not None:
+                    body.seek(position)
+            except:
+                # The request may have been partially sent
+                connection.close()
+                raise
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Get the shared pool for a particular upstream server; max_size and
+# idle_timeout are only used when the pool is first created. Users of
+# the same server with a different namespace get separate pools.
+def get_pool(scheme, hostname, port, max_size=4, idle_timeout=15, namespace=None):
+    key = (namespace, scheme, hostname, port)
+    _pools_lock.acquire()
+    try:
+        if not key in _pools:
+            _pools[key] = ConnectionPool(scheme, hostname, port, max_size, idle_timeout)
+        return _pools[key]
+    finally:
+        _pools_lock.release()
@@ -0,0 +1,169 @@
+# Storage of review drafts in SQLite
+#
+# In the browser, drafts are kept in localStorage, where the list of
+# reviews is a single JSON string that is rewritten on every change.
+# When draft_store_path is set in the configuration, the proxy keeps
+# them instead in a SQLite database with a row for each (bug,
+# attachment), so that saving a draft only writes that row, and only
+# the columns that changed.
+#
+# The database is used in WAL mode, so that listing reviews doesn't
+# wait on a draft being saved. Each thread has its own connection, as
+# does each process with the forking server engine.
+
+import os
+import sqlite3
+import threading
+import time
+
+# The properties of a review, as used by the ReviewStorage interface in
+# js/reviewStorage.js, and the columns they are stored in
+PROPERTIES = [
+    ('bugId', 'bug_id'),
+    ('bugShortDesc', 'bug_short_desc'),
+    ('attachmentId', 'attachment_id'),
+    ('attachmentDescription', 'attachment_description'),
+    ('creationTime', 'creation_time'),
+    ('modificationTime', 'modification_time'),
+    ('isDraft', 'is_draft')
+]
+
+# The properties that can be set by update(), and the types of value
+# they can be set to; strings can also be set to null
+UPDATABLE = {
+    'bugShortDesc': basestring,
+    'attachmentDescription': basestring,
+    'isDraft': bool,
+    'draft': basestring
+}
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS reviews (
+           bug_id INTEGER NOT NULL,
+           attachment_id INTEGER NOT NULL,
+           bug_short_desc TEXT,
+           attachment_description TEXT,
+           creation_time INTEGER NOT NULL,
+           modification_time INTEGER NOT NULL,
+           is_draft INTEGER NOT NULL DEFAULT 0,
+           draft TEXT,
+           PRIMARY KEY (bug_id, attachment_id))""",
+    """CREATE INDEX IF NOT EXISTS reviews_attachment_id ON reviews (attachment_id)""",
+    """CREATE INDEX IF NOT EXISTS reviews_modification_time ON reviews (modification_time)"""
+]
+
+class DraftStoreError(Exception):
+    pass
+
+def _row_to_review(row):
+    review = {}
+    for i, (prop, column) in enumerate(PROPERTIES):
+        review[prop] = row[i]
+    review['isDraft'] = review['isDraft'] != 0
+
+    return review
+
+class DraftStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        connection = self._get_connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10)
+            # With WAL, a commit is still atomic and durable against a
+            # crash of the proxy without syncing every time
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    # Returns (reviews, total) for the reviews ordered by modification
+    # time, oldest first, starting at offset; limit of None means all
+    def list(self, offset=0, limit=None):
+        connection = self._get_connection()
+        columns = ', '.join(column for prop, column in PROPERTIES)
+        if limit is None:
+            limit = -1
+        rows = connection.execute("SELECT " + columns + " FROM reviews " +
+                                  "ORDER BY modification_time, bug_id, attachment_id " +
+                                  "LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        total = connection.execute("SELECT COUNT(*) FROM reviews").fetchone()[0]
+
+        return [_row_to_review(row) for row in rows], total
+
+    # Returns the review for the attachment, with its text as 'draft',
+    # or None if there isn't one
+    def get(self, bug_id, attachment_id):
+        connection = self._get_connection()
+        columns = ', '.join(column for prop, column in PROPERTIES)
+        row = connection.execute("SELECT " + columns + ", draft FROM reviews " +
+                                 "WHERE bug_id = ? AND attachment_id = ?",
+                                 (bug_id, attachment_id)).fetchone()
+        if row is None:
+            return None
+
+        review = _row_to_review(row)
+        review['draft'] = row[-1]
+
+        return review
+
+    # Create or update the review for the attachment, setting only the
+    # properties in props (from UPDATABLE) and the modification time;
+    # returns the review, without the draft
+    def update(self, bug_id, attachment_id, props):
+        columns = []
+        values = []
+        for prop, value in props.iteritems():
+            if not prop in UPDATABLE:
+                raise DraftStoreError("Unknown property '%s'" % prop)
+            if not (isinstance(value, UPDATABLE[prop]) or
+                    (value is None and UPDATABLE[prop] is basestring)):
+                raise DraftStoreError("Bad value for property '%s'" % prop)
+            if prop == 'isDraft':
+                value = 1 if value else 0
+            columns.append(dict(PROPERTIES).get(prop, prop))
+            values.append(value)
+
+        now = long(time.time() * 1000)
+        connection = self._get_connection()
+        try:
+            connection.execute("INSERT OR IGNORE INTO reviews " +
+                               "(bug_id, attachment_id, creation_time, modification_time) " +
+                               "VALUES (?, ?, ?, ?)",
+                               (bug_id, attachment_id, now, now))
+            connection.execute("UPDATE reviews SET " +
+                               ''.join(column + ' = ?, ' for column in columns) +
+                               "modification_time = ? " +
+                               "WHERE bug_id = ? AND attachment_id = ?",
+                               values + [now, bug_id, attachment_id])
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+        review = self.get(bug_id, attachment_id)
+        del review['draft']
+
+        return review
+
+    # Returns True if there was a review to delete
+    def delete(self, bug_id, attachment_id):
+        connection = self._get_connection()
+        try:
+            cursor = connection.execute("DELETE FROM reviews WHERE bug_id = ? AND attachment_id = ?",
+                                        (bug_id, attachment_id))
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+        return cursor.rowcount > 0
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+# A stand-in for a Bugzilla server, for benchmarking splinter_proxy.py
+# without touching a real server. It serves:
+#
+#  /show_bug.cgi?id=N&ctype=xml  testbugs/N/bug.xml; with several id
+#                                parameters, the bugs of those files in
+#                                one document, like Bugzilla
+#  /attachment.cgi?id=N          testbugs/*/attachments/N, or for ids
+#                                from PATCH_BASE_ID up, the files in
+#                                testpatches/ in sorted order
+#  /xmlrpc.cgi                   User.login and Splinter.info
+#  /process_bug.cgi              accepts and discards POSTs
+#
+# Every response can be delayed by a fixed latency, and with --redirect
+# requests for attachment contents are redirected to /attachment_base/N
+# the way Bugzilla does when the attachment_base parameter is set. With
+# --session-lifetime, login cookies stop being accepted after that many
+# seconds; like Bugzilla, we then clear the cookies, and refuse POSTs to
+# process_bug.cgi with a login page.
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import bug_xml
+import cgi
+from optparse import OptionParser
+import os
+import Cookie
+import socket
+from SocketServer import ThreadingMixIn
+import sys
+import threading
+import time
+import urlparse
+import xmlrpclib
+
+PATCH_BASE_ID = 900000
+
+top_dir = os.path.dirname(os.path.dirname(os.path.realpath(os.path.abspath(__file__))))
+
+# Get the filename for each attachment ID we know about
+def find_attachments():
+    attachments = {}
+
+    testbugs_dir = os.path.join(top_dir, "testbugs")
+    for bug in os.listdir(testbugs_dir):
+        attachments_dir = os.path.join(testbugs_dir, bug, "attachments")
+        if os.path.isdir(attachments_dir):
+            for name in os.listdir(attachments_dir):
+                if name.isdigit():
+                    attachments[int(name)] = os.path.join(attachments_dir, name)
+
+    testpatches_dir = os.path.join(top_dir, "testpatches")
+    patches = sorted(os.listdir(testpatches_dir))
+    for i in xrange(len(patches)):
+        attachments[PATCH_BASE_ID + i] = os.path.join(testpatches_dir, patches[i])
+
+    return attachments
+
+def read_file(filename):
+    f = open(filename, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+class FakeBugzillaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer each response and send it with as few packets as possible,
+    # as a real web server would; BaseHTTPRequestHandler flushes the
+    # buffer after each request
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    # Check the login cookie sent with the request; returns True if it
+    # is for a current session
+    def check_session(self):
+        self.clear_cookies = False
+        cookie = Cookie.SimpleCookie()
+        try:
+            cookie.load(self.headers.getheader('cookie', ''))
+        except Cookie.CookieError:
+            return False
+        if not 'Bugzilla_logincookie' in cookie:
+            return False
+
+        if self.server.is_session_valid(cookie['Bugzilla_logincookie'].value):
+            return True
+
+        self.clear_cookies = True
+        return False
+
+    def send_content(self, status, content_type, content, extra_headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for header, value in extra_headers:
+            self.send_header(header, value)
+        if self.clear_cookies:
+            for name in ('Bugzilla_login', 'Bugzilla_logincookie'):
+                self.send_header("Set-Cookie", "%s=; path=/; expires=Tue, 15-Sep-1998 21:49:00 GMT" % name)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def send_not_found(self):
+        self.send_content(404, "text/plain", "Not Found\n")
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.check_session()
+
+        split = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(split.query)
+        if 'id' in query and query['id'][0].isdigit():
+            object_id = int(query['id'][0])
+        else:
+            object_id = None
+
+        if split.path == '/show_bug.cgi' and len(query.get('id', [])) > 1:
+            self.send_bugs(query['id'])
+        elif split.path == '/show_bug.cgi' and object_id is not None:
+            filename = os.path.join(top_dir, "testbugs", str(object_id), "bug.xml")
+            if os.path.exists(filename):
+                self.send_content(200, "text/xml", read_file(filename))
+            else:
+                self.send_not_found()
+        elif split.path == '/attachment.cgi' and object_id is not None:
+            if not object_id in self.server.attachments:
+                self.send_not_found()
+            elif self.server.redirect:
+                location = "http://%s:%d/attachment_base/%d" % (self.server.server_address[0],
+                                                                self.server.server_address[1],
+                                                                object_id)
+                self.send_content(302, "text/html", "Moved\n", [("Location", location)])
+            else:
+                self.send_attachment(object_id)
+        elif split.path.startswith('/attachment_base/') and split.path[17:].isdigit():
+            if int(split.path[17:]) in self.server.attachments:
+                self.send_attachment(int(split.path[17:]))
+            else:
+                self.send_not_found()
+        else:
+            self.send_not_found()
+
+    do_HEAD = do_GET
+
+    def send_bugs(self, bug_ids):
+        prolog = None
+        elements = []
+        for bug_id in bug_ids:
+            filename = os.path.join(top_dir, "testbugs", bug_id, "bug.xml")
+            if bug_id.isdigit() and os.path.exists(filename):
+                file_prolog, bugs = bug_xml.split_bugs(read_file(filename))
+                if prolog is None:
+                    prolog = file_prolog
+                elements += [element for _, _, element in bugs]
+            else:
+                elements.append('<bug error="%s">\n          <bug_id>%s</bug_id>\n        </bug>' %
+                                ("NotFound" if bug_id.isdigit() else "InvalidBugId", cgi.escape(bug_id)))
+        if prolog is None:
+            prolog = '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<bugzilla version="3.4">'
+
+        self.send_content(200, "text/xml", bug_xml.join_bugs(prolog, elements))
+
+    def send_attachment(self, attachment_id):
+        content = read_file(self.server.attachments[attachment_id])
+        self.send_content(200, "text/plain", content)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        logged_in = self.check_session()
+
+        content_length = int(self.headers.getheader('content-length', '0'))
+        body = self.rfile.read(content_length)
+
+        if self.path == '/xmlrpc.cgi':
+            self.do_xmlrpc(body, logged_in)
+        elif self.path == '/process_bug.cgi' or self.path == '/attachment.cgi':
+            if logged_in:
+                self.send_content(200, "text/html", "<title>Changes Submitted</title>\n")
+            else:
+                self.send_content(200, "text/html", "<title>Log in to Bugzilla</title>\n")
+        else:
+            self.send_not_found()
+
+    def do_xmlrpc(self, body, logged_in):
+        params, method = xmlrpclib.loads(body)
+        extra_headers = []
+        if method == 'User.login':
+            result = (dict(id=1),)
+            self.clear_cookies = False
+            extra_headers.append(("Set-Cookie", "Bugzilla_login=1; path=/"))
+            extra_headers.append(("Set-Cookie", "Bugzilla_logincookie=%s; path=/" % self.server.new_session()))
+        elif method == 'Splinter.info':
+            result = (dict(version=1, logged_in=logged_in,
+                           login='john.doe@example.com', name='John Doe'),)
+        else:
+            result = xmlrpclib.Fault(-32601, "Unknown method %s" % method)
+
+        self.send_content(200, "text/xml",
+                          xmlrpclib.dumps(result, methodresponse=True),
+                          extra_headers)
+
+class FakeBugzillaServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, latency=0, redirect=False, verbose=False, session_lifetime=None):
+        HTTPServer.__init__(self, server_address, FakeBugzillaHandler)
+        self.latency = latency
+        self.redirect = redirect
+        self.verbose = verbose
+        self.session_lifetime = session_lifetime
+        self.attachments = find_attachments()
+
+        self._lock = threading.Lock()
+        # login cookie => time of login
+        self._sessions = {}
+
+    def new_session(self):
+        self._lock.acquire()
+        try:
+            cookie = "session%d" % (len(self._sessions) + 1)
+            self._sessions[cookie] = time.time()
+        finally:
+            self._lock.release()
+
+        return cookie
+
+    def is_session_valid(self, cookie):
+        self._lock.acquire()
+        try:
+            login_time = self._sessions.get(cookie)
+        finally:
+            self._lock.release()
+
+        return (login_time is not None and
+                (self.session_lifetime is None or time.time() - login_time < self.session_lifetime))
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-p", "--port", type='int', default=23081,
+                      help="port to listen on")
+    parser.add_option("", "--latency", type='float', default=0,
+                      help="seconds to wait before answering each request")
+    parser.add_option("", "--redirect", action='store_true',
+                      help="redirect attachments to /attachment_base/")
+    parser.add_option("", "--session-lifetime", type='float',
+                      help="seconds after which login cookies expire")
+    parser.add_option("-v", "--verbose", action='store_true',
+                      help="log requests")
+
+    options, args = parser.parse_args()
+
+    server = FakeBugzillaServer(('127.0.0.1', options.port),
+                                options.latency, options.redirect, options.verbose,
+                                options.session_lifetime)
+    print >>sys.stderr, "Fake Bugzilla running as http://127.0.0.1:%d/" % options.port
+    server.serve_forever()
@@ -0,0 +1,243 @@
+# Counters, gauges and latency histograms for the proxy
+#
+# There is a single process-wide registry, so any module can record
+# measurements with metrics.inc(), metrics.add_gauge() and
+# metrics.observe() without having a registry passed around. Recording
+# a measurement is a dictionary update under a lock, so it's cheap
+# enough to leave on all the time. The registry can be rendered as
+# JSON-compatible data or in the Prometheus text exposition format.
+#
+# The measurements made by one thread can also be collected while a
+# trace is active in it (see start_trace()); the proxy uses this to
+# break down the time taken by a slow request into phases.
+
+import threading
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'splinter_requests_total': "Requests handled, by route",
+    'splinter_request_duration_seconds': "Time to handle a request, by route",
+    'splinter_requests_in_flight': "Requests currently being handled, by route",
+    'splinter_client_connections_total': "Connections accepted from clients",
+    'splinter_client_idle_closed_total': "Idle client connections closed to free a worker for waiting connections",
+    'splinter_upstream_connect_seconds': "Time to get a connection to Bugzilla",
+    'splinter_upstream_first_byte_seconds': "Time from sending a request to Bugzilla to receiving the response headers",
+    'splinter_upstream_transfer_seconds': "Time to relay a response body from Bugzilla",
+    'splinter_bytes_in_total': "Body bytes received, from clients and from Bugzilla",
+    'splinter_bytes_out_total': "Body bytes sent, to clients and to Bugzilla",
+    'splinter_redirects_total': "Redirects followed for clients",
+    'splinter_cache_requests_total': "Cache lookups, by cache and result",
+    'splinter_review_comments_indexed_total': "Bug comments checked for reviews by the review index",
+    'splinter_logins_total': "Attempts to log in to Bugzilla, at startup and when the session expired, by result",
+    'splinter_attachment_cache_entries': "Attachments in the attachment cache",
+    'splinter_attachment_cache_bytes': "Total size of the attachment cache",
+    'splinter_profiled_requests_total': "Requests run under the profiler, by route",
+    'splinter_slow_requests_total': "Requests slower than slow_request_threshold, by route",
+}
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i in xrange(len(BUCKETS)):
+            seen += self.counts[i]
+            if seen >= rank:
+                return BUCKETS[i]
+
+        return float('inf')
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) => value, where labels is a sorted tuple of
+        # (label, value) pairs
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def add_gauge(self, name, amount, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            self._gauges[key] = value
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+        finally:
+            self._lock.release()
+
+    def _snapshot(self):
+        self._lock.acquire()
+        try:
+            histograms = {}
+            for key, histogram in self._histograms.iteritems():
+                copy = Histogram()
+                copy.counts = list(histogram.counts)
+                copy.sum = histogram.sum
+                copy.count = histogram.count
+                histograms[key] = copy
+            return dict(self._counters), dict(self._gauges), histograms
+        finally:
+            self._lock.release()
+
+    def to_json(self):
+        counters, gauges, histograms = self._snapshot()
+
+        def add(result, name, labels, value):
+            entry = dict(labels)
+            entry.update(value)
+            result.setdefault(name, []).append(entry)
+
+        result = {}
+        for (name, labels), value in sorted(counters.iteritems()):
+            add(result, name, labels, { 'value': value })
+        for (name, labels), value in sorted(gauges.iteritems()):
+            add(result, name, labels, { 'value': value })
+        for (name, labels), histogram in sorted(histograms.iteritems()):
+            buckets = {}
+            cumulative = 0
+            for i in xrange(len(BUCKETS)):
+                cumulative += histogram.counts[i]
+                buckets[str(BUCKETS[i])] = cumulative
+            buckets['+Inf'] = histogram.count
+            add(result, name, labels, {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'p50': histogram.quantile(0.5),
+                    'p95': histogram.quantile(0.95),
+                    'p99': histogram.quantile(0.99),
+                    'buckets': buckets
+                    })
+
+        return result
+
+    def to_prometheus(self):
+        counters, gauges, histograms = self._snapshot()
+        lines = []
+
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ''
+            return '{%s}' % ','.join(['%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for label, value in labels])
+
+        seen = set()
+        def add_header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in HELP:
+                lines.append('# HELP %s %s' % (name, HELP[name]))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in sorted(counters.iteritems()):
+            add_header(name, 'counter')
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), value in sorted(gauges.iteritems()):
+            add_header(name, 'gauge')
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), histogram in sorted(histograms.iteritems()):
+            add_header(name, 'histogram')
+            cumulative = 0
+            for i in xrange(len(BUCKETS)):
+                cumulative += histogram.counts[i]
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', BUCKETS[i])]), cumulative))
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', '+Inf')]), histogram.count))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels), histogram.sum))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+# The measurements made by a thread between start_trace() and
+# finish_trace(). Only the thread itself touches a Trace, so there's no
+# locking.
+class Trace:
+    def __init__(self):
+        # (name, labels) => value, as in Registry
+        self.counters = {}
+        # (name, labels) => (count, sum)
+        self.observations = {}
+
+    def inc(self, name, amount, labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        count, total = self.observations.get(key, (0, 0.))
+        self.observations[key] = (count + 1, total + value)
+
+registry = Registry()
+
+_local = threading.local()
+
+def inc(name, amount=1, **labels):
+    registry.inc(name, amount, **labels)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.inc(name, amount, labels)
+
+def add_gauge(name, amount, **labels):
+    registry.add_gauge(name, amount, **labels)
+
+def set_gauge(name, value, **labels):
+    registry.set_gauge(name, value, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.observe(name, value, labels)
+
+# Start collecting the measurements made by the current thread into a
+# new Trace, which is returned
+def start_trace():
+    _local.trace = Trace()
+    return _local.trace
+
+# Stop collecting measurements for the current thread
+def finish_trace():
+    _local.trace = None
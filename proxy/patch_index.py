@@ -0,0 +1,174 @@
+# File-level index of a patch
+#
+# A tree-wide patch can touch hundreds of files; rather than parsing
+# and sending the whole thing, the proxy can hand out a table of
+# contents listing each file with its status and the byte offsets of the
+# file and its hunks in the attachment, and then serve files one at a
+# time. The index is built with a single scan of the raw bytes (usually
+# an mmap of the file in the attachment cache) using byte versions of
+# the regular expressions in patch_parser.py, without decoding or
+# splitting the text into lines.
+#
+# The slice of bytes between the offsets of a file is a patch on its
+# own, and parsing it with patch_parser gives the same result as for
+# that file when parsing the whole patch.
+
+import json
+import re
+
+import patch_parser
+
+# As in patch_parser, '\r\n', '\r' and '\n' all end a line
+_L = '[^\r\n]'
+_NL = '(?:\r\n?|\n)'
+# Beginning of a line; re.MULTILINE only knows about '\n'
+_BOL = '(?:(?<=[\r\n])|\\A)'
+
+_FILE_START_RE = re.compile(_BOL + '(?:(?:Index|index|===|RCS|diff)' + _L + '*' + _NL + ')*---[ \t]*(\\S+)' + _L + '*' + _NL + '\\+\\+\\+[ \t]*(\\S+)' + _L + '*' + _NL + '(?=@@)')
+
+_HUNK_RE = re.compile('@@[ \t]+-([0-9]+),([0-9]+)[ \t]+\\+([0-9]+),([0-9]+)[ \t]+@@' + _L + '*' + _NL + '((?:[ +\\\\-]' + _L + '*' + _NL + ')*)')
+
+_BODY_LINE_RE = re.compile('[ +\\\\-]' + _L + '*')
+
+class _HunkCounter:
+    def __init__(self):
+        self.lines = 0
+        self.added = 0
+        self.removed = 0
+        self.context = 0
+        self.segment_old = 0
+        self.segment_new = 0
+
+    def end_segment(self):
+        self.lines += max(self.segment_old, self.segment_new)
+        self.segment_old = 0
+        self.segment_new = 0
+
+# Count the lines of a hunk the way patch_parser.Hunk would: returns
+# (lines, added, removed), where lines is the number of rows the hunk
+# displays as, an added and removed line sharing a row when they are
+# part of the same segment
+def _count_hunk(data, start, end, old_count):
+    counter = _HunkCounter()
+    last_op = None
+    last_line = None
+    for m in _BODY_LINE_RE.finditer(data, start, end):
+        line = m.group(0)
+        op = line[0]
+        if op == ' ':
+            counter.end_segment()
+            counter.context += 1
+            counter.lines += 1
+        elif op == '-':
+            counter.removed += 1
+            counter.segment_old += 1
+        elif op == '+':
+            counter.added += 1
+            counter.segment_new += 1
+        else:
+            continue
+        last_op = op
+        last_line = line
+
+    # A git mail-formatted patch ends with a '-- ' signature line that
+    # looks like part of the last hunk; see patch_parser.Hunk
+    if (counter.context + counter.removed > old_count and
+        last_op == '-' and last_line.startswith('--')):
+        counter.removed -= 1
+        counter.segment_old -= 1
+
+    counter.end_segment()
+
+    return counter.lines, counter.added, counter.removed
+
+def _decode(s):
+    return s.decode('utf-8', 'replace')
+
+# Build the index of the patch in data, a string or mmap. Returns a
+# dictionary that converts directly to JSON:
+#
+#  { 'size': <size of data>,
+#    'intro': <text before the first file>,
+#    'files': [{ 'filename', 'status', 'start', 'end',
+#                'hunks': [{ 'start', 'end', 'oldStart', 'oldCount',
+#                            'newStart', 'newCount',
+#                            'lines', 'added', 'removed' }] }] }
+#
+# Offsets are byte offsets into data, with end exclusive. Raises
+# patch_parser.PatchError if data isn't a patch.
+def build_index(data):
+    m = _FILE_START_RE.search(data)
+    if m is None:
+        raise patch_parser.PatchError("Not a patch")
+
+    intro = re.sub(u'\r\n|\r', u'\n', _decode(data[:m.start()]))
+
+    files = []
+    while m is not None:
+        filename, status = patch_parser.get_filename_and_status(m.group(1), m.group(2))
+        start = m.start()
+
+        hunks = []
+        pos = m.end()
+        while True:
+            m2 = _HUNK_RE.match(data, pos)
+            if m2 is None:
+                break
+
+            pos = m2.end()
+            old_count = int(m2.group(2))
+            lines, added, removed = _count_hunk(data, m2.start(5), m2.end(5), old_count)
+            hunks.append({
+                    'start': m2.start(),
+                    'end': m2.end(),
+                    'oldStart': int(m2.group(1)),
+                    'oldCount': old_count,
+                    'newStart': int(m2.group(3)),
+                    'newCount': int(m2.group(4)),
+                    'lines': lines,
+                    'added': added,
+                    'removed': removed
+                    })
+
+        if status is None:
+            status = patch_parser.guess_status([(h['oldCount'], h['newCount']) for h in hunks])
+
+        m = _FILE_START_RE.search(data, pos)
+        files.append({
+                'filename': _decode(filename),
+                'status': status,
+                'start': start,
+                'end': m.start() if m is not None else len(data),
+                'hunks': hunks
+                })
+
+    return {
+        'size': len(data),
+        'intro': patch_parser._clean_intro(intro),
+        'files': files
+    }
+
+# Parse one file from an index built by build_index() out of data;
+# returns the compact form of the file, as found in the 'files' of
+# patch_parser.to_columns()
+def parse_file(data, file_entry):
+    text = _decode(data[file_entry['start']:file_entry['end']])
+    return patch_parser.to_columns(patch_parser.Patch(text))['files'][0]
+
+def to_json(obj):
+    return json.dumps(obj, separators=(',', ':'), sort_keys=True)
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        print >>sys.stderr, "Usage: patch_index.py <patch file>"
+        sys.exit(1)
+
+    f = open(sys.argv[1], 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    print to_json(build_index(data))
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+# Parsing of patches, following the rules of js/patch.js exactly, so
+# that the proxy can parse a patch once and hand the browser the result
+# instead of the text. See js/patch.js for how a patch is represented;
+# the lines of a hunk are stored as [old_text, new_text, flags].
+#
+# to_columns() converts a parsed patch into the compact form that
+# Patch.fromColumns() in js/patch.js reads: the lines of each hunk are
+# stored as three parallel arrays 'oldText', 'newText' and 'flags'
+# rather than an array per line.
+#
+# Run as a script to print that form for patch files, which is how the
+# fixtures checked by tests/parsedPatch.jst are generated.
+
+import json
+import re
+import sys
+
+ADDED         = 1 << 0 # Part of a pure addition segment
+REMOVED       = 1 << 1 # Part of a pure removal segment
+CHANGED       = 1 << 2 # Part of some other segmnet
+NEW_NONEWLINE = 1 << 3 # Old line doesn't end with \n
+OLD_NONEWLINE = 1 << 4 # New line doesn't end with \n
+
+# The regular expressions below are translations of the ones in
+# js/patch.js; in JavaScript '.' doesn't match line or paragraph
+# separators either
+ANY = u'[^\n\u2028\u2029]'
+
+class PatchError(Exception):
+    pass
+
+# Like Utils.strip()
+def _strip(s):
+    return re.match(u'^\\s*(.*?)\\s*$', s, re.UNICODE | re.DOTALL).group(1)
+
+class Hunk:
+    def __init__(self, old_start, old_count, new_start, new_count, function_line, text):
+        raw_lines = text.split(u'\n')
+        if len(raw_lines) > 0 and _strip(raw_lines[-1]) == u'':
+            raw_lines.pop() # Remove trailing element from final \n
+
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.function_line = _strip(function_line)
+
+        lines = []
+        total_old = 0
+        total_new = 0
+
+        # A segment is a series of lines added/removed/changed with no
+        # intervening unchanged lines. We make the classification of
+        # ADDED/REMOVED/CHANGED in the flags for the entire segment
+        segment = { 'start': -1, 'old_count': 0, 'new_count': 0 }
+
+        def start_segment():
+            if segment['start'] < 0:
+                segment['start'] = len(lines)
+
+        def end_segment():
+            if segment['start'] >= 0:
+                if segment['old_count'] > 0 and segment['new_count'] > 0:
+                    for j in xrange(segment['start'], len(lines)):
+                        lines[j][2] &= ~(ADDED | REMOVED)
+                        lines[j][2] |= CHANGED
+
+                segment['start'] = -1
+                segment['old_count'] = 0
+                segment['new_count'] = 0
+
+        for i in xrange(len(raw_lines)):
+            line = raw_lines[i]
+            op = line[0:1]
+            stripped_line = line[1:]
+            no_newline = 0
+            if i + 1 < len(raw_lines) and raw_lines[i + 1][0:1] == u'\\':
+                if op == u'-':
+                    no_newline = OLD_NONEWLINE
+                else:
+                    no_newline = NEW_NONEWLINE
+
+            if op == u' ':
+                end_segment()
+                total_old += 1
+                total_new += 1
+                lines.append([stripped_line, stripped_line, 0])
+            elif op == u'-':
+                total_old += 1
+                start_segment()
+                lines.append([stripped_line, None, REMOVED | no_newline])
+                segment['old_count'] += 1
+            elif op == u'+':
+                total_new += 1
+                start_segment()
+                index = segment['start'] + segment['new_count']
+                if index >= len(lines):
+                    lines.append([None, stripped_line, ADDED | no_newline])
+                else:
+                    lines[index][1] = stripped_line
+                    lines[index][2] |= ADDED | no_newline
+                segment['new_count'] += 1
+            # Anything else is either '\' (handled with the preceding
+            # line) or junk that we ignore as the JavaScript does
+
+        # git mail-formatted patches end with --\n<git version> like a
+        # signature; see the comment in js/patch.js
+        if (total_old > old_count and
+            lines[-1][1] is None and
+            lines[-1][0][0:1] == u'-'):
+            lines.pop()
+            segment['old_count'] -= 1
+            if segment['old_count'] == 0 and segment['new_count'] == 0:
+                segment['start'] = -1
+
+        end_segment()
+
+        self.lines = lines
+
+class File:
+    def __init__(self, filename, status, hunks):
+        self.filename = filename
+        self.status = status
+        self.hunks = hunks
+
+        l = 0
+        for hunk in hunks:
+            hunk.location = l
+            l += len(hunk.lines)
+
+_FROM_RE = re.compile(u'^From\\s+[a-f0-9]{40}' + ANY + u'*\n', re.UNICODE)
+_DIFFSTAT_RE = re.compile(u'^---\n(?:^\\s' + ANY + u'*\n)+\\s+[0-9]+\\s+files changed' + ANY + u'*\n?(?!' + ANY + u')',
+                          re.UNICODE | re.MULTILINE)
+
+def _clean_intro(intro):
+    intro = _strip(intro)
+
+    # Git: remove leading 'From <commit_id> <date'
+    m = _FROM_RE.search(intro)
+    if m:
+        intro = intro[m.end():]
+
+    # Git: remove 'diff --stat' output from the end
+    m = _DIFFSTAT_RE.search(intro)
+    if m:
+        intro = intro[:m.start()]
+
+    return intro
+
+# Matches the start unified diffs for a file as produced by different version control tools
+FILE_START_RE = re.compile(u'^(?:(?:Index|index|===|RCS|diff)' + ANY + u'*\n)*---[ \t]*(\\S+)' + ANY + u'*\n\\+\\+\\+[ \t]*(\\S+)' + ANY + u'*\n(?=@@)',
+                           re.UNICODE | re.MULTILINE)
+
+# Hunk start: @@ -23,12 +30,11 @@
+# Followed by: lines beginning with [ +\-]
+HUNK_RE = re.compile(u'^@@[ \t]+-([0-9]+),([0-9]+)[ \t]+\\+([0-9]+),([0-9]+)[ \t]+@@(' + ANY + u'*)\n((?:[ +\\\\-]' + ANY + u'*\n)*)',
+                     re.UNICODE | re.MULTILINE)
+
+# Get the filename and status of a file from the two filenames in the
+# diff header; the status is None if it can't be told from the names.
+# git and hg show a diff between a/foo/bar.c and b/foo/bar.c or between
+# a/foo/bar.c and /dev/null for removals and the reverse for additions.
+def get_filename_and_status(old_name, new_name):
+    if old_name.startswith('a/') and new_name.startswith('b/'):
+        return old_name[2:], CHANGED
+    elif old_name.startswith('a/') and new_name.startswith('/dev/null'):
+        return old_name[2:], REMOVED
+    elif old_name.startswith('/dev/null') and new_name.startswith('b/'):
+        return new_name[2:], ADDED
+    else:
+        return old_name, None
+
+# Guess the status of a file from the (old_count, new_count) of its hunks.
+# For non-Hg/Git we use assume patch was generated non-zero context
+# and just look at the patch to detect added/removed. Bzr actually
+# says added/removed in the diff, but SVN/CVS don't
+def guess_status(hunk_counts):
+    if len(hunk_counts) == 1 and hunk_counts[0][0] == 0:
+        return ADDED
+    elif len(hunk_counts) == 1 and hunk_counts[0][1] == 0:
+        return REMOVED
+    else:
+        return CHANGED
+
+class Patch:
+    # text is a unicode string; raises PatchError if it isn't a patch
+    def __init__(self, text):
+        # Canonicalize newlines to simplify the following
+        if u'\r' in text:
+            text = re.sub(u'\r\n|\r|\n', u'\n', text)
+
+        self.files = []
+
+        m = FILE_START_RE.search(text)
+        if m is None:
+            raise PatchError("Not a patch")
+        self.intro = _clean_intro(text[:m.start()])
+
+        while m is not None:
+            filename, status = get_filename_and_status(m.group(1), m.group(2))
+
+            hunks = []
+            pos = m.end()
+            while True:
+                m2 = HUNK_RE.match(text, pos)
+                if m2 is None:
+                    break
+
+                pos = m2.end()
+                hunks.append(Hunk(int(m2.group(1)), int(m2.group(2)),
+                                  int(m2.group(3)), int(m2.group(4)),
+                                  m2.group(5), m2.group(6)))
+
+            if status is None:
+                status = guess_status([(hunk.old_count, hunk.new_count) for hunk in hunks])
+
+            self.files.append(File(filename, status, hunks))
+
+            m = FILE_START_RE.search(text, pos)
+
+def to_columns(patch):
+    files = []
+    for f in patch.files:
+        hunks = []
+        for hunk in f.hunks:
+            hunks.append({
+                    'oldStart': hunk.old_start,
+                    'oldCount': hunk.old_count,
+                    'newStart': hunk.new_start,
+                    'newCount': hunk.new_count,
+                    'functionLine': hunk.function_line,
+                    'oldText': [line[0] for line in hunk.lines],
+                    'newText': [line[1] for line in hunk.lines],
+                    'flags': [line[2] for line in hunk.lines]
+                    })
+        files.append({
+                'filename': f.filename,
+                'status': f.status,
+                'hunks': hunks
+                })
+
+    return {
+        'intro': patch.intro,
+        'files': files
+    }
+
+# Parse the bytes of a patch into the compact JSON form
+def parse_to_json(data):
+    patch = Patch(data.decode('utf-8', 'replace'))
+    return json.dumps(to_columns(patch), separators=(',', ':'), sort_keys=True)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print >>sys.stderr, "Usage: patch_parser.py <patch file>"
+        sys.exit(1)
+
+    f = open(sys.argv[1], 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    print parse_to_json(data)
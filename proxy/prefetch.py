@@ -0,0 +1,137 @@
+# Background prefetching of patch attachments
+#
+# The first thing Splinter does after loading a bug is to load the patch
+# being reviewed, so when we proxy the XML for a bug, we can start
+# fetching its patches into the attachment cache right away. Fetches are
+# done by a fixed number of worker threads, and only the first
+# max_per_bug patches of a bug are fetched, newest non-obsolete first.
+#
+# The workers are started by the first prefetch in each process, so that
+# with the forking server engine, the process handling a connection has
+# workers of its own; they only live as long as that process does.
+
+import os
+import Queue
+import sys
+import threading
+from xml.parsers.expat import ExpatError
+import xml.etree.cElementTree as ElementTree
+
+# Find the IDs of the patches attached to the bugs in the XML from
+# show_bug.cgi?ctype=xml, in the order they should be prefetched
+def find_patch_attachments(bug_xml):
+    try:
+        root = ElementTree.fromstring(bug_xml)
+    except (ExpatError, SyntaxError):
+        return []
+
+    current = []
+    obsolete = []
+    for attachment in root.getiterator('attachment'):
+        if attachment.get('ispatch') != '1':
+            continue
+        attachid = attachment.findtext('attachid')
+        if attachid is None or not attachid.strip().isdigit():
+            continue
+        if attachment.get('isobsolete') == '1':
+            obsolete.append(int(attachid))
+        else:
+            current.append(int(attachid))
+
+    current.sort(reverse=True)
+    obsolete.sort(reverse=True)
+
+    return current + obsolete
+
+class Prefetcher:
+    # fetch(attachment_id) fetches an attachment into the cache,
+    # is_cached(attachment_id) checks whether that's already been done
+    def __init__(self, fetch, is_cached, max_concurrent=2, max_per_bug=5, max_queued=100):
+        self.fetch = fetch
+        self.is_cached = is_cached
+        self.max_per_bug = max_per_bug
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+
+        self._start_lock = threading.Lock()
+        # The process the workers were started in
+        self._pid = None
+
+    # Set up the queue and start the workers if that hasn't been done in
+    # this process; a forked process doesn't get the threads of its parent,
+    # and prefetches pending in the parent never finish for it
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+
+        self._start_lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+
+            self._lock = threading.Lock()
+            self._queue = Queue.Queue(self.max_queued)
+            # attachment ID => threading.Event set when the fetch finishes
+            self._pending = {}
+
+            for i in xrange(self.max_concurrent):
+                worker = threading.Thread(target=self._run)
+                worker.setDaemon(True)
+                worker.start()
+
+            # Last, since wait() doesn't take _start_lock
+            self._pid = os.getpid()
+        finally:
+            self._start_lock.release()
+
+    def schedule_bug(self, bug_xml):
+        for attachment_id in find_patch_attachments(bug_xml)[0:self.max_per_bug]:
+            self.schedule(attachment_id)
+
+    def schedule(self, attachment_id):
+        if self.is_cached(attachment_id):
+            return
+
+        self._start()
+        self._lock.acquire()
+        try:
+            if attachment_id in self._pending:
+                return
+            self._pending[attachment_id] = threading.Event()
+            try:
+                self._queue.put_nowait(attachment_id)
+            except Queue.Full:
+                del self._pending[attachment_id]
+        finally:
+            self._lock.release()
+
+    # If the attachment is being prefetched, wait up to timeout seconds
+    # for the prefetch to finish, rather than fetching it a second time
+    def wait(self, attachment_id, timeout):
+        if self._pid != os.getpid():
+            return
+
+        self._lock.acquire()
+        try:
+            event = self._pending.get(attachment_id)
+        finally:
+            self._lock.release()
+
+        if event is not None:
+            event.wait(timeout)
+
+    def _run(self):
+        while True:
+            attachment_id = self._queue.get()
+            try:
+                try:
+                    self.fetch(attachment_id)
+                except Exception, e:
+                    print >>sys.stderr, "Failed to prefetch attachment %d: %s" % (attachment_id, e)
+            finally:
+                self._lock.acquire()
+                try:
+                    event = self._pending.pop(attachment_id)
+                finally:
+                    self._lock.release()
+                event.set()
@@ -0,0 +1,162 @@
+# Opt-in profiling of requests, and a log of slow requests
+#
+# Both are off unless enabled in the configuration. When profile_dir is
+# set, a request is run under cProfile if it has an 'X-Splinter-Profile:
+# 1' header or 'splinter_profile=1' in its query string (which is
+# removed before the request is handled), and otherwise with probability
+# profile_sample_rate. The statistics for each profiled request are
+# written to profile_dir in a file named after the time, the route and
+# how long the request took, for loading with the pstats module:
+#
+#   20261018-141503-show_bug.cgi-1834ms-4242-7.pstats
+#
+# cProfile only sees the thread it was enabled in, so with the 'threads'
+# engine concurrent requests don't show up in each other's profiles.
+#
+# When slow_request_threshold is set, requests taking longer than that
+# many seconds are logged to slow_request_log (or to stderr), along with
+# the measurements recorded with metrics while handling the request -
+# the time spent getting a connection to Bugzilla, waiting for its
+# response and relaying the body, cache lookups, and so on.
+
+import cProfile
+import itertools
+import os
+import random
+import re
+import sys
+import time
+
+import metrics
+
+HEADER = 'X-Splinter-Profile'
+
+_FLAG_RE = re.compile(r"([?&])splinter_profile=1(&|$)")
+
+_ROUTE_CHARS_RE = re.compile(r"[^\w.-]+")
+
+# Handles distinct file names for requests profiled in the same second
+_counter = itertools.count(1)
+
+class _Request:
+    def __init__(self, profile, trace):
+        self.start = time.time()
+        self.profile = profile
+        self.trace = trace
+
+class RequestProfiler:
+    def __init__(self, profile_dir=None, sample_rate=0,
+                 slow_threshold=None, slow_log=None):
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.slow_log = slow_log
+
+        if self.profile_dir is not None and not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+    # Check whether a request should be profiled; returns (path,
+    # profile), where path is the path with the query flag asking for
+    # profiling removed
+    def check(self, path, headers):
+        if self.profile_dir is None:
+            return path, False
+
+        profile = False
+        m = _FLAG_RE.search(path)
+        if m is not None:
+            profile = True
+            if m.group(2) == '&':
+                path = path[0:m.start()] + m.group(1) + path[m.end():]
+            else:
+                path = path[0:m.start()] + path[m.end():]
+
+        if headers.getheader(HEADER, '').strip() == '1':
+            profile = True
+        elif self.sample_rate > 0 and random.random() < self.sample_rate:
+            profile = True
+
+        return path, profile
+
+    # Start measuring the handling of a request in the current thread;
+    # returns an object to pass to finish()
+    def start(self, profile):
+        trace = None
+        if self.slow_threshold is not None:
+            trace = metrics.start_trace()
+
+        request = _Request(cProfile.Profile() if profile else None, trace)
+        if request.profile is not None:
+            request.profile.enable()
+
+        return request
+
+    # Finish measuring a request started with start(); description is
+    # logged for a slow request, along with the response code
+    def finish(self, request, route, description, response_code):
+        if request.profile is not None:
+            request.profile.disable()
+        if request.trace is not None:
+            metrics.finish_trace()
+        elapsed = time.time() - request.start
+
+        profile_file = None
+        if request.profile is not None:
+            metrics.inc('splinter_profiled_requests_total', route=route)
+            try:
+                profile_file = self._dump_profile(request.profile, route, elapsed)
+            except (IOError, OSError), e:
+                print >>sys.stderr, "Cannot write profile: %s" % e
+
+        if request.trace is not None and elapsed > self.slow_threshold:
+            metrics.inc('splinter_slow_requests_total', route=route)
+            self._log_slow(request.trace, description, response_code, elapsed, profile_file)
+
+    def _dump_profile(self, profile, route, elapsed):
+        name = "%s-%s-%dms-%d-%d.pstats" % (time.strftime("%Y%m%d-%H%M%S"),
+                                            _ROUTE_CHARS_RE.sub('_', route).strip('_'),
+                                            int(elapsed * 1000),
+                                            os.getpid(), _counter.next())
+        filename = os.path.join(self.profile_dir, name)
+        profile.dump_stats(filename)
+
+        return filename
+
+    def _log_slow(self, trace, description, response_code, elapsed, profile_file):
+        def format_name(name, labels):
+            if name.startswith('splinter_'):
+                name = name[len('splinter_'):]
+            if len(labels) > 0:
+                name += '{%s}' % ','.join(['%s=%s' % label for label in labels])
+            return name
+
+        parts = ["%s - %s %s %.3fs" % (time.strftime("%Y-%m-%d %H:%M:%S"),
+                                       description, response_code, elapsed)]
+        for (name, labels), (count, total) in sorted(trace.observations.iteritems()):
+            if name.endswith('_seconds'):
+                name = name[0:-len('_seconds')]
+            part = "%s=%.3fs" % (format_name(name, labels), total)
+            if count > 1:
+                part += "/%d" % count
+            parts.append(part)
+        for (name, labels), value in sorted(trace.counters.iteritems()):
+            if name.endswith('_total'):
+                name = name[0:-len('_total')]
+            parts.append("%s=%s" % (format_name(name, labels), value))
+        if profile_file is not None:
+            parts.append("profile=%s" % profile_file)
+
+        line = " ".join(parts) + "\n"
+        if self.slow_log is None:
+            sys.stderr.write(line)
+        else:
+            # Opened each time, so that the forking engine's processes
+            # all append to the same file
+            try:
+                f = open(self.slow_log, "a")
+                try:
+                    f.write(line)
+                finally:
+                    f.close()
+            except IOError, e:
+                print >>sys.stderr, "Cannot write to slow request log: %s" % e
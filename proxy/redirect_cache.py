@@ -0,0 +1,75 @@
+# Memory of where Bugzilla redirects attachment requests
+#
+# When the attachment_base parameter is set, Bugzilla answers every
+# request for the contents of an attachment with a redirect to a
+# separate host. Following that redirect costs a second round trip for
+# each patch we show, so we remember the final location for each
+# attachment for a while and go there directly. A remembered location
+# is forgotten when it expires, or as soon as going there directly
+# doesn't produce the attachment.
+
+import metrics
+import threading
+import time
+
+class RedirectCache:
+    def __init__(self, ttl=300, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        # key => (location, time stored)
+        self._entries = {}
+
+    # Returns the remembered location for key, or None
+    def lookup(self, key):
+        if self.ttl <= 0:
+            return None
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] >= self.ttl:
+                del self._entries[key]
+                entry = None
+        finally:
+            self._lock.release()
+
+        if entry is None:
+            metrics.inc('splinter_cache_requests_total', cache='redirect', result='miss')
+            return None
+
+        metrics.inc('splinter_cache_requests_total', cache='redirect', result='hit')
+        return entry[0]
+
+    def store(self, key, location):
+        if self.ttl <= 0:
+            return
+
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if not key in self._entries and len(self._entries) >= self.max_entries:
+                for k, entry in self._entries.items():
+                    if now - entry[1] >= self.ttl:
+                        del self._entries[k]
+                if len(self._entries) >= self.max_entries:
+                    oldest = min(self._entries.keys(), key=lambda k: self._entries[k][1])
+                    del self._entries[oldest]
+
+            self._entries[key] = (location, now)
+        finally:
+            self._lock.release()
+
+    # Forget the location for key; if location is given, only if that's
+    # still the remembered location, so that a request that failed with
+    # an old location doesn't remove a newer one
+    def invalidate(self, key, location=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and (location is None or entry[0] == location):
+                del self._entries[key]
+                metrics.inc('splinter_cache_requests_total', cache='redirect', result='invalidated')
+        finally:
+            self._lock.release()
@@ -0,0 +1,87 @@
+# Reading request bodies from clients
+#
+# Bodies are read a block at a time as they are sent on to Bugzilla,
+# rather than read into memory first. LimitedReader reads a body with a
+# Content-Length, ChunkedReader decodes a body sent with
+# Transfer-Encoding: chunked. Neither reads beyond the end of the body,
+# so the connection can be used for another request afterwards, and
+# both refuse to read more than a maximum size.
+
+import metrics
+
+class RequestBodyError(Exception):
+    # code is the HTTP status to answer the client with
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+class LimitedReader:
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, amt):
+        amt = min(amt, self.remaining)
+        if amt == 0:
+            return ''
+
+        data = self.rfile.read(amt)
+        metrics.inc('splinter_bytes_in_total', len(data), peer='client')
+        if len(data) < amt:
+            raise RequestBodyError(400, "Incomplete request body")
+        self.remaining -= len(data)
+
+        return data
+
+class ChunkedReader:
+    def __init__(self, rfile, max_size):
+        self.rfile = rfile
+        self.max_size = max_size
+        self.size = 0
+        self._chunk_remaining = 0
+        self._done = False
+
+    def _readline(self):
+        line = self.rfile.readline(1024)
+        if not line.endswith('\n'):
+            raise RequestBodyError(400, "Bad chunked request body")
+        return line
+
+    # Read the size line of the next chunk; at the last chunk, skip the
+    # trailer
+    def _start_chunk(self):
+        try:
+            size = int(self._readline().split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise RequestBodyError(400, "Bad chunked request body")
+
+        if size == 0:
+            while not self._readline() in ('\r\n', '\n'):
+                pass
+            self._done = True
+            return
+
+        self.size += size
+        if self.size > self.max_size:
+            raise RequestBodyError(413, "Request body too large")
+        self._chunk_remaining = size
+
+    def read(self, amt):
+        if self._done:
+            return ''
+        if self._chunk_remaining == 0:
+            self._start_chunk()
+            if self._done:
+                return ''
+
+        amt = min(amt, self._chunk_remaining)
+        data = self.rfile.read(amt)
+        metrics.inc('splinter_bytes_in_total', len(data), peer='client')
+        if len(data) < amt:
+            raise RequestBodyError(400, "Incomplete request body")
+        self._chunk_remaining -= len(data)
+        if self._chunk_remaining == 0:
+            self._readline()
+
+        return data
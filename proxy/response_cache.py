@@ -0,0 +1,205 @@
+# Sharing of upstream responses between requests
+#
+# When several clients ask for the same URL at once, only the first
+# request goes to Bugzilla; the others wait for its response and get
+# a copy of it. Responses can also be kept for a short time so that
+# requests arriving shortly afterwards are answered without contacting
+# Bugzilla at all. Once an entry expires, it is revalidated with a
+# conditional request if the response had an ETag or Last-Modified.
+
+from cStringIO import StringIO
+import metrics
+import sys
+import threading
+import time
+
+# A completely read response; provides the subset of the interface of
+# httplib.HTTPResponse that ProxyHandler uses when relaying a response
+class BufferedResponse:
+    chunked = False
+    will_close = False
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        # List of (lowercase header name, value)
+        self.headers = headers
+        self.body = body
+        self._file = StringIO(body)
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for header, value in self.headers:
+            if header == name:
+                return value
+
+        return default
+
+    def getheaders(self):
+        return list(self.headers)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._file.read()
+        else:
+            return self._file.read(amt)
+
+    def isclosed(self):
+        return self._file.tell() == len(self.body)
+
+    # Get a new response with the same content, read from the start
+    def copy(self):
+        return BufferedResponse(self.status, self.reason, self.headers, self.body)
+
+# Read all of an httplib.HTTPResponse into a BufferedResponse
+def read_response(response):
+    start = time.time()
+    body = response.read()
+    metrics.observe('splinter_upstream_transfer_seconds', time.time() - start)
+    metrics.inc('splinter_bytes_in_total', len(body), peer='upstream')
+    headers = [(header.lower(), value) for header, value in response.getheaders()
+               if not header.lower() in ('transfer-encoding', 'content-length')]
+    headers.append(('content-length', str(len(body))))
+
+    return BufferedResponse(response.status, response.reason, headers, body)
+
+class _CacheEntry:
+    def __init__(self, response):
+        self.response = response
+        self.fetched = time.time()
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class ResponseCache:
+    # name identifies the cache in statistics
+    def __init__(self, name, ttl=0, max_entries=100):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        # key => _CacheEntry
+        self._entries = {}
+        # key => _Call for fetches in progress
+        self._calls = {}
+
+    # Get the response for key. fetch is called with a list of extra
+    # (header, value) pairs to send, and must return a BufferedResponse;
+    # it is only called by one thread at a time for a given key. If
+    # use_cache is False, responses are shared between concurrent
+    # requests but not kept afterwards.
+    def get(self, key, fetch, use_cache=True):
+        self._lock.acquire()
+        try:
+            entry = None
+            if use_cache and self.ttl > 0:
+                entry = self._entries.get(key)
+                if entry is not None and time.time() - entry.fetched < self.ttl:
+                    metrics.inc('splinter_cache_requests_total', cache=self.name, result='hit')
+                    return entry.response.copy()
+
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        finally:
+            self._lock.release()
+
+        if not leader:
+            metrics.inc('splinter_cache_requests_total', cache=self.name, result='coalesced')
+            call.event.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result.copy()
+
+        try:
+            try:
+                call.result = self._fetch(fetch, entry)
+            except:
+                call.exc_info = sys.exc_info()
+                raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+                if (use_cache and self.ttl > 0 and
+                    call.result is not None and call.result.status == 200):
+                    self._store(key, call.result)
+            finally:
+                self._lock.release()
+            call.event.set()
+
+        return call.result.copy()
+
+    # Get the response for key if it's in the cache and hasn't expired,
+    # without fetching it; returns None otherwise
+    def lookup(self, key):
+        if self.ttl <= 0:
+            return None
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry.fetched < self.ttl:
+                metrics.inc('splinter_cache_requests_total', cache=self.name, result='hit')
+                return entry.response.copy()
+        finally:
+            self._lock.release()
+
+        metrics.inc('splinter_cache_requests_total', cache=self.name, result='miss')
+        return None
+
+    # Keep response as the response for key, as if get() had fetched it;
+    # for responses fetched some other way
+    def store(self, key, response):
+        if self.ttl <= 0 or response.status != 200:
+            return
+
+        self._lock.acquire()
+        try:
+            self._store(key, response)
+        finally:
+            self._lock.release()
+
+    def _fetch(self, fetch, stale_entry):
+        extra_headers = []
+        if stale_entry is not None:
+            etag = stale_entry.response.getheader('etag')
+            last_modified = stale_entry.response.getheader('last-modified')
+            if etag is not None:
+                extra_headers.append(('If-None-Match', etag))
+            if last_modified is not None:
+                extra_headers.append(('If-Modified-Since', last_modified))
+
+        response = fetch(extra_headers)
+        if len(extra_headers) > 0 and response.status == 304:
+            metrics.inc('splinter_cache_requests_total', cache=self.name, result='revalidated')
+            return stale_entry.response
+
+        metrics.inc('splinter_cache_requests_total', cache=self.name, result='miss')
+        return response
+
+    # Called with the lock held
+    def _store(self, key, response):
+        now = time.time()
+        for k, entry in self._entries.items():
+            if now - entry.fetched >= self.ttl:
+                del self._entries[k]
+
+        if not key in self._entries and len(self._entries) >= self.max_entries:
+            oldest = min(self._entries.keys(), key=lambda k: self._entries[k].fetched)
+            del self._entries[oldest]
+
+        self._entries[key] = _CacheEntry(response)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries = {}
+        finally:
+            self._lock.release()
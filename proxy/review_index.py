@@ -0,0 +1,163 @@
+# Index of the reviews on bugs
+#
+# Finding the existing reviews of a patch means looking through every
+# comment of the bug for ones starting "Review of attachment N:" and
+# parsing them. We keep, for each bug we've seen the XML of, an index of
+# the review comments by attachment, file and line. Comments are only
+# ever added to a bug, so when the XML of a bug is fetched again, only
+# the comments after the last indexed one need to be parsed.
+
+import json
+import sys
+import threading
+import time
+from xml.parsers.expat import ExpatError
+import xml.etree.cElementTree as ElementTree
+
+import metrics
+import review_parser
+
+# Get the key for a comment in the index of a file: the line numbers in
+# the old and new versions of the file, either of which can be missing,
+# as '<old>:<new>'
+def line_key(old_line, new_line):
+    return '%s:%s' % ('' if old_line is None else old_line,
+                      '' if new_line is None else new_line)
+
+class _BugReviews:
+    def __init__(self):
+        # Number of comments indexed so far, and a key identifying the
+        # last of them, to check that the comments of the bug haven't
+        # changed other than by being added to
+        self.comment_count = 0
+        self.last_comment_key = None
+        # attachment ID => { 'reviews': [review, ...],
+        #                    'files': { filename: { line_key: [comment, ...] } } }
+        # where a review is a dictionary with the comment number, the
+        # reviewer and date, and the intro, and a comment in a file is
+        # a dictionary with the index of its review in 'reviews', type,
+        # and text
+        self.attachments = {}
+        self.updated = time.time()
+
+    def add_comment(self, comment_number, who, who_name, date, text):
+        try:
+            parsed = review_parser.parse_comment(text)
+        except review_parser.ReviewError, e:
+            print >>sys.stderr, "Can't parse review in comment %d: %s" % (comment_number, e)
+            return
+        if parsed is None:
+            return
+
+        attachment_id, review = parsed
+        attachment = self.attachments.setdefault(attachment_id, { 'reviews': [], 'files': {} })
+        review_index = len(attachment['reviews'])
+        attachment['reviews'].append({
+                'comment': comment_number,
+                'who': who,
+                'whoName': who_name,
+                'date': date,
+                'intro': review.intro
+                })
+        for comment in review.comments:
+            lines = attachment['files'].setdefault(comment.filename, {})
+            lines.setdefault(line_key(comment.old_line, comment.new_line), []).append({
+                    'review': review_index,
+                    'type': comment.type,
+                    'comment': comment.comment
+                    })
+
+def _get_comment_key(long_desc):
+    commentid = long_desc.findtext('commentid')
+    if commentid is not None:
+        return commentid.strip()
+
+    return '%s %s' % ((long_desc.findtext('who') or '').strip(),
+                      (long_desc.findtext('bug_when') or '').strip())
+
+class ReviewIndex:
+    def __init__(self, max_bugs=100):
+        self.max_bugs = max_bugs
+
+        self._lock = threading.Lock()
+        # bug ID => _BugReviews
+        self._bugs = {}
+
+    # Update the index from the XML of show_bug.cgi?ctype=xml
+    def update(self, bug_xml):
+        try:
+            root = ElementTree.fromstring(bug_xml)
+        except (ExpatError, SyntaxError):
+            return
+
+        for bug in root.getiterator('bug'):
+            bug_id = bug.findtext('bug_id')
+            if bug_id is None or not bug_id.strip().isdigit():
+                continue
+            self._update_bug(int(bug_id), bug.findall('long_desc'))
+
+    def _update_bug(self, bug_id, long_descs):
+        self._lock.acquire()
+        try:
+            reviews = self._bugs.get(bug_id)
+            if reviews is not None:
+                if (reviews.comment_count > len(long_descs) or
+                    (reviews.comment_count > 0 and
+                     _get_comment_key(long_descs[reviews.comment_count - 1]) != reviews.last_comment_key)):
+                    # Not just new comments; start over
+                    reviews = None
+            if reviews is None:
+                if not bug_id in self._bugs and len(self._bugs) >= self.max_bugs:
+                    oldest = min(self._bugs.keys(), key=lambda k: self._bugs[k].updated)
+                    del self._bugs[oldest]
+                reviews = _BugReviews()
+
+            start = reviews.comment_count
+            for i in xrange(start, len(long_descs)):
+                long_desc = long_descs[i]
+                who = long_desc.find('who')
+                reviews.add_comment(i,
+                                    (who.text or '').strip() if who is not None else None,
+                                    who.get('name') if who is not None else None,
+                                    (long_desc.findtext('bug_when') or '').strip(),
+                                    long_desc.findtext('thetext') or u'')
+
+            if len(long_descs) > 0:
+                reviews.last_comment_key = _get_comment_key(long_descs[-1])
+            reviews.comment_count = len(long_descs)
+            reviews.updated = time.time()
+            self._bugs[bug_id] = reviews
+        finally:
+            self._lock.release()
+
+        metrics.inc('splinter_review_comments_indexed_total', len(long_descs) - start)
+
+    # Get the reviews of a bug, of all attachments or just of one, as
+    # JSON:
+    #
+    #  { "bug": <bug ID>, "comments": <number of comments indexed>,
+    #    "attachments": { <attachment ID>: { "reviews": [...], "files": {...} } } }
+    #
+    # or None if the bug isn't in the index.
+    def get_json(self, bug_id, attachment_id=None):
+        self._lock.acquire()
+        try:
+            reviews = self._bugs.get(bug_id)
+            if reviews is None:
+                return None
+            if attachment_id is None:
+                attachments = reviews.attachments
+            elif attachment_id in reviews.attachments:
+                attachments = { attachment_id: reviews.attachments[attachment_id] }
+            else:
+                attachments = {}
+
+            # Serialized with the lock held, since the lists of reviews
+            # and comments are added to by update()
+            return json.dumps({
+                    'bug': bug_id,
+                    'comments': reviews.comment_count,
+                    'attachments': dict((str(k), v) for k, v in attachments.iteritems())
+                    }, separators=(',', ':'), sort_keys=True)
+        finally:
+            self._lock.release()
@@ -0,0 +1,167 @@
+# Parsing of reviews, following the rules of Review.parse() in
+# js/review.js; see docs/REVIEW_FORMAT.txt for the format.
+#
+# Unlike the JavaScript, parsing doesn't need the reviewed patch: each
+# comment is located by the line numbers it refers to in the old and new
+# versions of its file, rather than by its position in the patch, so
+# that reviews can be indexed before the patch is loaded.
+
+import re
+
+from patch_parser import ADDED, REMOVED, CHANGED, ANY, _strip
+
+class ReviewError(Exception):
+    pass
+
+# A Bugzilla comment that is a review starts with this
+REVIEW_RE = re.compile(u'^\\s*review\\s+of\\s+attachment\\s+(\\d+)\\s*:\\s*', re.IGNORECASE | re.UNICODE)
+
+# Indicates start of review comments about a file
+# ::: foo/bar.c
+FILE_START_RE = re.compile(u'^:::[ \t]+(\\S+)[ \t]*\n', re.UNICODE | re.MULTILINE)
+
+# See HUNK_RE in js/review.js; the hunk includes the trailing lines up
+# to the next hunk or file, which are split out as the comment
+HUNK_RE = re.compile(u'^@@[ \t]+(?:-(\\d+),(\\d+)[ \t]+)?(?:\\+(\\d+),(\\d+)[ \t]+)?@@' + ANY + u'*\n((?:(?!@@|:::)' + ANY + u'*\n?)*)',
+                     re.UNICODE | re.MULTILINE)
+
+_ABBREVIATION_RE = re.compile(u'^\\.\\.\\.\\s+(\\d+)\\s+', re.UNICODE)
+
+class Comment:
+    def __init__(self, filename, type, old_line, new_line, comment):
+        self.filename = filename
+        self.type = type
+        # The line the comment is about in the old and new version of
+        # the file; None for new_line for REMOVED and old_line for ADDED
+        self.old_line = old_line
+        self.new_line = new_line
+        self.comment = comment
+
+class Review:
+    # text is the text of the review after the "Review of attachment N:"
+    # line; raises ReviewError if it's not a valid review
+    def __init__(self, text):
+        self.intro = None
+        self.comments = []
+
+        m = FILE_START_RE.search(text)
+        if m is None:
+            self._set_intro(text)
+            return
+        self._set_intro(text[:m.start()])
+
+        while m is not None:
+            filename = m.group(1)
+            pos = m.end()
+
+            while True:
+                m2 = HUNK_RE.match(text, pos)
+                if m2 is None:
+                    break
+
+                pos = m2.end()
+                self._add_comment(filename, m2)
+
+            m = FILE_START_RE.search(text, pos)
+
+    def _set_intro(self, intro):
+        intro = _strip(intro)
+        self.intro = intro if intro != u'' else None
+
+    def _add_comment(self, filename, m):
+        if m.group(1) is not None:
+            old_start = int(m.group(1))
+            old_count = int(m.group(2))
+        else:
+            old_start = old_count = None
+
+        if m.group(3) is not None:
+            new_start = int(m.group(3))
+            new_count = int(m.group(4))
+        else:
+            new_start = new_count = None
+
+        if old_start is not None and new_start is not None:
+            type = CHANGED
+        elif old_start is not None:
+            type = REMOVED
+        elif new_start is not None:
+            type = ADDED
+        else:
+            raise ReviewError("Either old or new line numbers must be given")
+
+        old_line = old_start
+        new_line = new_start
+
+        raw_lines = m.group(5).split(u'\n')
+        # js/review.js only drops a trailing element that matches
+        # '^/s+$', which in practice never happens
+        if len(raw_lines) > 0 and re.match(u'^/s+$', raw_lines[-1]):
+            raw_lines.pop()
+
+        comment_text = None
+
+        last_segment_old = 0
+        last_segment_new = 0
+        i = 0
+        while i < len(raw_lines):
+            line = raw_lines[i]
+            count = 1
+            if i < len(raw_lines) - 1:
+                m3 = _ABBREVIATION_RE.match(raw_lines[i + 1])
+                if m3 is not None:
+                    count += int(m3.group(1))
+                    i += 1
+            # An empty line is context, because if Bugzilla is
+            # line-wrapping it also strips completely whitespace lines
+            op = line[0:1]
+            if op == u' ' or op == u'':
+                if old_line is not None:
+                    old_line += count
+                if new_line is not None:
+                    new_line += count
+                last_segment_old = 0
+                last_segment_new = 0
+            elif op == u'-':
+                if old_line is not None:
+                    old_line += count
+                last_segment_old += count
+            elif op == u'+':
+                if new_line is not None:
+                    new_line += count
+                last_segment_new += count
+            # Anything else is '\ No newline at end of file', or the
+            # result of line-wrapping, and is ignored
+
+            if ((old_start is None or old_line == old_start + old_count) and
+                (new_start is None or new_line == new_start + new_count)):
+                comment_text = u'\n'.join(raw_lines[i + 1:])
+                break
+
+            i += 1
+
+        if comment_text is None:
+            comment_text = u''
+
+        if type == CHANGED:
+            if last_segment_old >= last_segment_new:
+                old_line -= 1
+            if last_segment_old <= last_segment_new:
+                new_line -= 1
+        elif type == REMOVED:
+            old_line -= 1
+        elif type == ADDED:
+            new_line -= 1
+
+        self.comments.append(Comment(filename, type, old_line, new_line,
+                                     _strip(comment_text)))
+
+# If the text of a Bugzilla comment is a review, returns
+# (attachment ID, Review), otherwise None. Raises ReviewError if the
+# comment claims to be a review, but isn't a valid one.
+def parse_comment(text):
+    m = REVIEW_RE.match(text)
+    if m is None:
+        return None
+
+    return int(m.group(1)), Review(text[m.end():])
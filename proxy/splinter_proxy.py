@@ -1,18 +1,43 @@
 #!/usr/bin/python
 
-import config
+from attachment_cache import AttachmentCache
 from BaseHTTPServer import HTTPServer
+import hashlib
 import httplib
+import compression
+import connection_pool
+from draft_store import DraftStore, DraftStoreError
+import bug_xml
 import Cookie
+import imp
+import json
+import metrics
+import mmap
+import multiprocessing
 from optparse import OptionParser
 import os
+import patch_index
+import patch_parser
+from prefetch import Prefetcher
+from profiling import RequestProfiler
+from redirect_cache import RedirectCache
+from request_body import ChunkedReader, LimitedReader, RequestBodyError
+import Queue
+import select
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 import socket
 from SocketServer import ForkingMixIn
+from static_files import StaticFiles
+import threading
 import time
+import urllib
 import urlparse
 import re
+from review_index import ReviewIndex
+from response_cache import BufferedResponse, ResponseCache, read_response
+import rfc822
 import sys
+import tempfile
 import xmlrpclib
 
 # Restricting this isn't a security measure; these URLs are enough to
@@ -26,22 +51,108 @@ PROXIED_PATHS = [
     "/xmlrpc.cgi"
 ]
 
+# How often a connection kept open for another request checks whether
+# other connections are waiting for its worker thread, in seconds
+IDLE_POLL_INTERVAL = 0.05
+
+# Room for the login cookies shared between processes with the fork
+# server engine
+MAX_SHARED_COOKIE_HEADER = 4096
+
+# Path that the proxy serves statistics from
+STATS_PATH = "/_splinter/stats"
+
+# Path that the proxy serves parsed patches from
+PARSED_PATCH_PATH = "/_splinter/patch"
+
+# Path that the proxy serves the index of reviews on a bug from
+REVIEWS_PATH = "/_splinter/reviews"
+
+# Path that the proxy serves the XML of several bugs at once from
+BUGS_PATH = "/_splinter/bugs"
+
+# Path of the draft storage API, if draft_store_path is configured
+DRAFTS_PATH = "/_splinter/drafts"
+
+# Path to POST to with ?path=<path> to make the proxy look at a static
+# file again immediately, as flattener.py --notify does
+INVALIDATE_PATH = "/_splinter/invalidate"
+
+def path_matches(path, p):
+    l = len(p)
+    return (path.startswith(p) and
+            (len(path) == l or (len(path) > l and path[l] == '?')))
+
 def is_proxied(path):
     for p in PROXIED_PATHS:
-        l = len(p)
-        if (path.startswith(p) and
-            (len(path) == l or (len(path) > l and path[l] == '?'))):
+        if path_matches(path, p):
             return True
     return False
 
-# Cookie values we'll send to Bugzilla if logged in
-login_cookie_header = None
+# Get the name under which statistics for a request are recorded:
+# the path for proxied paths and our own special paths, otherwise 'static'
+def get_route(path):
+    for p in PROXIED_PATHS + ["/config.js", STATS_PATH, PARSED_PATCH_PATH, REVIEWS_PATH, BUGS_PATH,
+                              DRAFTS_PATH, INVALIDATE_PATH]:
+        if path_matches(path, p):
+            return p
+    return "static"
+
+# If the path is a plain request for the contents of an attachment,
+# return the attachment ID, otherwise None
+def get_attachment_id(path):
+    if not path.startswith('/attachment.cgi?'):
+        return None
+
+    query = urlparse.parse_qs(path[len('/attachment.cgi?'):], keep_blank_values=True)
+    for key, values in query.iteritems():
+        if len(values) != 1:
+            return None
+        if not (key == 'id' or (key == 'action' and values[0] == 'view')):
+            return None
+    if not 'id' in query or not query['id'][0].isdigit():
+        return None
+
+    return int(query['id'][0])
+
+# Whether the path is a request for the XML of a bug
+def is_bug_xml(path):
+    if not path.startswith('/show_bug.cgi?'):
+        return False
+
+    query = urlparse.parse_qs(path[len('/show_bug.cgi?'):])
+    return query.get('ctype') == ['xml']
+
+# Parse a date from an HTTP header into a timestamp, or None
+def parse_http_date(value):
+    parsed = rfc822.parsedate_tz(value)
+    if parsed is None:
+        return None
+
+    return rfc822.mktime_tz(parsed)
+
+# Get a function reading at most length bytes from f in total
+def limited_read(f, length):
+    remaining = [length]
+    def read(amt):
+        data = f.read(min(amt, remaining[0]))
+        remaining[0] -= len(data)
+        return data
+
+    return read
 
 # Time we started the proxy server
 start_time = time.time()
 
-# Content for config.js
-config_js_content = None
+# Instance for each configuration being served; the first one also
+# handles requests that don't match any of the others
+instances = []
+
+# StaticFiles index of the document root, shared by all instances
+static_files = None
+
+# RequestProfiler for profiling and logging slow requests
+request_profiler = None
 
 # This wraps up the pure-tuple old SplitResult into an object with attributes
 # like the new version
@@ -74,90 +185,684 @@ def port_from_scheme(scheme, override):
     else:
         raise RuntimeError("Bad scheme %s" % scheme)
 
-# Convert an URL we received from a client to all the information we'll
-# need to proxy to the Bugzilla server - host, port, new path, etc.
-def get_proxy_info(path):
-    split = urlsplit(current_config['bugzilla_url'])
-    if split.port:
-        portstr = ":" + str(split.port)
-    else:
-        portstr = ""
-    port = port_from_scheme(split.scheme, split.port)
-
-    proxy_path = split.path + path[1:] # Chop leading / off of path
+# Look up an optional setting that applies to the proxy as a whole,
+# rather than to a single instance: the settings for the listening
+# socket, the server engine, client connections, compression, static
+# files and profiling. These are taken from the first configuration.
+def config_value(key, default):
+    return instances[0].config_value(key, default)
+
+# Find the instance that should handle a request for path with the Host
+# header host (which may be None). Returns (instance, path), where path
+# is relative to the proxy_prefix of the instance; it doesn't start with
+# '/' if the request was for the prefix itself.
+def find_instance(host, path):
+    if host is not None:
+        # Without the port; IPv6 addresses are in brackets
+        host = re.match(r"^(\[[^\]]*\]|[^:]*)", host.strip().lower()).group(1)
+
+    for instance in instances:
+        if instance.host is not None and instance.host != host:
+            continue
+        if instance.prefix != '':
+            if not (path == instance.prefix or
+                    path.startswith(instance.prefix + '/') or
+                    path.startswith(instance.prefix + '?')):
+                continue
+            return instance, path[len(instance.prefix):]
+        elif instance.host is not None:
+            return instance, path
+
+    return instances[0], path
+
+# Like SocketServer.ThreadingMixIn, but rather than starting a thread for
+# every connection, connections are handed to a fixed set of worker
+# threads. At most max_workers requests are handled at once; beyond that
+# up to max_queued connections wait for a worker, and further connections
+# are refused with a 503 so that a burst can't exhaust memory or threads.
+class ThreadPoolMixIn:
+    max_workers = 16
+    max_queued = 64
+
+    def start_workers(self):
+        self.request_queue = Queue.Queue(self.max_queued)
+        for i in xrange(self.max_workers):
+            worker = threading.Thread(target=self.process_queued_requests)
+            worker.setDaemon(True)
+            worker.start()
+
+    def process_queued_requests(self):
+        while True:
+            request, client_address = self.request_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        try:
+            self.request_queue.put_nowait((request, client_address))
+        except Queue.Full:
+            self.reject_request(request, client_address)
 
-    url = "%s://%s%s%s" % (split.scheme, split.hostname,
-                           portstr, proxy_path)
+    # Whether a client connection can be kept open for another request;
+    # not if other connections are waiting for a worker
+    def should_keep_alive(self):
+        return self.request_queue.qsize() == 0
 
-    return split.scheme, split.hostname, port, proxy_path, url
+    def reject_request(self, request, client_address):
+        try:
+            request.sendall("HTTP/1.0 503 Service Unavailable\r\n"
+                            "Content-Type: text/plain\r\n"
+                            "Connection: close\r\n"
+                            "\r\n"
+                            "Too many requests\n")
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+# Without a mixin, HTTPServer is single-connection-at-a-time
+class ProxyServer(ThreadPoolMixIn, HTTPServer):
+    # The listen() backlog; the default of 5 makes clients that connect
+    # in a burst wait for SYN retransmission
+    request_queue_size = 128
+
+    def __init__(self, server_address, RequestHandlerClass, max_workers, max_queued):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.start_workers()
+
+class ForkingProxyServer(ForkingMixIn, HTTPServer):
+    request_queue_size = 128
+
+    def should_keep_alive(self):
+        return True
+
+# One request at a time; client connections aren't kept open, since an
+# idle connection would hold up everybody else
+class SingleProxyServer(HTTPServer):
+    def should_keep_alive(self):
+        return False
 
-# Without the mixin, HTTPServer is single-connection-at-a-time
-class ProxyServer(HTTPServer, ForkingMixIn):
-    pass
+# Create the server using the concurrency engine from the configuration:
+# 'threads' (a bounded pool of worker threads, the default), 'fork'
+# (a process per request), or 'single' (one request at a time)
+def make_server(server_address):
+    engine = config_value('server_engine', 'threads')
+    if engine == 'threads':
+        return ProxyServer(server_address, ProxyHandler,
+                           config_value('max_workers', 16),
+                           config_value('max_queued', 64))
+    elif engine == 'fork':
+        return ForkingProxyServer(server_address, ProxyHandler)
+    elif engine == 'single':
+        return SingleProxyServer(server_address, ProxyHandler)
+    else:
+        raise RuntimeError("Bad server_engine %s" % engine)
 
 # Extend SimpleHTTPRequestHandler to proxy certain URLs to HTTP
 # rather than serving from local files
 class ProxyHandler(SimpleHTTPRequestHandler):
+    # Client connections are kept open between requests, as long as
+    # every response can be delimited without closing the connection
+    protocol_version = "HTTP/1.1"
+    # Headers are buffered and sent along with the start of the body
+    # rather than a line at a time; the buffer is flushed after each
+    # block of the body and at the end of each request
+    wbufsize = -1
+
     # Send the response on to the client; called directly from do_proxied()
     # normally but from do_redirect() if there was a redirect
     def relay_response(self, response):
+        # Compress the body ourselves unless Bugzilla already did
+        encoder = None
+        if (self.command == 'GET' and response.status == 200 and
+            response.getheader('content-encoding') is None):
+            content_length = None
+            if not response.chunked:
+                content_length = response.getheader('content-length')
+            encoder = self.get_encoder(response.getheader('content-type'), content_length)
+
         self.send_response(response.status, response.reason)
-        content = response.read()
         seen_expires = False
+        # Whether the client gets the response compressed depends on its
+        # Accept-Encoding whenever it could have been compressed, not just
+        # when it is, so that caches keep the two versions apart
+        vary = None
+        if (self.command == 'GET' and response.status == 200 and
+            response.getheader('content-encoding') is None and
+            self.may_compress(response.getheader('content-type'))):
+            vary = 'Accept-Encoding'
         for header, value in response.getheaders():
             # BaseHTTPRequestHandler sends the 'Server' and 'Date' headers
             # We are handling the "session" with Bugzilla ourselves, so we
             # don't want the browser getting Bugzilla's cookies
             #
-            # Remove Transfer-Encoding since we end up converting chunked
-            # Transfer-Encoding to unchunked.
-            if header.lower() in ('date', 'server', 'set-cookie', 'transfer-encoding', 'content-length'):
+            # Transfer-Encoding and Content-Length are sent by relay_body()
+            # since httplib removes any chunking of the body for us.
+            #
+            # Whether the connection is kept alive is between us and the
+            # client, and between us and Bugzilla, separately.
+            if header.lower() in ('date', 'server', 'set-cookie', 'transfer-encoding', 'content-length',
+                                  'connection', 'keep-alive', 'proxy-connection', 'trailer', 'upgrade'):
                 continue
             if header.lower() == 'expires':
                 seen_expires = True
+            if header.lower() == 'vary' and vary is not None:
+                if not 'accept-encoding' in value.lower():
+                    vary = value + ', ' + vary
+                continue
+            # The compressed body isn't byte-for-byte what the ETag describes
+            if header.lower() == 'etag' and encoder is not None and not value.startswith('W/'):
+                value = 'W/' + value
             self.send_header(header, value)
         if not seen_expires and self.command == 'GET':
             # Assume that attachments are immutable - give them an Expires of a month
             if self.path.startswith('/attachment.cgi?'):
                 self.send_header('Expires', self.date_time_string(time.time() + 31*24*60*60))
             # If we are running anonymously, allow bug content to be cached for 5 minutes
-            elif not ('bugzilla_login' in current_config and 'bugzilla_login' in current_config):
+            elif self.instance.running_anonymously():
                 self.send_header('Expires', self.date_time_string(time.time() + 5*60))
-        self.send_header('content-length', len(content))
+        if encoder is not None:
+            self.send_header('Content-Encoding', encoder.encoding)
+        if vary is not None:
+            self.send_header('Vary', vary)
+
+        cache_writer = None
+        if self.cache_attachment_id is not None and response.status == 200:
+            cache_writer = self.instance.attachment_cache.begin_store(self.cache_attachment_id, response)
+
+        try:
+            if self.instance.config_value('stream_responses', True):
+                self.relay_body(response, cache_writer, encoder)
+            else:
+                content = response.read()
+                if cache_writer:
+                    cache_writer.write(content)
+                if encoder is not None:
+                    content = encoder.compress(content) + encoder.flush()
+                self.send_header('content-length', len(content))
+                self.end_headers()
+                self.wfile.write(content)
+        except:
+            if cache_writer:
+                cache_writer.abort()
+            raise
+        # Only store complete bodies
+        if cache_writer:
+            if response.isclosed():
+                cache_writer.commit()
+            else:
+                cache_writer.abort()
+
+    def relay_body(self, response, cache_writer=None, encoder=None):
+        content_length = None
+        if not response.chunked and encoder is None:
+            content_length = response.getheader('content-length')
+
+        has_body = not (self.command == 'HEAD' or
+                        response.status in (204, 304) or
+                        response.status < 200)
+
+        start = time.time()
+        bytes_read = self.send_body(response.read, content_length, has_body, cache_writer, encoder)
+        # Buffered responses were already counted when they were read
+        if not isinstance(response, BufferedResponse):
+            metrics.observe('splinter_upstream_transfer_seconds', time.time() - start)
+            metrics.inc('splinter_bytes_in_total', bytes_read, peer='upstream')
+
+    # Finish the headers and copy the body to the client buffer_size bytes
+    # at a time; read is called with the block size and returns '' at the
+    # end. We only read the next block once the previous block has been
+    # written - the writes block while the client is slow to read, so
+    # memory use per request stays bounded and backpressure propagates to
+    # the upstream connection. If cache_writer is not None, the data is
+    # also written to it; if encoder is not None, the data is compressed
+    # with it. Returns the number of bytes read.
+    def send_body(self, read, content_length, has_body, cache_writer=None, encoder=None):
+        buffer_size = self.instance.config_value('relay_buffer_size', 64 * 1024)
+
+        chunked = False
+        if content_length is not None:
+            self.send_header('Content-Length', content_length)
+        elif has_body:
+            if self.request_version >= 'HTTP/1.1' and self.protocol_version >= 'HTTP/1.1':
+                self.send_header('Transfer-Encoding', 'chunked')
+                chunked = True
+            else:
+                # The end of the body is marked by closing the connection
+                self.close_connection = 1
         self.end_headers()
-        self.wfile.write(content)
-        self.wfile.close()
 
-    def do_proxied(self):
-        proxy_scheme, proxy_hostname, proxy_port, proxy_path, proxy_url = get_proxy_info(self.path)
-        if (proxy_scheme == 'http'):
-            connection = httplib.HTTPConnection(proxy_hostname, proxy_port)
+        bytes_read = 0
+        if not has_body:
+            return bytes_read
+
+        while True:
+            data = read(buffer_size)
+            if not data:
+                break
+            bytes_read += len(data)
+            if cache_writer:
+                cache_writer.write(data)
+            if encoder is not None:
+                data = encoder.compress(data)
+            self.write_body_data(data, chunked)
+        if encoder is not None:
+            self.write_body_data(encoder.flush(), chunked)
+        if chunked:
+            self.wfile.write("0\r\n\r\n")
+
+        return bytes_read
+
+    def write_body_data(self, data, chunked):
+        # An empty chunk would mark the end of the body
+        if len(data) == 0:
+            return
+
+        metrics.inc('splinter_bytes_out_total', len(data), peer='client')
+        if chunked:
+            self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+        self.wfile.flush()
+
+    # Whether responses of content_type are compressed for clients that
+    # accept it (if they are big enough)
+    def may_compress(self, content_type):
+        return config_value('compress_responses', True) and compression.is_compressible(content_type)
+
+    # Get an encoder to compress a response body on the fly, if the client
+    # accepts one and the content is worth compressing
+    def get_encoder(self, content_type, content_length):
+        if not self.may_compress(content_type):
+            return None
+        if content_length is not None and long(content_length) < config_value('compress_min_size', 1024):
+            return None
+
+        encoding = compression.choose_encoding(self.headers.getheader('accept-encoding'))
+        if encoding is None:
+            return None
+
+        return compression.make_encoder(encoding, config_value('compress_level', 6))
+
+    # Serve a file under the document root using the static_files index;
+    # returns False if there is no such file, in which case
+    # SimpleHTTPRequestHandler takes care of directories and errors
+    def send_static(self):
+        path = self.translate_path(self.path)
+        static_file = static_files.lookup(path)
+        if static_file is None:
+            return False
+
+        use_gzip = (static_file.gzip_data is not None and
+                    compression.choose_encoding(self.headers.getheader('accept-encoding')) == 'gzip')
+        if use_gzip:
+            etag = static_file.gzip_etag()
         else:
-            connection = httplib.HTTPSConnection(proxy_hostname, proxy_port)
+            etag = static_file.etag
+        last_modified = self.date_time_string(static_file.mtime)
+
+        if self.is_not_modified(etag, last_modified):
+            self.send_response(304, "Not Modified")
+            self.send_static_headers(static_file, etag, last_modified)
+            self.end_headers()
+            return True
+
+        f = None
+        if self.command == 'GET' and not use_gzip:
+            # The file might have changed since it was last checked, in
+            # which case the index is out of date
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                static_files.invalidate(path)
+                return False
+            st = os.fstat(f.fileno())
+            if st.st_size != static_file.size or st.st_mtime != static_file.mtime:
+                f.close()
+                static_files.invalidate(path)
+                return self.send_static()
+
+        try:
+            self.send_response(200, "OK")
+            self.send_header("Content-type", static_file.content_type)
+            if use_gzip:
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(static_file.gzip_data)))
+            else:
+                self.send_header("Content-Length", str(static_file.size))
+            self.send_static_headers(static_file, etag, last_modified)
+            self.end_headers()
+
+            if self.command == 'GET':
+                if use_gzip:
+                    self.wfile.write(static_file.gzip_data)
+                    metrics.inc('splinter_bytes_out_total', len(static_file.gzip_data), peer='client')
+                elif static_file.size > 0:
+                    # Writing the mapped file directly to the socket avoids
+                    # copying the contents into a string first
+                    self.wfile.flush()
+                    contents = mmap.mmap(f.fileno(), static_file.size, access=mmap.ACCESS_READ)
+                    try:
+                        self.connection.sendall(contents)
+                    finally:
+                        contents.close()
+                    metrics.inc('splinter_bytes_out_total', static_file.size, peer='client')
+        finally:
+            if f is not None:
+                f.close()
+
+        return True
+
+    def send_static_headers(self, static_file, etag, last_modified):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if static_file.gzip_data is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        if static_file.content_hashed:
+            self.send_header("Cache-Control", "public, max-age=31536000")
+            self.send_header("Expires", self.date_time_string(time.time() + 365*24*60*60))
+
+    # Check the validators in the request against the current ETag and
+    # Last-Modified date of the resource; If-None-Match takes precedence
+    # over If-Modified-Since as described in RFC 2616.
+    def is_not_modified(self, etag, last_modified):
+        if_none_match = self.headers.getheader('if-none-match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+        if_modified_since = self.headers.getheader('if-modified-since')
+        if if_modified_since is not None and last_modified is not None:
+            since = parse_http_date(if_modified_since)
+            modified = parse_http_date(last_modified)
+            return since is not None and modified is not None and modified <= since
+
+        return False
+
+    # Get the range of bytes requested with a Range header for a resource
+    # of the given size; returns None to send the whole resource, or the
+    # inclusive (start, end) of the range, start being at least size if
+    # the range can't be satisfied. Only a single range is supported; the
+    # whole resource is sent for anything else, as RFC 2616 allows, and
+    # also if an If-Range validator doesn't match.
+    def get_byte_range(self, size, etag, last_modified):
+        value = self.headers.getheader('range')
+        if value is None:
+            return None
+        m = re.match(r'^\s*bytes\s*=\s*([0-9]*)\s*-\s*([0-9]*)\s*$', value)
+        if m is None or (m.group(1) == '' and m.group(2) == ''):
+            return None
+
+        if_range = self.headers.getheader('if-range')
+        if if_range is not None:
+            if_range = if_range.strip()
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                # Weak validators never match
+                if if_range != etag or etag.startswith('W/'):
+                    return None
+            elif if_range != last_modified:
+                return None
+
+        if m.group(1) == '':
+            # bytes=-<n>: the last n bytes
+            length = int(m.group(2))
+            if length == 0:
+                return (size, size)
+            return (max(size - length, 0), size - 1)
+
+        start = int(m.group(1))
+        end = size - 1
+        if m.group(2) != '':
+            if int(m.group(2)) < start:
+                return None
+            end = min(int(m.group(2)), end)
+        if start >= size:
+            return (size, size)
+
+        return (start, end)
+
+    # Serve an attachment from the cache; returns False if the attachment
+    # isn't cached
+    def send_cached_attachment(self, attachment_id):
+        entry = self.instance.attachment_cache.lookup(attachment_id)
+        if entry is None:
+            return False
+        try:
+            f = self.instance.attachment_cache.open(entry)
+        except IOError:
+            return False
+
+        try:
+            etag = '"%s"' % entry['sha1']
+            size = entry['size']
+            not_modified = self.is_not_modified(etag, entry['last_modified'])
+            byte_range = None
+            if not not_modified:
+                byte_range = self.get_byte_range(size, etag, entry['last_modified'])
+            encoder = None
+            content_length = None
+            read = f.read
+            if not_modified:
+                self.send_response(304, "Not Modified")
+            elif byte_range is not None and byte_range[0] >= size:
+                self.send_response(416, "Requested Range Not Satisfiable")
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                content_length = '0'
+            else:
+                if byte_range is not None:
+                    start, end = byte_range
+                    self.send_response(206, "Partial Content")
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+                    f.seek(start)
+                    read = limited_read(f, end + 1 - start)
+                    content_length = str(end + 1 - start)
+                else:
+                    # Partial responses are never compressed, since the
+                    # range is of the uncompressed content
+                    encoder = self.get_encoder(entry['content_type'], size)
+                    self.send_response(200, "OK")
+                    self.send_header('Accept-Ranges', 'bytes')
+                    if encoder is None:
+                        content_length = str(size)
+                if entry['content_type'] is not None:
+                    self.send_header('Content-Type', entry['content_type'])
+                if entry['content_disposition'] is not None:
+                    self.send_header('Content-Disposition', entry['content_disposition'])
+                if encoder is not None:
+                    self.send_header('Content-Encoding', encoder.encoding)
+                    etag = 'W/' + etag
+            if self.may_compress(entry['content_type']):
+                self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', entry['last_modified'])
+            self.send_header('Expires', self.date_time_string(time.time() + 31*24*60*60))
+
+            has_body = self.command == 'GET' and not not_modified
+            self.send_body(read, content_length, has_body, encoder=encoder)
+        finally:
+            f.close()
+
+        return True
+
+    def do_proxied(self):
+        instance = self.instance
+
+        # Attachments are served from the cache when possible, and otherwise
+        # stored in the cache by relay_response() when fetched
+        self.cache_attachment_id = None
+        if instance.attachment_cache is not None and self.command in ('GET', 'HEAD'):
+            attachment_id = get_attachment_id(self.path)
+            if attachment_id is not None:
+                if instance.prefetcher is not None:
+                    instance.prefetcher.wait(attachment_id, instance.config_value('prefetch_wait_timeout', 30))
+                if self.send_cached_attachment(attachment_id):
+                    metrics.inc('splinter_cache_requests_total', cache='attachment', result='hit')
+                    self.log_message("Serving attachment %d from cache", attachment_id)
+                    return
+                metrics.inc('splinter_cache_requests_total', cache='attachment', result='miss')
+                if self.command == 'GET':
+                    self.cache_attachment_id = attachment_id
+
+        proxy_scheme, proxy_hostname, proxy_port, proxy_path, proxy_url = instance.get_proxy_info(self.path)
+        pool = instance.get_upstream_pool(proxy_scheme, proxy_hostname, proxy_port)
 
         self.log_message("Proxying to %s", proxy_url)
 
-        connection.putrequest(self.command, proxy_path)
-        content_length = -1;
+        headers = []
         for header, value in self.headers.items():
-            if header.lower() == 'content-length':
-                content_length = long(value)
             # httplib.py will send an appropriate Host: header, we'll send
-            # the cookies for our "session" with Bugzilla ourselves
-            if not header.lower() in ('cookie', 'host', 'x-forwarded-host', 'x-forwarded-server'):
-                connection.putheader(header, value)
-        if login_cookie_header is not None:
-            connection.putheader('Cookie', login_cookie_header)
-        connection.endheaders()
-        if content_length > 0:
-            connection.send(self.rfile.read(content_length))
-
-        response = connection.getresponse()
-
-        if not self.maybe_redirect(response, [proxy_url]):
-            self.relay_response(response)
+            # the cookies for our "session" with Bugzilla ourselves, and
+            # the connection to Bugzilla is kept alive independently of the
+            # connection from the client. We handle Expect: 100-continue and
+            # the transfer encoding of the body ourselves.
+            if not header.lower() in ('cookie', 'host', 'x-forwarded-host', 'x-forwarded-server',
+                                      'connection', 'keep-alive', 'proxy-connection',
+                                      'expect', 'transfer-encoding', 'te', 'trailer', 'upgrade'):
+                # The attachment cache needs the data unencoded
+                if header.lower() == 'accept-encoding' and self.cache_attachment_id is not None:
+                    continue
+                headers.append((header, value))
+        headers.extend(instance.get_login_headers())
+
+        if self.command == 'GET' and is_bug_xml(self.path):
+            self.do_shared_get(pool, proxy_path, proxy_url, headers)
+            return
 
-        connection.close()
+        # If Bugzilla redirected us elsewhere for this attachment recently,
+        # go there directly
+        self.redirect_attachment_id = None
+        if self.command in ('GET', 'HEAD'):
+            self.redirect_attachment_id = get_attachment_id(self.path)
+        if self.redirect_attachment_id is not None:
+            location = instance.redirect_cache.lookup(self.redirect_attachment_id)
+            if location is not None and self.do_cached_redirect(location):
+                return
+
+        try:
+            body = self.get_request_body(headers)
+            connection, response = pool.request(self.command, proxy_path, headers, body,
+                                                instance.config_value('relay_buffer_size', 64 * 1024))
+            if instance.renew_session(response, headers):
+                try:
+                    response.read()
+                finally:
+                    pool.release(connection, response)
+                # A body being streamed from the client can't be sent
+                # again; rather than passing on Bugzilla's login page as
+                # if the request had succeeded, tell the client to retry
+                if hasattr(body, 'read') and not hasattr(body, 'seek'):
+                    self.send_error(503, "Session with Bugzilla expired; please send the request again")
+                    return
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                connection, response = pool.request(self.command, proxy_path, headers, body,
+                                                    instance.config_value('relay_buffer_size', 64 * 1024))
+        except RequestBodyError, e:
+            self.send_error(e.code, e.message)
+            return
+        except (socket.error, httplib.HTTPException), e:
+            # Including a request that might have reached Bugzilla, which
+            # isn't sent again unless it's a GET or HEAD
+            self.log_message("Request to Bugzilla failed: %s", e)
+            self.send_error(502, "Request to Bugzilla failed")
+            return
+        try:
+            if not self.maybe_redirect(response, [proxy_url]):
+                self.relay_response(response)
+        finally:
+            pool.release(connection, response)
+
+    # Get the body of the request to send on to Bugzilla: None if there
+    # isn't one, a string if it fits in relay_buffer_size, and otherwise a
+    # file-like object that reads the body from the client as it is sent
+    # on. Bugzilla's CGI scripts need to know the length of the body up
+    # front, so a chunked body is spooled to a temporary file, and a
+    # Content-Length header for it is added to headers. Raises
+    # RequestBodyError if the body is bigger than max_request_body_size.
+    def get_request_body(self, headers):
+        max_size = self.instance.config_value('max_request_body_size', 32 * 1024 * 1024)
+        buffer_size = self.instance.config_value('relay_buffer_size', 64 * 1024)
+
+        transfer_encoding = self.headers.getheader('transfer-encoding')
+        content_length = self.headers.getheader('content-length')
+        if transfer_encoding is not None and transfer_encoding.lower() != 'identity':
+            if transfer_encoding.lower() != 'chunked':
+                raise RequestBodyError(501, "Unsupported Transfer-Encoding")
+            self.send_continue()
+            reader = ChunkedReader(self.rfile, max_size)
+            body = tempfile.SpooledTemporaryFile(buffer_size)
+            while True:
+                data = reader.read(buffer_size)
+                if not data:
+                    break
+                body.write(data)
+            headers.append(('Content-Length', str(reader.size)))
+            body.seek(0)
+            return body
+        elif content_length is not None:
+            try:
+                length = long(content_length)
+            except ValueError:
+                raise RequestBodyError(400, "Bad Content-Length")
+            if length < 0:
+                raise RequestBodyError(400, "Bad Content-Length")
+            if length > max_size:
+                raise RequestBodyError(413, "Request body too large")
+            if length == 0:
+                return None
+            self.send_continue()
+            # A small body is read up front so that it can be resent if
+            # a pooled connection turns out to have been closed by the
+            # server
+            if length <= buffer_size:
+                return LimitedReader(self.rfile, length).read(length)
+            return LimitedReader(self.rfile, length)
+        else:
+            return None
+
+    # If the client is waiting for our go-ahead before sending the body,
+    # give it
+    def send_continue(self):
+        if (self.request_version == 'HTTP/1.1' and
+            self.headers.getheader('expect', '').lower() == '100-continue'):
+            self.wfile.write("HTTP/1.1 100 Continue\r\n\r\n")
+            self.wfile.flush()
+
+    # Handle a GET that is shared between identical concurrent requests,
+    # and, when running anonymously, cached for a short time. The response
+    # can't depend on the client's validators, range or encoding, so those
+    # aren't sent to Bugzilla; we check the validators ourselves.
+    def do_shared_get(self, pool, proxy_path, proxy_url, headers):
+        self.redirect_attachment_id = None
+        headers = [(header, value) for header, value in headers
+                   if not header.lower() in ('if-none-match', 'if-modified-since',
+                                             'range', 'if-range', 'accept-encoding')]
+
+        instance = self.instance
+        response = instance.bug_xml_cache.get(proxy_path,
+                                              lambda extra_headers: instance.fetch_bug_xml(pool, proxy_path,
+                                                                                           headers + extra_headers),
+                                              instance.running_anonymously())
+        if self.maybe_redirect(response, [proxy_url]):
+            return
+
+        etag = response.getheader('etag')
+        last_modified = response.getheader('last-modified')
+        if (response.status == 200 and (etag is not None or last_modified is not None) and
+            self.is_not_modified(etag, last_modified)):
+            self.send_response(304, "Not Modified")
+            if etag is not None:
+                self.send_header('ETag', etag)
+            if last_modified is not None:
+                self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return
+
+        self.relay_response(response)
 
     def maybe_redirect(self, response, seen_urls):
         # Redirect status codes are a bit confusing; 302 (Found) by
@@ -177,43 +882,79 @@ class ProxyHandler(SimpleHTTPRequestHandler):
         if response.status in (302, 303):
             location = response.getheader('location')
             if location:
+                # Finish reading the (small) body so that the connection
+                # can go back to the pool
+                response.read()
                 if location in seen_urls or len(seen_urls) >= 10:
                     self.send_error(400, 'Circular redirection, or too many redirects')
                 else:
                     seen_urls.append(location)
+                    metrics.inc('splinter_redirects_total')
                     self.do_redirect(location, seen_urls)
                 return True
 
         return False
 
-    # Retry the request with a GET after a redirect
-    def do_redirect(self, location, seen_urls):
-        self.log_message("Redirecting to %s", location)
+    # Make a GET request for an absolute URL we've been redirected to;
+    # returns (pool, connection, response)
+    def request_location(self, location):
         split = urlsplit(location)
         port = port_from_scheme(split.scheme, split.port)
-
-        if (split.scheme == 'http'):
-            connection = httplib.HTTPConnection(split.hostname, split.port)
-        else:
-            connection = httplib.HTTPSConnection(split.hostname, split.port)
+        pool = self.instance.get_upstream_pool(split.scheme, split.hostname, port)
 
         relative = urlparse.urlunsplit((None, None, split.path, split.query, split.fragment))
-        connection.putrequest('GET', relative)
+        headers = []
         for header, value in self.headers.items():
             # We additionally exclude content-length since it would
             # be referring to the data sent with an original POST and
             # we're not sending that data with the redirected GET
-            if not header.lower() in ('cookie', 'host',  'x-forwarded-host', 'x-forwarded-server', 'content-length'):
-                connection.putheader(header, value)
-        if login_cookie_header is not None:
-            connection.putheader('Cookie', login_cookie_header)
-        connection.endheaders()
-
-        response = connection.getresponse()
-        if not self.maybe_redirect(response, seen_urls):
-            self.relay_response(response)
+            if not header.lower() in ('cookie', 'host',  'x-forwarded-host', 'x-forwarded-server', 'content-length',
+                                      'connection', 'keep-alive', 'proxy-connection'):
+                if header.lower() == 'accept-encoding' and self.cache_attachment_id is not None:
+                    continue
+                headers.append((header, value))
+        headers.extend(self.instance.get_login_headers())
+
+        connection, response = pool.request('GET', relative, headers)
+        return pool, connection, response
 
-        connection.close()
+    # Retry the request with a GET after a redirect
+    def do_redirect(self, location, seen_urls):
+        self.log_message("Redirecting to %s", location)
+        pool, connection, response = self.request_location(location)
+        try:
+            if not self.maybe_redirect(response, seen_urls):
+                if self.redirect_attachment_id is not None and response.status == 200:
+                    self.instance.redirect_cache.store(self.redirect_attachment_id, location)
+                self.relay_response(response)
+        finally:
+            pool.release(connection, response)
+
+    # Get an attachment from the location Bugzilla last redirected us
+    # to for it. If that fails, the location is forgotten and False is
+    # returned without anything having been sent to the client, so that
+    # the original URL can be tried instead. Redirects from the location
+    # count as failure, so aren't followed here.
+    def do_cached_redirect(self, location):
+        self.log_message("Using cached redirect to %s", location)
+        try:
+            pool, connection, response = self.request_location(location)
+        except (socket.error, httplib.HTTPException), e:
+            self.log_message("Cached redirect failed: %s", e)
+            self.instance.redirect_cache.invalidate(self.redirect_attachment_id, location)
+            return False
+
+        try:
+            if response.status >= 300 and response.status != 304:
+                response.read()
+                self.log_message("Cached redirect failed with status %d", response.status)
+                self.instance.redirect_cache.invalidate(self.redirect_attachment_id, location)
+                return False
+
+            self.relay_response(response)
+            return True
+        finally:
+            pool.release(connection, response)
 
     # Copy of date_time_string() in the Python-2.6 BaseHttpRequestHandler
     # Differs from the the Python-2.4 version in taking an optional time to format.
@@ -229,167 +970,1140 @@ class ProxyHandler(SimpleHTTPRequestHandler):
         return s
 
     def do_config_js(self):
+        # Wait a bit for the extension check, rather than telling the
+        # browser the wrong thing
+        self.instance.splinter_info_done.wait(self.instance.config_value('startup_wait_timeout', 10))
+        config_js_content, config_js_time = self.instance.config_js
+        last_modified = self.date_time_string(config_js_time)
+        if self.is_not_modified(None, last_modified):
+            self.send_response(304, "Not Modified")
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return
+
         self.send_response(200, "OK")
         self.send_header("Content-type", "text/javascript")
         self.send_header("Content-Length", str(len(config_js_content)))
-        self.send_header("Last-Modified", self.date_time_string(start_time))
+        self.send_header("Last-Modified", last_modified)
         self.end_headers()
 
         if (self.command == 'GET'):
             self.wfile.write(config_js_content)
+            metrics.inc('splinter_bytes_out_total', len(config_js_content), peer='client')
+
+    # Report the statistics kept by the metrics module, as JSON, or with
+    # ?format=prometheus in the Prometheus text format
+    def do_stats(self):
+        # Totals over the instances that have an attachment cache
+        total_entries = 0
+        total_size = 0
+        for instance in instances:
+            if instance.attachment_cache is not None:
+                entries, size = instance.attachment_cache.get_size()
+                total_entries += entries
+                total_size += size
+        metrics.set_gauge('splinter_attachment_cache_entries', total_entries)
+        metrics.set_gauge('splinter_attachment_cache_bytes', total_size)
+
+        query = urlparse.parse_qs(urlsplit(self.path).query)
+        if query.get('format') == ['prometheus']:
+            content_type = "text/plain; version=0.0.4"
+            content = metrics.registry.to_prometheus()
+        else:
+            content_type = "application/json"
+            content = json.dumps(metrics.registry.to_json(), indent=2, sort_keys=True)
+
+        self.send_response(200, "OK")
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(content)
+
+    # Serve the compact JSON form of a parsed patch (see patch_parser.py)
+    # for ?id=<attachment id>. With &toc=1, serve instead the file-level
+    # index of the patch (see patch_index.py), and with &file=<n>, just
+    # the n'th file of the patch, so that huge patches can be loaded a
+    # file at a time.
+    def do_parsed_patch(self):
+        self.cache_attachment_id = None
+
+        query = urlparse.parse_qs(urlsplit(self.path).query)
+        if query.get('id') is None or len(query['id']) != 1 or not query['id'][0].isdigit():
+            self.send_error(400, "Bad attachment ID")
+            return
+        attachment_id = int(query['id'][0])
+
+        instance = self.instance
+        if query.get('file') is not None:
+            if len(query['file']) != 1 or not query['file'][0].isdigit():
+                self.send_error(400, "Bad file index")
+                return
+            file_index = int(query['file'][0])
+            response = instance.parsed_file_cache.get((attachment_id, file_index),
+                                                      lambda extra_headers: instance.fetch_parsed_file(attachment_id, file_index))
+        elif query.get('toc') == ['1']:
+            response = instance.patch_index_cache.get(attachment_id,
+                                                      lambda extra_headers: instance.fetch_patch_index(attachment_id))
+        else:
+            response = instance.parsed_patch_cache.get(attachment_id,
+                                                       lambda extra_headers: instance.fetch_parsed_patch(attachment_id))
+
+        self.send_json_response(response)
+
+    # Serve the index of the reviews on a bug (see review_index.py) for
+    # ?bug=<bug ID>, optionally restricted to the reviews of one
+    # attachment with &attachment=<attachment ID>. The XML of the bug is
+    # fetched as for show_bug.cgi, which brings the index up to date.
+    def do_reviews(self):
+        self.cache_attachment_id = None
+
+        query = urlparse.parse_qs(urlsplit(self.path).query)
+        if query.get('bug') is None or len(query['bug']) != 1 or not query['bug'][0].isdigit():
+            self.send_error(400, "Bad bug ID")
+            return
+        bug_id = int(query['bug'][0])
+        attachment_id = None
+        if query.get('attachment') is not None:
+            if len(query['attachment']) != 1 or not query['attachment'][0].isdigit():
+                self.send_error(400, "Bad attachment ID")
+                return
+            attachment_id = int(query['attachment'][0])
+
+        instance = self.instance
+        proxy_scheme, proxy_hostname, proxy_port, proxy_path, proxy_url = \
+            instance.get_proxy_info("/show_bug.cgi?id=%d&ctype=xml" % bug_id)
+        pool = instance.get_upstream_pool(proxy_scheme, proxy_hostname, proxy_port)
+        headers = instance.get_login_headers()
+
+        response = instance.bug_xml_cache.get(proxy_path,
+                                              lambda extra_headers: instance.fetch_bug_xml(pool, proxy_path,
+                                                                                           headers + extra_headers),
+                                              instance.running_anonymously())
+        if response.status != 200:
+            self.send_error(502, "Failed to retrieve bug %d" % bug_id)
+            return
+
+        content = instance.review_index.get_json(bug_id, attachment_id)
+        if content is None:
+            # The response came from the cache, and the bug has since
+            # been dropped from the index
+            instance.review_index.update(response.body)
+            content = instance.review_index.get_json(bug_id, attachment_id)
+        if content is None:
+            self.send_error(404, "No bug %d" % bug_id)
+            return
+
+        self.send_json_response(json_response(content))
+
+    # Serve the XML of several bugs as one document, as show_bug.cgi does
+    # for ?id=<bug ID>&id=<bug ID>...&ctype=xml, for pages listing many
+    # bugs; excludefield=<field> can be given as for show_bug.cgi. The
+    # bugs are fetched from Bugzilla together rather than one request
+    # each; see Instance.fetch_bugs().
+    def do_bugs(self):
+        self.cache_attachment_id = None
+
+        query = urlparse.parse_qs(urlsplit(self.path).query)
+        bug_ids = []
+        for value in query.get('id', []):
+            for bug_id in value.split(','):
+                if not bug_id.isdigit():
+                    self.send_error(400, "Bad bug ID")
+                    return
+                if not int(bug_id) in bug_ids:
+                    bug_ids.append(int(bug_id))
+        if len(bug_ids) == 0:
+            self.send_error(400, "No bug IDs")
+            return
+        max_ids = self.instance.config_value('bug_batch_max_ids', 500)
+        if len(bug_ids) > max_ids:
+            self.send_error(400, "Too many bug IDs (at most %d)" % max_ids)
+            return
+
+        self.send_json_response(self.instance.fetch_bugs(bug_ids, query.get('excludefield', [])))
+
+    # The draft storage API used by ProxyReviewStorage in
+    # js/reviewStorage.js; see draft_store.py.
+    #
+    #  GET ?offset=<n>&limit=<n>: {"reviews": [...], "total": <n>}
+    #  GET ?bug=<id>&attachment=<id>: the review, with the text of the draft
+    #  POST ?bug=<id>&attachment=<id>: create or update the review, setting
+    #    the properties in the JSON object in the body; returns the review
+    #  POST ?bug=<id>&attachment=<id>&delete=1: delete the review
+    def do_drafts(self):
+        self.cache_attachment_id = None
+
+        if self.instance.draft_store is None:
+            self.send_error(404, "Draft storage is not enabled")
+            return
+
+        query = urlparse.parse_qs(urlsplit(self.path).query)
+        params = {}
+        for name in ('bug', 'attachment', 'offset', 'limit'):
+            if query.get(name) is not None:
+                if len(query[name]) != 1 or not query[name][0].isdigit():
+                    self.send_error(400, "Bad %s" % name)
+                    return
+                params[name] = int(query[name][0])
+        have_review = 'bug' in params and 'attachment' in params
+
+        try:
+            if self.command == 'GET' and have_review:
+                result = self.instance.draft_store.get(params['bug'], params['attachment'])
+                if result is None:
+                    self.send_error(404, "No review of attachment %d" % params['attachment'])
+                    return
+            elif self.command == 'GET':
+                reviews, total = self.instance.draft_store.list(params.get('offset', 0), params.get('limit'))
+                result = { 'reviews': reviews, 'total': total }
+            elif not have_review:
+                self.send_error(400, "Bug and attachment are required")
+                return
+            elif query.get('delete') == ['1']:
+                result = { 'deleted': self.instance.draft_store.delete(params['bug'], params['attachment']) }
+            else:
+                body = self.get_request_body([])
+                if hasattr(body, 'read'):
+                    body = body.read(self.instance.config_value('max_request_body_size', 32 * 1024 * 1024))
+                try:
+                    props = json.loads(body or '')
+                except ValueError:
+                    self.send_error(400, "Bad JSON in request body")
+                    return
+                if not isinstance(props, dict):
+                    self.send_error(400, "Request body must be a JSON object")
+                    return
+                result = self.instance.draft_store.update(params['bug'], params['attachment'], props)
+        except RequestBodyError, e:
+            self.send_error(e.code, e.message)
+            return
+        except DraftStoreError, e:
+            self.send_error(400, str(e))
+            return
+
+        content = json.dumps(result, separators=(',', ':'), sort_keys=True)
+        self.send_response(200, "OK")
+        self.send_header("Content-type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(content)
+        metrics.inc('splinter_bytes_out_total', len(content), peer='client')
+
+    # Make the proxy look at the static file ?path=<path> again right away
+    # instead of waiting for static_check_interval; for flattener.py
+    def do_invalidate(self):
+        self.cache_attachment_id = None
+
+        # Only for tools running on the same machine as the proxy
+        if not self.client_address[0] in ('127.0.0.1', '::1'):
+            self.send_error(403, "Forbidden")
+            return
+
+        query = urlparse.parse_qs(urlsplit(self.path).query)
+        if query.get('path') is None or len(query['path']) != 1:
+            self.send_error(400, "Bad path")
+            return
+
+        static_files.invalidate(self.translate_path(query['path'][0]))
+
+        self.send_response(204, "No Content")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # Relay a BufferedResponse made by json_response(), or answer 304 if
+    # the client already has it
+    def send_json_response(self, response):
+        etag = response.getheader('etag')
+        if response.status == 200 and self.is_not_modified(etag, None):
+            self.send_response(304, "Not Modified")
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
 
-        self.wfile.close()
+        self.relay_response(response)
 
     # Overrides
 
     def version_string(self):
         return "splinter_proxy.py 0.1"
 
+    def setup(self):
+        SimpleHTTPRequestHandler.setup(self)
+        # Our writes are already buffered into as few as possible
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Handle requests on the connection until the client or we close it;
+    # between requests, wait at most client_idle_timeout seconds for the
+    # next one
+    def handle(self):
+        metrics.inc('splinter_client_connections_total')
+        self.requests_handled = 0
+        self.close_connection = 0
+        while not self.close_connection:
+            self.waiting_for_request = True
+            if not self.wait_for_request():
+                break
+            self.connection.settimeout(config_value('client_idle_timeout', 5))
+            self.handle_one_request()
+
+    # Wait for the client to start sending another request on a connection
+    # kept open; returns False if the connection should be closed instead,
+    # because the client has been idle for client_idle_timeout seconds, or
+    # because this idle connection is holding a worker thread that other
+    # connections are waiting for. The server is checked for those every
+    # IDLE_POLL_INTERVAL seconds.
+    def wait_for_request(self):
+        # The first request on a connection, and requests the client has
+        # already sent and rfile has buffered, can be read straight away
+        if self.requests_handled == 0 or self.rfile._rbuf.tell() > 0:
+            return True
+
+        deadline = time.time() + config_value('client_idle_timeout', 5)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                readable, _, _ = select.select([self.connection], [], [],
+                                               min(remaining, IDLE_POLL_INTERVAL))
+            except (select.error, socket.error):
+                return False
+            if len(readable) > 0:
+                return True
+            if not self.server.should_keep_alive():
+                metrics.inc('splinter_client_idle_closed_total')
+                return False
+
+    # Whether to keep the connection open after the current request
+    def keep_alive_allowed(self):
+        if not config_value('client_keep_alive', True):
+            return False
+        if self.requests_handled >= config_value('client_max_requests', 100):
+            return False
+        return self.server.should_keep_alive()
+
+    # Called once the request line has been read
+    def parse_request(self):
+        self.waiting_for_request = False
+        self.connection.settimeout(None)
+        self.response_code = None
+        self.response_framed = False
+        self.response_connection_header = False
+
+        if not SimpleHTTPRequestHandler.parse_request(self):
+            return False
+
+        self.requests_handled += 1
+        if not self.keep_alive_allowed():
+            self.close_connection = 1
+
+        # We only read the body of POST requests; if a body could be left
+        # unread, the connection can't be used for another request
+        content_length = self.headers.getheader('content-length')
+        if self.command != 'POST' and (self.headers.getheader('transfer-encoding') is not None or
+                                       (content_length is not None and content_length.strip() != '0')):
+            self.close_connection = 1
+
+        return True
+
+    def log_error(self, format, *args):
+        # A client closing an idle connection isn't worth logging
+        if self.waiting_for_request:
+            return
+        SimpleHTTPRequestHandler.log_error(self, format, *args)
+
+    def send_response(self, code, message=None):
+        self.response_code = code
+        self.response_framed = False
+        self.response_connection_header = False
+        SimpleHTTPRequestHandler.send_response(self, code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() in ('content-length', 'transfer-encoding'):
+            self.response_framed = True
+        elif keyword.lower() == 'connection':
+            self.response_connection_header = True
+        SimpleHTTPRequestHandler.send_header(self, keyword, value)
+
+    def end_headers(self):
+        # Without a Content-Length or chunking, the end of the body can
+        # only be marked by closing the connection
+        if not (self.response_framed or self.command == 'HEAD' or
+                self.response_code in (204, 304) or self.response_code < 200):
+            self.close_connection = 1
+
+        if not self.response_connection_header:
+            if self.close_connection:
+                if self.request_version == 'HTTP/1.1':
+                    self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+
+        SimpleHTTPRequestHandler.end_headers(self)
+
+    # Handle the request with serve(), keeping statistics,
+    # and profiling it if requested; see profiling.py
+    def dispatch(self, serve):
+        self.path, profile = request_profiler.check(self.path, self.headers)
+        description = "%s %s" % (self.command, self.path)
+        self.instance, self.path = find_instance(self.headers.getheader('host'), self.path)
+        if not self.path.startswith('/'):
+            serve = self.redirect_to_prefix
+        route = get_route(self.path)
+        metrics.add_gauge('splinter_requests_in_flight', 1, route=route)
+        start = time.time()
+        request = request_profiler.start(profile)
+        try:
+            serve()
+        finally:
+            request_profiler.finish(request, route, description, self.response_code)
+            metrics.add_gauge('splinter_requests_in_flight', -1, route=route)
+            metrics.inc('splinter_requests_total', route=route)
+            metrics.observe('splinter_request_duration_seconds', time.time() - start, route=route)
+
+    # The relative URLs in our pages only work below the proxy_prefix of
+    # the instance, so a request for the prefix itself is redirected
+    def redirect_to_prefix(self):
+        self.send_response(301, "Moved Permanently")
+        self.send_header("Location", self.instance.prefix + "/" + self.path)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
     def do_GET(self):
+        self.dispatch(self.serve_GET)
+
+    def do_HEAD(self):
+        self.dispatch(self.serve_HEAD)
+
+    def do_POST(self):
+        self.dispatch(self.serve_POST)
+
+    def serve_GET(self):
         if is_proxied(self.path):
             self.do_proxied()
         elif self.path == "/config.js":
             self.do_config_js()
-        else:
+        elif path_matches(self.path, STATS_PATH):
+            self.do_stats()
+        elif path_matches(self.path, PARSED_PATCH_PATH):
+            self.do_parsed_patch()
+        elif path_matches(self.path, REVIEWS_PATH):
+            self.do_reviews()
+        elif path_matches(self.path, BUGS_PATH):
+            self.do_bugs()
+        elif path_matches(self.path, DRAFTS_PATH):
+            self.do_drafts()
+        elif not self.send_static():
             SimpleHTTPRequestHandler.do_GET(self)
 
-    def do_HEAD(self):
+    def serve_HEAD(self):
         if is_proxied(self.path):
             self.do_proxied()
         elif self.path == "/config.js":
             self.do_config_js()
-        else:
+        elif not self.send_static():
             SimpleHTTPRequestHandler.do_HEAD(self)
 
-    def do_POST(self):
+    def serve_POST(self):
         if is_proxied(self.path):
             self.do_proxied()
             return
+        elif path_matches(self.path, DRAFTS_PATH):
+            self.do_drafts()
+            return
+        elif path_matches(self.path, INVALIDATE_PATH):
+            self.do_invalidate()
+            return
 
         self.send_error(404, 'Not Found')
 
-# We got a reply to our attempt to log in. If it was succesful
-# it will contain a Set-Cookie
-def check_login_headers(headers):
+def text_response(status, reason, content):
+    return BufferedResponse(status, reason,
+                            [('content-type', 'text/plain'),
+                             ('content-length', str(len(content)))],
+                            content)
+
+def json_response(content):
+    headers = [('content-type', 'application/json; charset=utf-8'),
+               ('content-length', str(len(content))),
+               ('etag', '"%s"' % hashlib.sha1(content).hexdigest())]
+    return BufferedResponse(200, "OK", headers, content)
+
+def attachment_failed_response(attachment_id):
+    return text_response(502, "Bad Gateway",
+                         "Failed to retrieve attachment %d\n" % attachment_id)
+
+def not_a_patch_response(attachment_id):
+    return text_response(400, "Bad Request",
+                         "Attachment %d is not a patch\n" % attachment_id)
+
+# We got a reply to our attempt to log in. If it was succesful it will
+# contain a Set-Cookie; returns cookie_header with the cookies added, or
+# None if there weren't any
+def check_login_headers(headers, cookie_header):
     # The Cookie class is really meant to be used server side; so it has
     # good support for parsing Cookie headers, and generating Set-Cookie
     # headers. We're abusing it here to do "client-side' processing
     # where we need to parse Set-Cookie headers and generate Cookie headers.
-    global login_cookie_header
     login_cookie = None
     for header, value in headers.items():
         if header.lower() == "set-cookie":
             if login_cookie == None:
                 login_cookie = Cookie.SimpleCookie()
             login_cookie.load(value)
-    login_header = ""
     if login_cookie is None:
-        return
+        return None
 
     for key, morsel in login_cookie.iteritems():
-        if login_cookie_header is None:
-            login_cookie_header = ""
+        if cookie_header is None:
+            cookie_header = ""
         else:
-            login_cookie_header += "; "
-        login_cookie_header += key + "=" + morsel.coded_value
+            cookie_header += "; "
+        cookie_header += key + "=" + morsel.coded_value
         # attributes in the Cookie: header are represented as $Attribute
         # to distinguish them from cookie names, since it's:
         # Cookie: name=val; attr=val; attr=val; name=val; attr=val
         if 'path' in morsel and morsel['path'] != '':
-            login_cookie_header += "; $Path=" + Cookie._quote(morsel['path'])
+            cookie_header += "; $Path=" + Cookie._quote(morsel['path'])
         if 'domain' in morsel and morsel['domain'] != '':
-            login_cookie_header += "; $Domain=" + Cookie._quote(morsel['domain'])
+            cookie_header += "; $Domain=" + Cookie._quote(morsel['domain'])
 
+    return cookie_header
 
 # We need to hook in to the raw response received by xmlrpclib to get the
-# cookie headers; we do this with a series of trivial subclasses - we
-# subclass httplib.HTTP[S] to override getreply() and then a subclass
-# of xmlrpclib.Transport to make it create the appropriate connection
-# subclass.
+# cookie headers, and we want XML-RPC calls to share the pooled keep-alive
+# connections used for proxying, so we replace the request() method of
+# xmlrpclib.Transport entirely. With new_session, our cookies aren't
+# sent, and the cookies we get back replace them rather than being added
+# to them, as for logging in again. The cookies are those of instance.
 class LoginTransport(xmlrpclib.Transport):
-    def __init__(self, scheme, hostname, port):
+    def __init__(self, instance, scheme, hostname, port, new_session=False):
         if hasattr(xmlrpclib.Transport, '__init__'):
             xmlrpclib.Transport.__init__(self)
+        self.instance = instance
         self.scheme = scheme
         self.hostname = hostname
         self.port = port
+        self.new_session = new_session
+
+    def request(self, host, handler, request_body, verbose=0):
+        pool = self.instance.get_upstream_pool(self.scheme, self.hostname, self.port)
+
+        headers = [('Content-Type', 'text/xml'),
+                   ('Content-Length', str(len(request_body))),
+                   ('User-Agent', self.user_agent)]
+        cookie_header = None if self.new_session else self.instance.get_login_cookie_header()
+        if cookie_header is not None:
+            headers.append(('Cookie', cookie_header))
+
+        connection, response = pool.request('POST', handler, headers, request_body)
+        try:
+            cookie_header = check_login_headers(response.msg, cookie_header)
+            if cookie_header is not None:
+                self.instance.set_login_cookie_header(cookie_header)
+            if response.status != 200:
+                response.read()
+                raise xmlrpclib.ProtocolError(host + handler,
+                                              response.status, response.reason,
+                                              response.msg)
+
+            self.verbose = verbose
+            parser, unmarshaller = self.getparser()
+            parser.feed(response.read())
+            parser.close()
+
+            return unmarshaller.close()
+        finally:
+            pool.release(connection, response)
+
+# Bugzilla clears the login cookie, by setting it to an empty value,
+# when it doesn't accept it any more
+def session_expired(response):
+    for value in response.msg.getheaders('set-cookie'):
+        cookie = Cookie.SimpleCookie()
+        try:
+            cookie.load(value)
+        except Cookie.CookieError:
+            continue
+        morsel = cookie.get('Bugzilla_logincookie')
+        if morsel is not None and morsel.value == '':
+            return True
+
+    return False
 
-    def make_connection(self, host):
-        if self.scheme == 'http':
-            return LoginConnection(self.hostname, self.port)
+# One of the configurations in config.configs being served: the Bugzilla
+# instance it proxies to, our session with it, and the caches of its
+# data. When several configurations are served from one process, a
+# request is handled by the instance whose proxy_host matches its Host
+# header or whose proxy_prefix its path starts with; see find_instance().
+class Instance:
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        # Simpler to normalize here than to require the config to have
+        # a particular form
+        if not self.config['bugzilla_url'].endswith('/'):
+            self.config['bugzilla_url'] += '/'
+
+        self.host = self.config_value('proxy_host', None)
+        if self.host is not None:
+            self.host = self.host.lower()
+        self.prefix = self.config_value('proxy_prefix', '').rstrip('/')
+        if self.prefix != '' and not self.prefix.startswith('/'):
+            self.prefix = '/' + self.prefix
+
+        # Cookie values we'll send to Bugzilla if logged in; see
+        # get_login_cookie_header()
+        self.login_cookie_header = None
+        # With the fork server engine, a copy in memory shared with the
+        # processes forked for connections, so that a session renewed by
+        # one of them is used by all of them; see start_session()
+        self.shared_login_cookie_header = None
+
+        # Set once logging in at startup has finished, or wasn't
+        # attempted, and once we know whether Bugzilla has the Splinter
+        # extension
+        self.login_done = threading.Event()
+        self.splinter_info_done = threading.Event()
+
+        # Held while logging in again after our session expired
+        self.relogin_lock = threading.Lock()
+
+        # DraftStore, if enabled in the configuration
+        self.draft_store = None
+        if 'draft_store_path' in self.config:
+            self.draft_store = DraftStore(os.path.expanduser(self.config['draft_store_path']))
+
+        self.have_extension = False
+        # Content for config.js and the time it last changed, as a tuple,
+        # so that both can be replaced at once when we find out about the
+        # Splinter extension
+        self.config_js = (self.make_config_js(), time.time())
+
+        # ResponseCache shared by requests for bug XML
+        self.bug_xml_cache = ResponseCache('bug_xml',
+                                           self.config_value('bug_cache_ttl', 0),
+                                           self.config_value('bug_cache_max_entries', 100))
+
+        # RedirectCache of the final locations of attachments, by
+        # attachment ID
+        self.redirect_cache = RedirectCache(self.config_value('redirect_cache_ttl', 300),
+                                            self.config_value('redirect_cache_max_entries', 1000))
+
+        # ResponseCaches of parsed patches and of file-level indexes of
+        # patches, by attachment ID, and of single parsed files of
+        # patches, by (attachment ID, index of the file)
+        self.parsed_patch_cache = ResponseCache('parsed_patch',
+                                                self.config_value('parsed_patch_cache_ttl', 3600),
+                                                self.config_value('parsed_patch_cache_max_entries', 20))
+        self.patch_index_cache = ResponseCache('patch_index',
+                                               self.config_value('parsed_patch_cache_ttl', 3600),
+                                               self.config_value('patch_index_cache_max_entries', 100))
+        self.parsed_file_cache = ResponseCache('parsed_file',
+                                               self.config_value('parsed_patch_cache_ttl', 3600),
+                                               self.config_value('parsed_file_cache_max_entries', 1000))
+
+        # ReviewIndex of the reviews on the bugs we've seen
+        self.review_index = ReviewIndex(self.config_value('review_index_max_bugs', 100))
+
+        # AttachmentCache, if enabled in the configuration
+        self.attachment_cache = None
+        if 'attachment_cache_dir' in self.config:
+            self.attachment_cache = AttachmentCache(os.path.expanduser(self.config['attachment_cache_dir']),
+                                                    self.config_value('attachment_cache_size', 256 * 1024 * 1024))
+
+        # Prefetcher for patch attachments, if enabled in the configuration
+        self.prefetcher = None
+        if self.config_value('prefetch_attachments', False):
+            if self.attachment_cache is None:
+                print >>sys.stderr, "Not prefetching attachments for %s: attachment_cache_dir is not set" % self.name
+            else:
+                self.prefetcher = Prefetcher(self.fetch_attachment_to_cache, self.is_attachment_cached,
+                                             self.config_value('prefetch_max_concurrent', 2),
+                                             self.config_value('prefetch_max_per_bug', 5))
+
+    # Look up an optional setting in the configuration
+    def config_value(self, key, default):
+        if key in self.config:
+            return self.config[key]
         else:
-            return LoginConnectionS(self.hostname, self.port)
-
-    def send_request(self, connection, handler, request_body):
-        xmlrpclib.Transport.send_request(self, connection, handler, request_body)
-        if login_cookie_header is not None:
-            connection.putheader('Cookie', login_cookie_header)
-
-class LoginConnection(httplib.HTTP):
-    def getreply(self):
-        errcode, errmsg, headers = httplib.HTTP.getreply(self)
-        check_login_headers(headers)
-        return errcode, errmsg, headers
-
-class LoginConnectionS(httplib.HTTPS):
-    def getreply(self):
-        errcode, errmsg, headers = httplib.HTTPS.getreply(self)
-        check_login_headers(headers)
-        return errcode, errmsg, headers
-
-# Try to log in; we log in once every time the proxy is started, and don't
-# try to remember our cookies. Cookies will be deleted from the server
-# after 30 days of non-use.
-def login(xmlrpc):
-    try:
-        # 'remember: 0' basically just causes the server not to send an
-        # Expires: parameter with the cookie, but it serves as a hint
-        # to our intent if Bugzilla's login cookie handling chanes
-        xmlrpc.User.login({ 'login': current_config['bugzilla_login'],
-                            'password': current_config['bugzilla_password'],
-                            'remember': 0 })
-        print >>sys.stderr, "Successfully logged into %s" % current_config['bugzilla_url']
-    except xmlrpclib.Fault, e:
-        print >>sys.stderr, "Can't log in to %s: %s" % (current_config['bugzilla_url'],
-                                                        e.faultString)
-    except xmlrpclib.ProtocolError, e:
-        print >>sys.stderr, "Can't log in to %s: %d %s" % (current_config['bugzilla_url'],
-                                                           e.errcode,
-                                                           e.errmsg)
-    except (socket.error, socket.herror, socket.gaierror), e:
-        print >>sys.stderr, "Can't log in to %s: %s" % (current_config['bugzilla_url'],
-                                                        e.args[1])
-
-def get_splinter_info(xmlrpc):
-    try:
-        return xmlrpc.Splinter.info()
-    except xmlrpclib.Fault, e:
-        # Probably simply no extension
-        pass
-    except xmlrpclib.ProtocolError, e:
-        print >>sys.stderr, "Can't get splinter extension info: %d %s" % (e.errcode,
-                                                                          e.errmsg)
-    except (socket.error, socket.herror, socket.gaierror), e:
-        print >>sys.stderr, "Can't get splinter extension info %s: %s" % (current_config['bugzilla_url'],
-                                                                          e.args[1])
-
-    return None
-
-def make_config_js():
-    if 'bugzilla_login' in current_config and 'bugzilla_login' in current_config:
-        note = ''
-    else:
-        note = 'This is a read-only demo instance of Splinter; you will not be able to publish your reviews'
+            return default
+
+    # Whether the configuration has us running without a Bugzilla login
+    def running_anonymously(self):
+        return not ('bugzilla_login' in self.config and 'bugzilla_password' in self.config)
+
+    # Get our pool of keep-alive connections to an upstream server
+    def get_upstream_pool(self, scheme, hostname, port):
+        return connection_pool.get_pool(scheme, hostname, port,
+                                        self.config_value('upstream_pool_size', 4),
+                                        self.config_value('upstream_idle_timeout', 15),
+                                        namespace=self.name)
+
+    # Convert an URL we received from a client to all the information we'll
+    # need to proxy to the Bugzilla server - host, port, new path, etc.
+    def get_proxy_info(self, path):
+        split = urlsplit(self.config['bugzilla_url'])
+        if split.port:
+            portstr = ":" + str(split.port)
+        else:
+            portstr = ""
+        port = port_from_scheme(split.scheme, split.port)
 
-    if have_extension:
-        have_extension_value = 'true';
-    else:
-        have_extension_value = 'false';
+        proxy_path = split.path + path[1:] # Chop leading / off of path
+
+        url = "%s://%s%s%s" % (split.scheme, split.hostname,
+                               portstr, proxy_path)
+
+        return split.scheme, split.hostname, port, proxy_path, url
+
+    # Request the contents of an attachment from Bugzilla, following redirects
+    # to the attachment_base host, and going directly to the location we were
+    # last redirected to if there is one in redirect_cache. Returns (pool,
+    # connection, response) for the final response; the caller must read the
+    # response and then release the connection to the pool.
+    def request_attachment(self, attachment_id):
+        proxy_scheme, proxy_hostname, proxy_port, proxy_path, proxy_url = \
+            self.get_proxy_info("/attachment.cgi?id=%d" % attachment_id)
+        seen_urls = [proxy_url]
+        cached_url = self.redirect_cache.lookup(attachment_id)
+        url = cached_url or proxy_url
+        renewed_session = False
+        while True:
+            split = urlsplit(url)
+            port = port_from_scheme(split.scheme, split.port)
+            pool = self.get_upstream_pool(split.scheme, split.hostname, port)
+            relative = urlparse.urlunsplit((None, None, split.path, split.query, split.fragment))
+
+            headers = self.get_login_headers()
+
+            connection, response = pool.request('GET', relative, headers)
+            if not renewed_session and self.renew_session(response, headers):
+                renewed_session = True
+                try:
+                    response.read()
+                finally:
+                    pool.release(connection, response)
+                connection, response = pool.request('GET', relative, headers)
+
+            location = response.getheader('location')
+            if url == cached_url and response.status != 200:
+                # Forget the cached location and start over
+                next_url = proxy_url
+                self.redirect_cache.invalidate(attachment_id, cached_url)
+                cached_url = None
+            elif (response.status in (302, 303) and location and
+                  not (location in seen_urls or len(seen_urls) >= 10)):
+                next_url = location
+                seen_urls.append(location)
+            else:
+                if response.status == 200 and url != proxy_url:
+                    self.redirect_cache.store(attachment_id, url)
+                return pool, connection, response
+
+            try:
+                response.read()
+            finally:
+                pool.release(connection, response)
+            url = next_url
+
+    # Fetch the XML for a bug from Bugzilla; returns a BufferedResponse. The
+    # patches of the bug are prefetched (unless prefetch is False), and the
+    # reviews of the bug indexed.
+    def fetch_bug_xml(self, pool, path, headers, prefetch=True):
+        connection, response = pool.request('GET', path, headers)
+        if self.renew_session(response, headers):
+            try:
+                response.read()
+            finally:
+                pool.release(connection, response)
+            connection, response = pool.request('GET', path, headers)
+
+        try:
+            response = read_response(response)
+        finally:
+            pool.release(connection, response)
+
+        if response.status == 200:
+            if self.prefetcher is not None and prefetch:
+                self.prefetcher.schedule_bug(response.body)
+            self.review_index.update(response.body)
+
+        return response
+
+    # Get the XML of several bugs as one document with a <bug> element for
+    # each, in the order of bug_ids; returns a BufferedResponse. When
+    # running anonymously, bugs in bug_xml_cache are taken from there; the
+    # rest are fetched with show_bug.cgi, bug_batch_size bugs per request,
+    # and each bug is added to bug_xml_cache as if fetched on its own.
+    # Patches aren't prefetched for bugs fetched this way.
+    def fetch_bugs(self, bug_ids, exclude_fields):
+        def get_query(ids):
+            params = ["id=%d" % bug_id for bug_id in ids] + ["ctype=xml"]
+            params += ["excludefield=%s" % urllib.quote_plus(field) for field in exclude_fields]
+            return "/show_bug.cgi?" + "&".join(params)
+
+        use_cache = self.running_anonymously()
+        prolog = None
+        content_type = None
+        elements = {}
+
+        missing = []
+        for bug_id in bug_ids:
+            response = None
+            if use_cache:
+                response = self.bug_xml_cache.lookup(self.get_proxy_info(get_query([bug_id]))[3])
+            if response is None:
+                missing.append(bug_id)
+                continue
+            try:
+                response_prolog, bugs = bug_xml.split_bugs(response.body)
+            except bug_xml.BugXmlError:
+                bugs = []
+            for element_bug_id, error, element in bugs:
+                if element_bug_id == bug_id:
+                    elements[bug_id] = element
+            if not bug_id in elements:
+                missing.append(bug_id)
+            elif prolog is None:
+                prolog = response_prolog
+                content_type = response.getheader('content-type')
+
+        batch_size = self.config_value('bug_batch_size', 50)
+        for i in xrange(0, len(missing), batch_size):
+            proxy_scheme, proxy_hostname, proxy_port, proxy_path, proxy_url = \
+                self.get_proxy_info(get_query(missing[i:i + batch_size]))
+            pool = self.get_upstream_pool(proxy_scheme, proxy_hostname, proxy_port)
+            response = self.fetch_bug_xml(pool, proxy_path, self.get_login_headers(), prefetch=False)
+            if response.status != 200:
+                return text_response(502, "Bad Gateway", "Failed to retrieve bugs\n")
+            try:
+                response_prolog, bugs = bug_xml.split_bugs(response.body)
+            except bug_xml.BugXmlError:
+                return text_response(502, "Bad Gateway", "Failed to retrieve bugs\n")
+
+            headers = [(header, value) for header, value in response.getheaders()
+                       if not header.lower() in ('content-length', 'etag', 'last-modified', 'set-cookie')]
+            for bug_id, error, element in bugs:
+                if bug_id is None or not bug_id in missing:
+                    continue
+                elements[bug_id] = element
+                if use_cache and not error:
+                    content = bug_xml.join_bugs(response_prolog, [element])
+                    self.bug_xml_cache.store(self.get_proxy_info(get_query([bug_id]))[3],
+                                             BufferedResponse(200, "OK",
+                                                              headers + [('content-length', str(len(content)))],
+                                                              content))
+            if prolog is None:
+                prolog = response_prolog
+                content_type = response.getheader('content-type')
+
+        content = bug_xml.join_bugs(prolog,
+                                    [elements[bug_id] for bug_id in bug_ids if bug_id in elements])
+        headers = [('content-type', content_type or 'text/xml'),
+                   ('content-length', str(len(content))),
+                   ('etag', '"%s"' % hashlib.sha1(content).hexdigest())]
+        return BufferedResponse(200, "OK", headers, content)
+
+    # Fetch an attachment from Bugzilla into the attachment cache; used for
+    # prefetching
+    def fetch_attachment_to_cache(self, attachment_id):
+        pool, connection, response = self.request_attachment(attachment_id)
+        try:
+            if response.status != 200:
+                response.read()
+            else:
+                cache_writer = self.attachment_cache.begin_store(attachment_id, response)
+                try:
+                    while True:
+                        data = response.read(64 * 1024)
+                        if not data:
+                            break
+                        cache_writer.write(data)
+                except:
+                    cache_writer.abort()
+                    raise
+                cache_writer.commit()
+        finally:
+            pool.release(connection, response)
+
+    # Call func with the contents of an attachment, from the attachment cache
+    # if it's enabled, in which case func gets an mmap of the cached file;
+    # returns (status, result of func), with None for the result if the
+    # attachment couldn't be retrieved
+    def with_attachment_data(self, attachment_id, func):
+        if self.attachment_cache is not None:
+            if self.prefetcher is not None:
+                self.prefetcher.wait(attachment_id, self.config_value('prefetch_wait_timeout', 30))
+            if not self.is_attachment_cached(attachment_id):
+                self.fetch_attachment_to_cache(attachment_id)
+            entry = self.attachment_cache.lookup(attachment_id)
+            if entry is not None:
+                try:
+                    f = self.attachment_cache.open(entry)
+                except IOError:
+                    pass
+                else:
+                    try:
+                        if entry['size'] == 0:
+                            return 200, func('')
+                        data = mmap.mmap(f.fileno(), entry['size'], access=mmap.ACCESS_READ)
+                        try:
+                            return 200, func(data)
+                        finally:
+                            data.close()
+                    finally:
+                        f.close()
+
+        pool, connection, response = self.request_attachment(attachment_id)
+        try:
+            response = read_response(response)
+        finally:
+            pool.release(connection, response)
+
+        if response.status != 200:
+            return response.status, None
+        return response.status, func(response.body)
+
+    # Get the contents of an attachment; returns (status, data)
+    def get_attachment_data(self, attachment_id):
+        return self.with_attachment_data(attachment_id, lambda data: data[:])
+
+    # Get an attachment and parse it as a patch; returns a BufferedResponse
+    # with the compact JSON form of the patch, or an error
+    def fetch_parsed_patch(self, attachment_id):
+        status, data = self.get_attachment_data(attachment_id)
+        if status != 200:
+            return attachment_failed_response(attachment_id)
+
+        try:
+            content = patch_parser.parse_to_json(data)
+        except patch_parser.PatchError, e:
+            return not_a_patch_response(attachment_id)
+
+        return json_response(content)
+
+    # Get the file-level index of a patch (see patch_index.py); returns a
+    # BufferedResponse with the index as JSON, or an error
+    def fetch_patch_index(self, attachment_id):
+        try:
+            status, index = self.with_attachment_data(attachment_id, patch_index.build_index)
+        except patch_parser.PatchError, e:
+            return not_a_patch_response(attachment_id)
+        if status != 200:
+            return attachment_failed_response(attachment_id)
+
+        return json_response(patch_index.to_json(index))
+
+    # Parse a single file of a patch, found using the index of the patch;
+    # returns a BufferedResponse with the compact JSON form of the file,
+    # or an error
+    def fetch_parsed_file(self, attachment_id, file_index):
+        response = self.patch_index_cache.get(attachment_id,
+                                              lambda extra_headers: self.fetch_patch_index(attachment_id))
+        if response.status != 200:
+            return response
+
+        files = json.loads(response.body)['files']
+        if file_index >= len(files):
+            return text_response(404, "Not Found",
+                                 "Attachment %d has no file %d\n" % (attachment_id, file_index))
+
+        try:
+            status, f = self.with_attachment_data(attachment_id,
+                                                  lambda data: patch_index.parse_file(data, files[file_index]))
+        except patch_parser.PatchError, e:
+            return not_a_patch_response(attachment_id)
+        if status != 200:
+            return attachment_failed_response(attachment_id)
+
+        return json_response(patch_index.to_json(f))
+
+    def is_attachment_cached(self, attachment_id):
+        return self.attachment_cache.lookup(attachment_id) is not None
+
+    def make_xmlrpc(self, new_session=False):
+        proxy_scheme, proxy_hostname, proxy_port, proxy_path, proxy_url = self.get_proxy_info("/xmlrpc.cgi")
+        transport = LoginTransport(self, proxy_scheme, proxy_hostname, proxy_port, new_session)
+        return xmlrpclib.ServerProxy(proxy_url, transport)
+
+    # Whether we should log in with the login and password in the
+    # configuration
+    def can_log_in(self):
+        if self.running_anonymously():
+            return False
+
+        # anybody connecting to the proxy can do ABSOLUTELY ANYTHING
+        # with your bugzilla account.
+        return config_value('proxy_bind', '127.0.0.1') == '127.0.0.1'
+
+    # Try to log in; we log in every time the proxy is started, and again
+    # when Bugzilla stops accepting our cookies, and don't try to remember
+    # them. Cookies will be deleted from the server after 30 days of
+    # non-use. Returns True if we logged in.
+    def login(self):
+        try:
+            # 'remember: 0' basically just causes the server not to send an
+            # Expires: parameter with the cookie, but it serves as a hint
+            # to our intent if Bugzilla's login cookie handling chanes
+            self.make_xmlrpc(new_session=True).User.login({ 'login': self.config['bugzilla_login'],
+                                                            'password': self.config['bugzilla_password'],
+                                                            'remember': 0 })
+            print >>sys.stderr, "Successfully logged into %s" % self.config['bugzilla_url']
+            metrics.inc('splinter_logins_total', result='success')
+            return True
+        except xmlrpclib.Fault, e:
+            print >>sys.stderr, "Can't log in to %s: %s" % (self.config['bugzilla_url'],
+                                                            e.faultString)
+        except xmlrpclib.ProtocolError, e:
+            print >>sys.stderr, "Can't log in to %s: %d %s" % (self.config['bugzilla_url'],
+                                                               e.errcode,
+                                                               e.errmsg)
+        except (socket.error, socket.herror, socket.gaierror), e:
+            print >>sys.stderr, "Can't log in to %s: %s" % (self.config['bugzilla_url'],
+                                                            e.args[-1])
+
+        metrics.inc('splinter_logins_total', result='failure')
+        return False
+
+    def get_login_cookie_header(self):
+        if self.shared_login_cookie_header is not None and self.shared_login_cookie_header.value:
+            return self.shared_login_cookie_header.value
+        return self.login_cookie_header
+
+    def set_login_cookie_header(self, cookie_header):
+        self.login_cookie_header = cookie_header
+        if self.shared_login_cookie_header is not None:
+            # Too long to share is too unlikely to do better than each
+            # process keeping its own
+            if len(cookie_header) < len(self.shared_login_cookie_header):
+                self.shared_login_cookie_header.value = cookie_header
+            else:
+                self.shared_login_cookie_header.value = ''
+
+    # Get the Cookie header to send to Bugzilla, as a list of headers that
+    # is empty if we aren't logged in. Until logging in at startup has
+    # finished, we wait for it, up to startup_wait_timeout seconds.
+    def get_login_headers(self):
+        self.login_done.wait(self.config_value('startup_wait_timeout', 10))
+        cookie_header = self.get_login_cookie_header()
+        if cookie_header is None:
+            return []
+
+        return [('Cookie', cookie_header)]
+
+    # If response shows that the session for the cookies in headers (which
+    # the request was made with) has expired, log in again, and update
+    # headers for the new session. Returns True if the request should be
+    # made again with the updated headers. (With the fork server engine,
+    # the new session is shared with the other processes; see
+    # start_session().)
+    def renew_session(self, response, headers):
+        expired_cookie_header = dict(headers).get('Cookie')
+        if expired_cookie_header is None or not session_expired(response):
+            return False
+
+        self.relogin_lock.acquire()
+        try:
+            # Only log in once when several requests find that the session
+            # has expired
+            if self.get_login_cookie_header() == expired_cookie_header:
+                print >>sys.stderr, "Session with %s expired; logging in again" % self.config['bugzilla_url']
+                if not self.login():
+                    return False
+        finally:
+            self.relogin_lock.release()
+
+        headers[:] = [(header, value) for header, value in headers if header != 'Cookie']
+        headers.extend(self.get_login_headers())
+        return True
+
+    def get_splinter_info(self):
+        try:
+            return self.make_xmlrpc().Splinter.info()
+        except xmlrpclib.Fault, e:
+            # Probably simply no extension
+            pass
+        except xmlrpclib.ProtocolError, e:
+            print >>sys.stderr, "Can't get splinter extension info: %d %s" % (e.errcode,
+                                                                              e.errmsg)
+        except (socket.error, socket.herror, socket.gaierror), e:
+            print >>sys.stderr, "Can't get splinter extension info %s: %s" % (self.config['bugzilla_url'],
+                                                                              e.args[-1])
+
+        return None
+
+    # Log in, and find out whether Bugzilla has the Splinter extension, in
+    # parallel and in the background, so that the proxy can start serving
+    # static files at once even if Bugzilla is slow or unreachable. Returns
+    # the threads doing this. With the fork server engine (forking=True),
+    # the processes forked for connections wouldn't see what the threads
+    # do once they've been forked, so the caller waits for the threads
+    # before serving, and the session is shared between the processes.
+    def start_session(self, forking=False):
+        if forking:
+            self.shared_login_cookie_header = multiprocessing.Array('c', MAX_SHARED_COOKIE_HEADER)
+
+        def do_login():
+            try:
+                if self.can_log_in():
+                    self.login()
+                elif not self.running_anonymously():
+                    print >>sys.stderr, "proxy_bind is '%s' not '127.0.0.1" % config_value('proxy_bind', '127.0.0.1')
+                    print >>sys.stderr, "Refusing to log in with private login/password"
+                if self.get_login_cookie_header() is None:
+                    print >>sys.stderr, "Proxying to %s anonymously" % (self.config['bugzilla_url'])
+            finally:
+                self.login_done.set()
+
+        def do_splinter_info():
+            try:
+                splinter_info = self.get_splinter_info()
+                if splinter_info:
+                    extension_version = splinter_info['version']
+
+                    if extension_version < 1:
+                        print >>sys.stderr, "Too old splinter extension found on %s" % self.config['bugzilla_url']
+                    else:
+                        print >>sys.stderr, "Splinter extension found on %s, version %d" % (self.config['bugzilla_url'],
+                                                                                           extension_version)
+                        self.have_extension = True
+                        if splinter_info['logged_in']:
+                            print "Login=%s, Name=%s" % (splinter_info['login'], splinter_info['name'])
+                else:
+                    print >>sys.stderr, "No Splinter extension found on %s" % self.config['bugzilla_url']
+
+                if self.have_extension:
+                    self.config_js = (self.make_config_js(), time.time())
+            finally:
+                self.splinter_info_done.set()
+
+        threads = []
+        for target in (do_login, do_splinter_info):
+            thread = threading.Thread(target=target)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        return threads
 
-    # configAttachmentStatuses is just hardcoded here to the values for bugzilla.gnome.org
-    # which is the only Bugzilla instance I'm aware of using attachment statuses. It
-    # could be added to config.py if needed.
-    return """\
+    def make_config_js(self):
+        if not self.running_anonymously():
+            note = ''
+        else:
+            note = 'This is a read-only demo instance of Splinter; you will not be able to publish your reviews'
+
+        if self.have_extension:
+            have_extension_value = 'true';
+        else:
+            have_extension_value = 'false';
+
+        # configAttachmentStatuses is just hardcoded here to the values for bugzilla.gnome.org
+        # which is the only Bugzilla instance I'm aware of using attachment statuses. It
+        # could be added to config.py if needed.
+        return """\
 configAttachmentStatuses = [
     'none',
     'accepted-commit_now',
@@ -405,11 +2119,17 @@ configBugzillaUrl = '%(bugzilla_url)s';
 configHaveExtension = %(have_extension)s;
 configHelp = 'help.html';
 configNote = '%(note)s';
+configDraftStorageUrl = %(draft_storage_url)s;
+configParsedPatchUrl = '%(parsed_patch_url)s';
+configUrlPrefix = '%(url_prefix)s';
 """ % {
-        'bugzilla_url': current_config['bugzilla_url'],
-        'have_extension': have_extension_value,
-        'note': note
-      }
+            'bugzilla_url': self.config['bugzilla_url'],
+            'have_extension': have_extension_value,
+            'draft_storage_url': "'%s'" % (self.prefix + DRAFTS_PATH) if self.draft_store is not None else 'null',
+            'note': note,
+            'parsed_patch_url': self.prefix + PARSED_PATCH_PATH,
+            'url_prefix': self.prefix
+          }
 
 def redirect_to_log(log_file):
     outf = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
@@ -444,6 +2164,7 @@ def daemonize():
 
 # SimpleHTTPRequestHandler serves files relative to the current working directory
 # so chdir to our document root (../web)
+invocation_dir = os.getcwd()
 script_path = os.path.realpath(os.path.abspath(sys.argv[0]))
 top_dir = os.path.dirname(os.path.dirname(script_path))
 os.chdir(os.path.join(top_dir, "web"))
@@ -455,9 +2176,18 @@ parser.add_option("", "--pid-file",
                   help="location to write PID of daemon")
 parser.add_option("-l", "--log", metavar="<log file>",
                   help="file to log to")
+parser.add_option("-c", "--config", metavar="<config file>",
+                  help="configuration file to use instead of config.py")
+parser.add_option("-a", "--all", action='store_true',
+                  help="serve all the configurations in the configuration file")
 
 options, args = parser.parse_args()
 
+if options.config:
+    config = imp.load_source('config', os.path.join(invocation_dir, options.config))
+else:
+    import config
+
 if options.log:
     redirect_to_log(options.log)
 
@@ -471,65 +2201,73 @@ if options.daemonize:
         except IOError, e:
             print >>sys.stderr, "Cannot write pid to '%s': %s" % (options.pid_file, e.args[1])
 
-if len(args) == 0:
-    config_name = config.default_config
-elif len(args) == 1:
-    config_name = args[1]
-else:
-    print >>sys.stderr, "Usage: splinter_proxy.py [--daemonize] [--log=<logfile>] [<config_name>]"
-    sys.exit(1)
-
-if not config_name in config.configs:
-    print >>sys.stderr, "Usage: Configuration name '%s' is not defined in config.py" % config_name
-    sys.exit(1)
-
-current_config = config.configs[config_name]
-# Simpler to normalize here than to require the config to have
-# a particular form
-if not current_config['bugzilla_url'].endswith('/'):
-    current_config['bugzilla_url'] += '/'
-
-proxy_scheme, proxy_hostname, proxy_port, proxy_path, proxy_url = get_proxy_info("/xmlrpc.cgi")
-transport = LoginTransport(proxy_scheme, proxy_hostname, proxy_port)
-xmlrpc = xmlrpclib.ServerProxy(proxy_url, transport)
-
-if 'bugzilla_login' in current_config and 'bugzilla_login' in current_config:
-    if 'proxy_bind' in current_config and current_config['proxy_bind'] != '127.0.0.1':
-        # anybody connecting to the proxy can do ABSOLUTELY ANYTHING
-        # with your bugzilla account.
-        print >>sys.stderr, "proxy_bind is '%s' not '127.0.0.1" % current_config['proxy_bind']
-        print >>sys.stderr, "Refusing to log in with private login/password"
-    else:
-        login(xmlrpc)
-
-if login_cookie_header is None:
-    print >>sys.stderr, "Proxying to %s anonymously" % (current_config['bugzilla_url'])
-
-have_extension = False
-splinter_info = get_splinter_info(xmlrpc)
-if splinter_info:
-    extension_version = splinter_info['version']
-
-    if extension_version < 1:
-        print >>sys.stderr, "Too old splinter extension found"
-    else:
-        print >>sys.stderr, "Splinter extension found, version %d" % extension_version
-        have_extension = True
-        if splinter_info['logged_in']:
-            print "Login=%s, Name=%s" % (splinter_info['login'], splinter_info['name'])
+if options.all:
+    # The default configuration first, so that it handles the requests
+    # that don't match any other
+    config_names = [config.default_config] + sorted(name for name in config.configs
+                                                    if name != config.default_config)
+elif len(args) == 0:
+    config_names = [config.default_config]
 else:
-    print >>sys.stderr, "No Splinter extension found"
-
-config_js_content = make_config_js()
-
-proxy_bind = '127.0.0.1'
-proxy_port = 23080
-if 'proxy_bind' in current_config:
-    proxy_bind = current_config['proxy_bind']
-if 'proxy_port' in current_config:
-    proxy_port = current_config['proxy_port']
-
-print >>sys.stderr, "Running as http://%s:%d/index.html" % (proxy_bind, proxy_port)
-
-httpd = HTTPServer((proxy_bind, proxy_port), ProxyHandler)
+    config_names = args
+
+for config_name in config_names:
+    if not config_name in config.configs:
+        print >>sys.stderr, "Usage: Configuration name '%s' is not defined in config.py" % config_name
+        sys.exit(1)
+
+for config_name in config_names:
+    instances.append(Instance(config_name, config.configs[config_name]))
+
+# Every instance but the first needs to be told apart from the others,
+# and mustn't share files with them
+seen_routes = set()
+seen_paths = set()
+for instance in instances:
+    if instance is not instances[0] and instance.host is None and instance.prefix == '':
+        print >>sys.stderr, "Configuration '%s' needs a proxy_host or proxy_prefix to be served along with '%s'" % (instance.name, instances[0].name)
+        sys.exit(1)
+    if (instance.host, instance.prefix) in seen_routes:
+        print >>sys.stderr, "Configuration '%s' has the same proxy_host and proxy_prefix as another" % instance.name
+        sys.exit(1)
+    seen_routes.add((instance.host, instance.prefix))
+    for key in ('attachment_cache_dir', 'draft_store_path'):
+        if key in instance.config:
+            path = os.path.abspath(os.path.expanduser(instance.config[key]))
+            if path in seen_paths:
+                print >>sys.stderr, "Configuration '%s' has the same %s as another" % (instance.name, key)
+                sys.exit(1)
+            seen_paths.add(path)
+
+static_files = StaticFiles(os.getcwd(), ProxyHandler.extensions_map,
+                           config_value('compress_responses', True),
+                           config_value('static_check_interval', 1))
+
+profile_dir = config_value('profile_dir', None)
+if profile_dir is not None:
+    profile_dir = os.path.expanduser(profile_dir)
+slow_request_log = config_value('slow_request_log', None)
+if slow_request_log is not None:
+    slow_request_log = os.path.expanduser(slow_request_log)
+request_profiler = RequestProfiler(profile_dir,
+                                   config_value('profile_sample_rate', 0),
+                                   config_value('slow_request_threshold', None),
+                                   slow_request_log)
+
+proxy_bind = config_value('proxy_bind', '127.0.0.1')
+proxy_port = config_value('proxy_port', 23080)
+
+httpd = make_server((proxy_bind, proxy_port))
+for instance in instances:
+    print >>sys.stderr, "Running %s as http://%s:%d%s/index.html" % (instance.name,
+                                                                     instance.host or proxy_bind, proxy_port,
+                                                                     instance.prefix)
+
+forking = config_value('server_engine', 'threads') == 'fork'
+session_threads = []
+for instance in instances:
+    session_threads += instance.start_session(forking)
+if forking:
+    for thread in session_threads:
+        thread.join()
 httpd.serve_forever()
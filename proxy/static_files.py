@@ -0,0 +1,123 @@
+# In-memory index of the static files under the document root
+#
+# For each file we remember the size, modification time, a strong ETag
+# computed from the contents and, for compressible types, a gzip
+# compressed copy. Files are only re-examined when check_interval
+# seconds have passed since they were last checked, so most requests
+# for static files don't touch the filesystem until the body is sent.
+
+import hashlib
+import os
+import re
+import threading
+import time
+
+import compression
+
+# Files with a content hash in their name, like splinter.flat.0123abcd.js,
+# never change, and can be cached by the browser forever
+CONTENT_HASHED_RE = re.compile(r'\.[0-9a-f]{8,}\.\w+$')
+
+class StaticFile:
+    def __init__(self, path, size, mtime, etag, content_type, gzip_data):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.content_type = content_type
+        self.gzip_data = gzip_data
+        self.content_hashed = CONTENT_HASHED_RE.search(path) is not None
+        self.checked = time.time()
+
+    def gzip_etag(self):
+        return self.etag[:-1] + '-gzip"'
+
+class StaticFiles:
+    # extensions_map maps extensions to content types, as for
+    # SimpleHTTPRequestHandler
+    def __init__(self, root, extensions_map, precompress=True, check_interval=1):
+        self.root = root
+        self.extensions_map = extensions_map
+        self.precompress = precompress
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        # filesystem path => StaticFile
+        self._files = {}
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                self.lookup(os.path.join(dirpath, filename))
+
+    def _guess_type(self, path):
+        ext = os.path.splitext(path)[1]
+        if ext in self.extensions_map:
+            return self.extensions_map[ext]
+        ext = ext.lower()
+        if ext in self.extensions_map:
+            return self.extensions_map[ext]
+
+        return self.extensions_map['']
+
+    def _load(self, path, st):
+        f = open(path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        content_type = self._guess_type(path)
+        gzip_data = None
+        if self.precompress and compression.is_compressible(content_type):
+            gzip_data = compression.gzip_data(data)
+
+        return StaticFile(path, st.st_size, st.st_mtime, etag, content_type, gzip_data)
+
+    # Get the StaticFile for a filesystem path, or None if there is no
+    # regular file there
+    def lookup(self, path):
+        self._lock.acquire()
+        try:
+            static_file = self._files.get(path)
+        finally:
+            self._lock.release()
+
+        now = time.time()
+        if static_file is not None and now - static_file.checked < self.check_interval:
+            return static_file
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        if st is None or not os.path.isfile(path):
+            static_file = None
+        elif (static_file is not None and
+              static_file.size == st.st_size and static_file.mtime == st.st_mtime):
+            static_file.checked = now
+        else:
+            try:
+                static_file = self._load(path, st)
+            except IOError:
+                static_file = None
+
+        self._lock.acquire()
+        try:
+            if static_file is None:
+                self._files.pop(path, None)
+            else:
+                self._files[path] = static_file
+        finally:
+            self._lock.release()
+
+        return static_file
+
+    # Force the file to be examined again on the next lookup()
+    def invalidate(self, path):
+        self._lock.acquire()
+        try:
+            self._files.pop(path, None)
+        finally:
+            self._lock.release()